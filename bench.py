@@ -0,0 +1,539 @@
+"""
+Benchmark the main pages against a generated dataset.
+
+    python bench.py                                 # default scale, print a report
+    python bench.py --events 5000 --bookings 50000  # bigger dataset
+    python bench.py --save bench_baseline.json      # keep the numbers
+    python bench.py --compare bench_baseline.json   # diff against them (exit 1 on regressions)
+    python bench.py --load 10                       # readers vs. concurrent bookings (WAL)
+    python bench.py --load 10 --journal-mode DELETE # the same with the old rollback journal
+    python bench.py --database-url postgresql://localhost/bench_scratch
+
+A scratch SQLite database, or the empty one given by --database-url (the
+bench refuses a database whose tables already hold data), is filled through
+the models (users, events, tags, images, ticket types, bookings, payments),
+then every scenario is requested through the Flask test client. For each
+scenario the report has latency percentiles, SQL statements per request and
+rows returned per request.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+import argparse, json, os, random, re, shutil, statistics, sys, tempfile, threading, time
+
+from flask_bcrypt import generate_password_hash
+from sqlalchemy import create_engine, event, inspect, insert, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from website import SQLITE_PRAGMAS, _database_url, create_app, db, fragments
+from website.cache import aggregate_cache
+from website.models import User, Event, Tag, Event_Tag, Event_Image, TicketType, Booking, Payment
+
+PASSWORD = "bench-password"
+FORMATS = ("In-person", "Virtual", "Hybrid")
+WORDS = ("python", "data", "startup", "design", "marketing", "finance", "health", "cloud",
+         "security", "music", "networking", "workshop", "summit", "meetup", "careers")
+IMAGES = ("/static/img/pitch-night.jpg", "/static/img/ai-brisbane.jpg", "/static/img/wellness.jpg")
+
+
+# dataset
+
+# filled by the schema migrations rather than seed(), so rows there don't make a database "in use"
+_SETUP_TABLES = {"schema_version", "tags"}
+
+
+def existing_tables(url):
+    """(the app's tables already in the database at url, those of them holding data)."""
+    engine = create_engine(_database_url(url))
+    try:
+        with engine.connect() as conn:
+            existing = set(inspect(conn).get_table_names()) & set(db.metadata.tables)
+            in_use = sorted(
+                name for name in existing - _SETUP_TABLES
+                if conn.execute(select(text("1")).select_from(db.metadata.tables[name]).limit(1)).first()
+            )
+    finally:
+        engine.dispose()
+    return existing, in_use
+
+
+def _title(rng):
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(2, 4)))
+
+
+def seed(users=200, events=2000, bookings=20000, seed_value=1):
+    """
+    Fill the (empty) database. Hosts are the first tenth of the users and
+    bookings are skewed towards user 1, so the host / history pages have real
+    volume to page through. Must run inside an app context.
+    """
+    rng = random.Random(seed_value)
+    now = datetime.now()
+    pw_hash = generate_password_hash(PASSWORD).decode()
+
+    db.session.execute(insert(User), [
+        {"id": i, "name": f"user{i}", "email": f"user{i}@bench.test", "password_hash": pw_hash,
+         "first_name": "Bench", "last_name": f"User{i}"}
+        for i in range(1, users + 1)
+    ])
+
+    tag_ids = [t.id for t in db.session.query(Tag).all()]
+    hosts = max(users // 10, 1)
+    event_rows, image_rows, tag_rows, ticket_rows = [], [], [], []
+    ticket_of = {}
+    for eid in range(1, events + 1):
+        start = now + timedelta(days=rng.randint(-60, 180), hours=rng.randint(0, 23))
+        capacity = rng.choice((20, 50, 100, 250, 1000))
+        event_rows.append({
+            "id": eid, "host_user_id": rng.randint(1, hosts), "title": _title(rng),
+            "description": " ".join(rng.choice(WORDS) for _ in range(30)),
+            "event_type": rng.choice(FORMATS), "event_timezone": "Australia/Brisbane",
+            "start_at": start, "end_at": start + timedelta(hours=2),
+            "location_text": rng.choice(("Brisbane", "Sydney", "Melbourne", "Online")),
+            "capacity": capacity, "cancelled": rng.random() < 0.05,
+        })
+        image_rows.append({"event_id": eid, "url": rng.choice(IMAGES), "alt_text": "Event image"})
+        for tag_id in rng.sample(tag_ids, rng.randint(1, 2)):
+            tag_rows.append({"event_id": eid, "tag_id": tag_id})
+        price = rng.choice((0, 10, 25, 49.5, 120))
+        ticket_rows.append({
+            "id": eid, "event_id": eid, "name": "General Admission", "is_free": price == 0,
+            "price": Decimal(str(price)), "currency": "AUD", "capacity": capacity,
+        })
+        ticket_of[eid] = (capacity, Decimal(str(price)))
+
+    db.session.execute(insert(Event), event_rows)
+    db.session.execute(insert(Event_Image), image_rows)
+    db.session.execute(insert(Event_Tag), tag_rows)
+    db.session.execute(insert(TicketType), ticket_rows)
+
+    booking_rows, payment_rows = [], []
+    sold = {}
+    for n in range(bookings):
+        eid = rng.randint(1, events)
+        capacity, price = ticket_of[eid]
+        qty = rng.randint(1, 4)
+        status = rng.choices(("CONFIRMED", "CANCELLED", "REFUNDED", "RESERVED"), (80, 10, 5, 5))[0]
+        if status == "CONFIRMED":
+            if sold.get(eid, 0) + qty > capacity:
+                continue
+            sold[eid] = sold.get(eid, 0) + qty
+        user_id = 1 if rng.random() < 0.05 else rng.randint(1, users)
+        booking_id = f"bench{n:019d}"
+        booking_rows.append({
+            "booking_id": booking_id, "event_id": eid, "user_id": user_id, "ticket_type_id": eid,
+            "qty": qty, "unit_price": price, "total_amount": price * qty, "status": status,
+        })
+        payment_rows.append({
+            "booking_id": booking_id, "provider": "bench", "amount": price * qty, "currency": "AUD",
+            "status": "CAPTURED" if status == "CONFIRMED" else "REFUNDED" if status == "REFUNDED" else "PENDING",
+        })
+    for i in range(0, len(booking_rows), 5000):
+        db.session.execute(insert(Booking), booking_rows[i:i + 5000])
+        db.session.execute(insert(Payment), payment_rows[i:i + 5000])
+
+    if db.engine.dialect.name == "postgresql":
+        # rows were inserted with explicit ids; move the serial sequences past them
+        for table in ("users", "events", "ticket_types"):
+            db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                    f"(SELECT max(id) FROM {table}))"))
+
+    from website.bookings import reconcile_sales
+    reconcile_sales()
+    db.session.commit()
+    return {"users": users, "events": events, "bookings": len(booking_rows)}
+
+
+# SQL accounting
+
+class SQLCounter:
+    """Counts statements (every cursor execute) and rows returned to ORM selects."""
+
+    def __init__(self):
+        self.active = False
+        self.queries = 0
+        self.rows = 0
+
+    def reset(self):
+        self.queries = 0
+        self.rows = 0
+
+    def install(self):
+        event.listen(Engine, "after_cursor_execute", self._on_execute)
+        event.listen(Session, "do_orm_execute", self._on_orm_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active:
+            self.queries += 1
+
+    def _on_orm_execute(self, state):
+        if not self.active or not state.is_select:
+            return None
+        # buffer the result once to count its rows, then hand back an equivalent one
+        frozen = state.invoke_statement().freeze()
+        self.rows += len(frozen.data)
+        return frozen()
+
+
+# scenarios
+
+def _csrf_token(client, url):
+    body = client.get(url).get_data(as_text=True)
+    m = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', body)
+    return m.group(1) if m else None
+
+
+def _login(client, name):
+    token = _csrf_token(client, "/login")
+    r = client.post("/login", data={"user_name": name, "password": PASSWORD, "csrf_token": token})
+    if r.status_code != 302:
+        raise RuntimeError(f"could not log in as {name}")
+    return token
+
+
+def _open_event_ids():
+    # upcoming events with room for a benchmark's worth of single-ticket bookings
+    rows = (
+        db.session.query(Event.id)
+        .filter(Event.cancelled == False, Event.start_at > datetime.now(),
+                Event.capacity - Event.sold_qty >= 50)
+        .all()
+    )
+    return [eid for (eid,) in rows]
+
+
+def scenarios(app, rng):
+    """
+    (name, client, method, url-or-callable, form data) for every benchmarked page.
+    Callables are re-evaluated per request so e.g. event pages vary the event.
+    """
+    anon = app.test_client()
+    host = app.test_client()
+    attendee = app.test_client()
+    buyer = app.test_client()
+    _login(host, "user1")
+    _login(attendee, "user1")
+
+    with app.app_context():
+        users = db.session.query(User).count()
+        events = db.session.query(Event).count()
+        bookable = _open_event_ids()
+        # the last user never hosts (hosts are the first tenth), so every event is bookable
+        buyer_name = f"user{users}"
+        first_tag = db.session.query(Tag.name).order_by(Tag.name).first()[0]
+
+    buy_token = _login(buyer, buyer_name)
+
+    # a cursor token for the second listing page, to time a keyset "next" page
+    first = anon.get("/home?cursor=").get_data(as_text=True)
+    m = re.search(r'cursor=([A-Za-z0-9_\-]+)"[^>]*rel="next"|rel="next"[^>]*href="[^"]*cursor=([A-Za-z0-9_\-]+)', first)
+    next_cursor = (m.group(1) or m.group(2)) if m else ""
+
+    out = []
+    for sort in ("dateSoonest", "priceLowHigh", "priceHighLow", "popularity", "relevance"):
+        out.append((f"index sort={sort}", anon, "GET", f"/home?sort={sort}", None))
+    for status in ("Open", "Sold Out", "Cancelled", "Inactive"):
+        out.append((f"index status={status}", anon, "GET", f"/home?status={status.replace(' ', '+')}", None))
+    out += [
+        ("index category", anon, "GET", f"/home?category={first_tag}", None),
+        ("index format", anon, "GET", "/home?format=Virtual", None),
+        ("index price range", anon, "GET", "/home?price_min=10&price_max=50&sort=priceLowHigh", None),
+        ("index keyword", anon, "GET", "/home?q=python", None),
+        ("index all filters", anon, "GET",
+         f"/home?q=data&category={first_tag}&format=Hybrid&price_min=5&status=Open&sort=popularity", None),
+        ("index deep page", anon, "GET", f"/home?page={max(events // 9 // 2, 1)}", None),
+        ("index cursor next", anon, "GET", f"/home?cursor={next_cursor}", None),
+        ("search relevance", anon, "GET", "/search?q=python+summit", None),
+        ("search prefix", anon, "GET", "/search?q=sec&sort=dateSoonest", None),
+        ("event page", anon, "GET", lambda: f"/event/{rng.randint(1, events)}", None),
+        ("event page (signed in)", attendee, "GET", lambda: f"/event/{rng.randint(1, events)}", None),
+        ("my events", host, "GET", "/my-events", None),
+        ("my events table", host, "GET", "/my-events?view=table&when=all&sort=created", None),
+        ("my events cursor", host, "GET", "/my-events?cursor=", None),
+        ("booking history", attendee, "GET", "/booking-history", None),
+        ("booking history page 3", attendee, "GET", "/booking-history?page=3", None),
+        ("book event", buyer, "POST", lambda: f"/event/{rng.choice(bookable)}/book",
+         {"qty": "1", "csrf_token": buy_token}),
+    ]
+    return out
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def run(app, iterations=30, warmup=3, cold=False, seed_value=1, only=None):
+    """Time every scenario; returns {name: stats}."""
+    rng = random.Random(seed_value)
+    counter = SQLCounter()
+    counter.install()
+    results = {}
+    for name, client, method, url, data in scenarios(app, rng):
+        if only and not re.search(only, name):
+            continue
+        timings, queries, rows, statuses = [], [], [], set()
+        for i in range(warmup + iterations):
+            target = url() if callable(url) else url
+            if cold:
+                aggregate_cache.clear()
+                app.extensions["fragment_cache"].clear()
+            counter.reset()
+            counter.active = True
+            started = time.perf_counter()
+            r = client.post(target, data=data) if method == "POST" else client.get(target)
+            elapsed = time.perf_counter() - started
+            counter.active = False
+            if r.status_code >= 500 or (method == "GET" and r.status_code != 200):
+                # a redirect or error page would time the wrong thing
+                raise RuntimeError(f"{name}: {target} returned {r.status_code}")
+            if i < warmup:
+                continue
+            statuses.add(r.status_code)
+            timings.append(elapsed * 1000)
+            queries.append(counter.queries)
+            rows.append(counter.rows)
+        results[name] = {
+            "n": len(timings),
+            "p50_ms": round(_percentile(timings, 50), 3),
+            "p95_ms": round(_percentile(timings, 95), 3),
+            "p99_ms": round(_percentile(timings, 99), 3),
+            "mean_ms": round(statistics.fmean(timings), 3),
+            "queries": round(statistics.fmean(queries), 2),
+            "max_queries": max(queries),
+            "rows": round(statistics.fmean(rows), 1),
+            "status": sorted(statuses),
+        }
+    return results
+
+
+# load test: concurrent readers while others book
+
+def _load_worker(app, kind, i, seconds, seed_value, start, out):
+    """One reader or writer: loops for `seconds` and puts (kind, timings, errors) on `out`."""
+    client, rng = app.test_client(), random.Random(seed_value * 1000 + i)
+    with app.app_context():
+        events = db.session.query(Event).count()
+        users = db.session.query(User).count()
+        bookable = _open_event_ids()
+        db.session.remove()
+    # the last users never host, so they can book anything
+    token = _login(client, f"user{users - i}") if kind == "write" else None
+    timings, errors = [], 0
+    start.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        began = time.perf_counter()
+        if kind == "read":
+            url = "/home" if rng.random() < 0.3 else f"/event/{rng.randint(1, events)}"
+            ok = client.get(url).status_code == 200
+        else:
+            r = client.post(f"/event/{rng.choice(bookable)}/book", data={"qty": "1", "csrf_token": token})
+            ok = r.headers.get("Location", "").endswith("/booking-history")
+            # drop the flash message so the session cookie doesn't grow with every booking
+            with client.session_transaction() as sess:
+                sess.pop("_flashes", None)
+        timings.append((time.perf_counter() - began) * 1000)
+        errors += not ok
+    out.put((kind, timings, errors))
+
+
+def load(app, seconds=10.0, readers=8, writers=2, seed_value=1):
+    """
+    Readers fetch the home and event pages in a loop while writers book
+    tickets, each in its own forked process (threads where fork isn't
+    available), like workers of a multi-process server. Returns latency and
+    error stats for both, to see whether reads stall behind the booking writes.
+    """
+    import multiprocessing
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+        spawn, out = ctx.Process, ctx.Queue()
+    else:
+        import queue
+        ctx, spawn, out = threading, threading.Thread, queue.Queue()
+    start = ctx.Barrier(readers + writers)
+    workers = [spawn(target=_load_worker, args=(app, "read", i, seconds, seed_value, start, out))
+               for i in range(readers)]
+    workers += [spawn(target=_load_worker, args=(app, "write", i, seconds, seed_value, start, out))
+                for i in range(writers)]
+    for w in workers:
+        w.start()
+    samples, errors = {"read": [], "write": []}, {"read": 0, "write": 0}
+    for _ in workers:
+        kind, timings, failed = out.get()
+        samples[kind] += timings
+        errors[kind] += failed
+    for w in workers:
+        w.join()
+
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            journal = db.session.execute(text("PRAGMA journal_mode")).scalar()
+        else:
+            journal = db.engine.dialect.name
+    results = {"seconds": seconds, "readers": readers, "writers": writers, "journal_mode": journal}
+    for kind, timings in samples.items():
+        results[kind] = {
+            "n": len(timings),
+            "per_s": round(len(timings) / seconds, 1),
+            "errors": errors[kind],
+            "p50_ms": round(_percentile(timings, 50), 3) if timings else None,
+            "p95_ms": round(_percentile(timings, 95), 3) if timings else None,
+            "p99_ms": round(_percentile(timings, 99), 3) if timings else None,
+            "max_ms": round(max(timings), 3) if timings else None,
+        }
+    return results
+
+
+# reporting
+
+def report(results, out=sys.stdout):
+    width = max(len(name) for name in results) if results else 10
+    print(f"{'scenario':<{width}}  {'p50':>8} {'p95':>8} {'p99':>8}  {'queries':>7} {'rows':>8}", file=out)
+    for name, r in results.items():
+        print(f"{name:<{width}}  {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}"
+              f"  {r['queries']:>7.1f} {r['rows']:>8.1f}", file=out)
+
+
+def report_load(results, out=sys.stdout):
+    print(f"{results['seconds']:.0f}s, {results['readers']} readers, {results['writers']} writers,"
+          f" journal_mode={results['journal_mode']}", file=out)
+    print(f"{'':<8}{'requests':>9} {'per s':>7} {'errors':>7}  {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}", file=out)
+    for kind in ("read", "write"):
+        r = results[kind]
+        if not r["n"]:
+            print(f"{kind:<8}{0:>9}", file=out)
+            continue
+        print(f"{kind:<8}{r['n']:>9} {r['per_s']:>7.1f} {r['errors']:>7}  {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f}"
+              f" {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}", file=out)
+
+
+def compare(old, new, threshold=20.0, out=sys.stdout):
+    """
+    Print per-scenario changes against a saved run and return the regressions:
+    p95 slower by more than `threshold` percent, or more SQL statements per request.
+    """
+    regressions = []
+    width = max(len(name) for name in new) if new else 10
+    print(f"{'scenario':<{width}}  {'p95 old':>8} {'p95 new':>8} {'change':>8}  {'queries':>13}", file=out)
+    for name, r in new.items():
+        before = old.get(name)
+        if before is None:
+            print(f"{name:<{width}}  {'-':>8} {r['p95_ms']:>8.2f} {'new':>8}", file=out)
+            continue
+        change = (r["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 if before["p95_ms"] else 0.0
+        flags = []
+        if change > threshold:
+            flags.append("slower")
+        if r["queries"] > before["queries"]:
+            flags.append("more queries")
+        if flags:
+            regressions.append((name, flags))
+        print(f"{name:<{width}}  {before['p95_ms']:>8.2f} {r['p95_ms']:>8.2f} {change:>+7.1f}%"
+              f"  {before['queries']:>5.1f} -> {r['queries']:<5.1f} {'  !! ' + ', '.join(flags) if flags else ''}",
+              file=out)
+    for name in old:
+        if name not in new:
+            print(f"{name:<{width}}  (not run)", file=out)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the site's pages on generated data.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--bookings", type=int, default=20000)
+    parser.add_argument("--iterations", type=int, default=30, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests per scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cold", action="store_true", help="clear the aggregate and fragment caches before every request")
+    parser.add_argument("--only", help="regex; run only the matching scenarios")
+    parser.add_argument("--save", metavar="PATH", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="diff against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=20.0, help="p95 slowdown (%%) counted as a regression")
+    parser.add_argument("--load", type=float, metavar="SECONDS",
+                        help="instead of the scenarios, run readers and booking writers concurrently")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--journal-mode", help="override the SQLite journal mode, e.g. DELETE to compare with WAL")
+    parser.add_argument("--database-url", help="an empty database to use instead of a scratch SQLite file"
+                                                " (e.g. PostgreSQL); the tables the run creates are dropped afterwards")
+    args = parser.parse_args(argv)
+
+    existing = set()
+    if args.database_url:
+        # seed() writes fixed primary keys: never run against a database in use
+        existing, in_use = existing_tables(args.database_url)
+        if in_use:
+            parser.error(f"--database-url must be an empty database; {', '.join(in_use)} already hold rows")
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    app = None
+    seeded = False
+    try:
+        config = {
+            "SQLALCHEMY_DATABASE_URI": args.database_url or "sqlite:///" + os.path.join(workdir, "bench.sqlite"),
+            "TESTING": True,
+        }
+        if args.journal_mode:
+            config["SQLITE_PRAGMAS"] = {**SQLITE_PRAGMAS, "journal_mode": args.journal_mode}
+        app = create_app(config)
+        with app.app_context():
+            started = time.perf_counter()
+            scale = seed(args.users, args.events, args.bookings, args.seed)
+            seeded = True
+            print(f"seeded {scale['users']} users, {scale['events']} events, {scale['bookings']} bookings"
+                  f" in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        aggregate_cache.clear()
+
+        if args.load:
+            results = load(app, args.load, args.readers, args.writers, args.seed)
+            report_load(results)
+            if args.save:
+                with open(args.save, "w") as fh:
+                    json.dump({"scale": scale, "load": results}, fh, indent=2)
+            return 0
+
+        results = run(app, args.iterations, args.warmup, args.cold, args.seed, args.only)
+        report(results)
+        with app.app_context():
+            for label, stats in (("aggregate cache", aggregate_cache.stats()), ("fragment cache", fragments.stats())):
+                if "hit_rate" in stats:
+                    print(f"{label}: {stats['hits']} hits, {stats['misses']} misses"
+                          f" ({stats['hit_rate']:.0%} hit rate)", file=sys.stderr)
+
+        if args.save:
+            with open(args.save, "w") as fh:
+                json.dump({"scale": scale, "iterations": args.iterations, "cold": args.cold,
+                           "results": results}, fh, indent=2)
+        if args.compare:
+            with open(args.compare) as fh:
+                baseline = json.load(fh)
+            print()
+            regressions = compare(baseline["results"], results, args.threshold)
+            if regressions:
+                print(f"\n{len(regressions)} regression(s)")
+                return 1
+        return 0
+    finally:
+        if args.database_url and seeded:
+            # only what this run created; tables that were there (empty) keep the bench data
+            with app.app_context():
+                db.session.remove()
+                if not existing:
+                    db.drop_all()  # with the PostgreSQL enum types
+                else:
+                    for table in reversed(db.metadata.sorted_tables):
+                        if table.name not in existing:
+                            table.drop(db.engine)
+            if existing:
+                print(f"left bench data in the existing tables: {', '.join(sorted(existing))}", file=sys.stderr)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
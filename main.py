@@ -1,5 +1,6 @@
 from website import create_app
 
 if __name__ == '__main__':
-    app = create_app()
-    app.run()
\ No newline at end of file
+    # development server; production runs wsgi.py
+    app = create_app({'DEBUG': True})
+    app.run()
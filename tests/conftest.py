@@ -0,0 +1,119 @@
+import itertools
+import os
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+from flask_bcrypt import generate_password_hash
+from sqlalchemy import create_engine, inspect
+
+from website import _database_url, create_app, db
+from website.cache import aggregate_cache
+from website.models import Event, TicketType, User
+
+PASSWORD = "pw123456"
+_PASSWORD_HASH = generate_password_hash(PASSWORD, 4).decode()  # cheap rounds, tests only
+
+# every database test runs against SQLite (a temp file) and, when
+# TEST_POSTGRES_URL names an empty PostgreSQL database, against that too;
+# the tables and enum types a test creates there are dropped after it
+POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL")
+
+
+@pytest.fixture(params=[
+    "sqlite",
+    pytest.param("postgresql", marks=pytest.mark.skipif(not POSTGRES_URL, reason="TEST_POSTGRES_URL is not set")),
+])
+def database_url(request, tmp_path):
+    if request.param == "sqlite":
+        return f"sqlite:///{tmp_path / 'test.sqlite'}"
+    engine = create_engine(_database_url(POSTGRES_URL))
+    try:
+        with engine.connect() as conn:
+            tables = inspect(conn).get_table_names()
+    finally:
+        engine.dispose()
+    if tables:
+        pytest.fail(f"TEST_POSTGRES_URL has tables ({', '.join(sorted(tables))}); the tests need an empty database")
+    return POSTGRES_URL
+
+
+@pytest.fixture
+def make_app(database_url, tmp_path):
+    apps = []
+
+    def make(**config):
+        app = create_app({
+            "TESTING": True,
+            "SECRET_KEY": "test",
+            "SQLALCHEMY_DATABASE_URI": database_url,
+            "STORAGE_ROOT": str(tmp_path / "media"),
+            "ASSETS_ROOT": str(tmp_path / "assets"),
+            "ASSETS_AUTO_BUILD": False,
+            "METRICS_ENABLED": False,
+            **config,
+        })
+        apps.append(app)
+        return app
+
+    yield make
+    aggregate_cache.clear()  # process-wide, and event ids repeat from one test database to the next
+    for app in apps:
+        app.extensions["jobs"].stop()  # before the tables its dispatcher polls go away
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+    if apps and database_url.startswith("postgresql"):
+        with apps[0].app_context():
+            db.drop_all(bind_key=None)  # the enum types too; not the replica bind another test may have added
+            db.engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def make_event():
+    """Add a host, an event and its ticket type (in the current app context); returns their ids."""
+    hosts = itertools.count()
+
+    def make(capacity=10, **fields):
+        n = next(hosts)
+        host = User(name=f"host{n}", email=f"host{n}@example.com", password_hash=_PASSWORD_HASH)
+        db.session.add(host)
+        db.session.flush()
+        fields = {"title": "Test event", "start_at": datetime(2030, 1, 1, 9), "end_at": datetime(2030, 1, 1, 17), **fields}
+        event = Event(host_user_id=host.id, capacity=capacity, **fields)
+        db.session.add(event)
+        db.session.flush()
+        ticket = TicketType(event_id=event.id, name="GA", price=Decimal("10.00"), currency="AUD", capacity=capacity)
+        db.session.add(ticket)
+        db.session.commit()
+        return event.id, ticket.id, host.id
+
+    return make
+
+
+@pytest.fixture
+def make_user():
+    """Add a user who can log in with PASSWORD (in the current app context); returns the id."""
+    def make(name):
+        user = User(name=name, email=f"{name}@example.com", password_hash=_PASSWORD_HASH)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+    return make
+
+
+@pytest.fixture
+def login():
+    """login(app, name): a test client logged in as name (the app needs WTF_CSRF_ENABLED off)."""
+    def log_in(app, name):
+        client = app.test_client()
+        assert client.post("/login", data={"user_name": name, "password": PASSWORD}).status_code == 302
+        return client
+
+    return log_in
@@ -0,0 +1,151 @@
+import csv
+import functools
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select, update
+
+from website import bookings, db
+from website.bookings import place_booking, release_booking
+from website.models import Booking, BookingStatusEnum, Event, Payment, TicketType, User
+
+
+@pytest.mark.parametrize("attempts, threads, capacity, qty", [
+    (25, 8, 10, 1),
+    (2000, 32, 500, 1),
+    (1000, 16, 301, 3),  # the last seats can't take a whole booking
+])
+def test_concurrent_bookings_never_oversell(make_app, make_event, attempts, threads, capacity, qty):
+    # a pooled connection per thread (PostgreSQL's pool is smaller by default)
+    app = make_app(DB_POOL_SIZE=threads, DB_MAX_OVERFLOW=0)
+    with app.app_context():
+        event_id, ticket_id, _ = make_event(capacity=capacity)
+        buyers = [User(name=f"buyer{i}", email=f"buyer{i}@example.com", password_hash="x") for i in range(threads)]
+        db.session.add_all(buyers)
+        db.session.commit()
+        buyer_ids = [u.id for u in buyers]
+
+    def buy(i):
+        with app.app_context():
+            ticket = db.session.get(TicketType, ticket_id)
+            try:
+                return place_booking(event_id, buyer_ids[i % threads], ticket, qty) is not None
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(buy, range(attempts)))
+
+    expected = min(capacity // qty, attempts)
+    assert results.count(True) == expected
+    with app.app_context():
+        event = db.session.get(Event, event_id)
+        confirmed = db.session.execute(
+            select(func.sum(Booking.qty)).where(Booking.event_id == event_id, Booking.status == "CONFIRMED")
+        ).scalar()
+        assert confirmed == event.sold_qty == expected * qty <= capacity
+        assert db.session.get(TicketType, ticket_id).sold_qty == expected * qty
+        assert db.session.execute(select(func.count()).select_from(Payment)).scalar() == expected
+
+
+def test_cancelled_event_takes_no_bookings(app, make_event):
+    with app.app_context():
+        event_id, ticket_id, user_id = make_event(cancelled=True)
+        assert place_booking(event_id, user_id, db.session.get(TicketType, ticket_id), qty=1) is None
+        assert db.session.get(Event, event_id).sold_qty == 0
+
+
+def test_concurrent_cancellations_return_seats_once(app, make_event):
+    with app.app_context():
+        event_id, ticket_id, user_id = make_event(capacity=10)
+        booking_id = place_booking(event_id, user_id, db.session.get(TicketType, ticket_id), qty=3).booking_id
+        db.session.remove()
+
+    def cancel(_):
+        with app.app_context():
+            booking = db.session.get(Booking, booking_id)
+            try:
+                released = release_booking(booking)
+                db.session.commit()
+                return released
+            finally:
+                db.session.remove()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(cancel, range(4)))
+
+    assert results.count(True) == 1
+    with app.app_context():
+        booking = db.session.get(Booking, booking_id)
+        assert booking.status is BookingStatusEnum.CANCELLED and booking.cancelled_at is not None
+        assert db.session.get(Event, event_id).sold_qty == 0
+        assert db.session.get(TicketType, ticket_id).sold_qty == 0
+
+
+@pytest.fixture
+def export(make_app, make_event, make_user, login, monkeypatch):
+    """An event with 12 bookings in tied created_at groups; yields (host client, url, booking ids)."""
+    monkeypatch.setattr(bookings, "_EXPORT_BATCH", 5)  # several fetches per export
+    app = make_app(WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        event_id, ticket_id, _ = make_event(capacity=100)
+        user_id = make_user("attendee")
+        ticket = db.session.get(TicketType, ticket_id)
+        booking_ids = [place_booking(event_id, user_id, ticket, qty=1).booking_id for _ in range(12)]
+        # three bookings per timestamp, whole and fractional seconds, so resuming
+        # has to break ties on booking_id
+        base = datetime(2030, 1, 1, 9)
+        for n, booking_id in enumerate(booking_ids):
+            created = base + timedelta(seconds=n // 3, milliseconds=250 * (n // 3 % 2))
+            db.session.execute(update(Booking).where(Booking.booking_id == booking_id).values(created_at=created))
+        # a second payment: still one row per booking
+        db.session.add(Payment(booking_id=booking_ids[0], amount=10, currency="AUD", status="REFUNDED"))
+        db.session.commit()
+    yield app, login(app, "host0"), f"/event/{event_id}/attendees.csv", booking_ids
+
+
+def _rows(body):
+    return list(csv.DictReader(io.StringIO(body)))
+
+
+def test_attendee_export_resumes_without_gaps_or_repeats(export):
+    app, client, url, booking_ids = export
+    rows = _rows(client.get(url).get_data(as_text=True))
+    assert sorted(row["booking_id"] for row in rows) == sorted(booking_ids)
+    assert [row["payment_status"] for row in rows if row["booking_id"] == booking_ids[0]] == ["REFUNDED"]
+
+    # cut after every row in turn, including inside each run of equal timestamps
+    for cut in range(1, len(rows)):
+        last = rows[cut - 1]
+        resumed = _rows(client.get(url, query_string={"since": last["created_at"], "after": last["booking_id"]}).get_data(as_text=True))
+        assert [row["booking_id"] for row in rows[:cut] + resumed] == [row["booking_id"] for row in rows]
+
+
+def test_attendee_export_resumes_a_dropped_stream(export, monkeypatch):
+    app, client, url, booking_ids = export
+    # a chunk per row, so the stream can be dropped between rows
+    monkeypatch.setattr(bookings, "_csv_chunks", functools.partial(bookings._csv_chunks, flush_at=1))
+    response = client.get(url, buffered=False)
+    chunks = iter(response.response)
+    received = b"".join(next(chunks) for _ in range(1 + 5)).decode()  # the header, then five rows
+    response.close()
+    first = _rows(received)
+    assert len(first) == 5
+
+    last = first[-1]
+    rest = _rows(client.get(url, query_string={"since": last["created_at"], "after": last["booking_id"]}).get_data(as_text=True))
+    ids = [row["booking_id"] for row in first + rest]
+    assert len(ids) == len(set(ids)) == len(booking_ids)
+    assert set(ids) == set(booking_ids)
+
+
+def test_attendee_export_is_for_the_host_only(export, make_user, login):
+    app, host, url, _ = export
+    with app.app_context():
+        make_user("stranger")
+    assert login(app, "stranger").get(url).status_code == 404
+    assert app.test_client().get(url).status_code == 302  # to the login page
+    assert host.get("/event/999999/attendees.csv").status_code == 404
+    assert host.get(url, query_string={"since": "yesterday"}).status_code == 400
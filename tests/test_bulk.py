@@ -0,0 +1,63 @@
+import io
+import json
+
+from sqlalchemy import select, text
+
+from website import bulk, db, listing, search
+from website.models import Event, Event_Tag, Tag, TicketType, User
+
+
+def _records(host, count):
+    return "".join(json.dumps({
+        "title": f"Imported {n}",
+        "host": host,
+        "capacity": 10 + n,
+        "tags": [f"tag {n}"],
+        "tickets": [{"name": f"Ticket {n}", "price": str(n)}],
+    }) + "\n" for n in range(count))
+
+
+def test_import_onto_ids_with_gaps(app, make_event):
+    with app.app_context():
+        made = [make_event(title=f"Existing {n}") for n in range(5)]
+        ids, host_id = [event_id for event_id, _, _ in made], made[0][2]
+        host = db.session.get(Event, ids[0]).host.name
+        # gaps in the middle and at the end, and a row far past the rest
+        db.session.execute(Event.__table__.insert().values(id=ids[-1] + 500, host_user_id=host_id, title="Far away"))
+        for event_id in (ids[1], ids[3], ids[4]):
+            db.session.execute(TicketType.__table__.delete().where(TicketType.event_id == event_id))
+            db.session.execute(Event.__table__.delete().where(Event.id == event_id))
+        db.session.commit()
+
+        result = bulk.import_events(io.StringIO(_records(host, 7)), "jsonl", create_tags=True, batch_size=3)
+        assert (result.events, result.tags, result.tickets, result.errors) == (7, 7, 7, [])
+
+        imported = db.session.execute(
+            select(Event.id, Event.title, Event.capacity).where(Event.title.like("Imported %"))
+        ).all()
+        assert len({event_id for event_id, _, _ in imported}) == 7
+        for event_id, title, capacity in imported:
+            n = int(title.split()[1])
+            assert capacity == 10 + n
+            # every child row went to its own event
+            assert db.session.execute(
+                select(TicketType.name).where(TicketType.event_id == event_id)
+            ).scalars().all() == [f"Ticket {n}"]
+            assert db.session.execute(
+                select(Tag.name).join(Event_Tag, Event_Tag.tag_id == Tag.id).where(Event_Tag.event_id == event_id)
+            ).scalars().all() == [f"tag {n}"]
+            if search.enabled():
+                assert db.session.execute(
+                    text("SELECT title FROM events_fts WHERE rowid = :id"), {"id": event_id}
+                ).scalar() == title
+
+
+def test_import_creating_tags_refreshes_tag_names(app, make_event):
+    with app.app_context():
+        _, _, host_id = make_event()
+        host = db.session.get(User, host_id).name
+        before = listing.all_tag_names()  # now cached
+        assert "tag 0" not in before
+
+        bulk.import_events(io.StringIO(_records(host, 2)), "jsonl", create_tags=True)
+        assert set(listing.all_tag_names()) == set(before) | {"tag 0", "tag 1"}
@@ -0,0 +1,125 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+from website import db
+from website.bookings import place_booking
+from website.models import Event, TicketType, User
+
+PAGES = ["/home", "/event/{id}"]
+
+
+@pytest.fixture
+def site(make_app, make_event, make_user):
+    app = make_app(WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        event_id, ticket_id, _ = make_event(capacity=10, title="Conditional GETs")
+        make_user("alice")
+        make_user("bob")
+    return app, event_id, ticket_id
+
+
+@pytest.fixture
+def visitor(site, login):
+    """client() is anonymous, client(name) logged in."""
+    app = site[0]
+    return lambda user=None: login(app, user) if user else app.test_client()
+
+
+def _etag(client, url):
+    response = client.get(url)
+    assert response.status_code == 200 and response.headers.get("ETag")
+    return response.headers["ETag"]
+
+
+def _revalidate(client, url, etag):
+    return client.get(url, headers={"If-None-Match": etag})
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_repeat_get_is_not_modified(site, visitor, page):
+    app, event_id, _ = site
+    url = page.format(id=event_id)
+    for client in (visitor(), visitor("alice")):
+        etag = _etag(client, url)
+        response = _revalidate(client, url, etag)
+        assert response.status_code == 304 and response.data == b""
+        assert response.headers["ETag"] == etag
+        assert _revalidate(client, url, 'W/"something else"').status_code == 200
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_booking_changes_the_etag(site, visitor, page):
+    app, event_id, ticket_id = site
+    url = page.format(id=event_id)
+    client = visitor()
+    etag = _etag(client, url)
+    with app.app_context():
+        buyer = db.session.query(User).filter_by(name="bob").one()
+        assert place_booking(event_id, buyer.id, db.session.get(TicketType, ticket_id), qty=2)
+    response = _revalidate(client, url, etag)
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_edit_changes_the_etag(site, visitor, page):
+    app, event_id, _ = site
+    url = page.format(id=event_id)
+    with app.app_context():
+        # a page cached before this second (updated_at has one-second resolution on SQLite)
+        db.session.execute(update(Event).values(updated_at=datetime(2020, 1, 1)))
+        db.session.commit()
+    client = visitor()
+    etag = _etag(client, url)
+    with app.app_context():
+        db.session.get(Event, event_id).title = "Renamed"
+        db.session.commit()
+    response = _revalidate(client, url, etag)
+    assert response.status_code == 200 and b"Renamed" in response.data
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_status_flip_changes_the_etag(site, visitor, page):
+    app, event_id, _ = site
+    url = page.format(id=event_id)
+    starts = datetime.now() + timedelta(seconds=1)
+    with app.app_context():
+        # only the clock moves: nothing in the row changes when the event starts
+        db.session.execute(update(Event).values(start_at=starts, end_at=starts + timedelta(hours=1),
+                                                updated_at=Event.updated_at))
+        db.session.commit()
+    client = visitor()
+    etag = _etag(client, url)
+    assert _revalidate(client, url, etag).status_code == 304
+    time.sleep(max((starts - datetime.now()).total_seconds(), 0) + 0.1)
+    response = _revalidate(client, url, etag)
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_etag_is_per_user(site, visitor, page):
+    app, event_id, _ = site
+    url = page.format(id=event_id)
+    anonymous, alice, bob = visitor(), visitor("alice"), visitor("bob")
+    etags = {_etag(anonymous, url), _etag(alice, url), _etag(bob, url)}
+    assert len(etags) == 3
+    assert _revalidate(bob, url, _etag(alice, url)).status_code == 200
+    assert _revalidate(anonymous, url, _etag(alice, url)).status_code == 200
+    assert "private" in alice.get(url).headers["Cache-Control"]
+
+
+@pytest.mark.parametrize("page", PAGES)
+def test_pending_flash_is_rendered_not_revalidated(site, visitor, page):
+    app, event_id, _ = site
+    url = page.format(id=event_id)
+    client = visitor()
+    etag = _etag(client, url)
+    with client.session_transaction() as session:
+        session["_flashes"] = [("info", "Flash for the next page")]
+    response = _revalidate(client, url, etag)
+    assert response.status_code == 200 and b"Flash for the next page" in response.data
+    assert "ETag" not in response.headers
+    # shown once; the next visit is answered from the cache again
+    assert _revalidate(client, url, etag).status_code == 304
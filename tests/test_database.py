@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.exc import DBAPIError, StatementError
+
+from website import SQLITE_PRAGMAS, db, migrations
+from website.models import Booking, BookingStatusEnum, Event, Payment, PaymentStatusEnum
+
+
+# migrations
+
+def test_new_database_is_migrated_to_head(app):
+    with app.app_context():
+        assert migrations.current_version(db.engine) == migrations.head()
+        assert set(db.metadata.tables) <= set(inspect(db.engine).get_table_names())
+        assert migrations.upgrade(db.engine) == []
+
+
+def test_upgrade_applies_missing_steps_in_order(make_app):
+    app = make_app(AUTO_MIGRATE=False)
+    with app.app_context():
+        assert migrations.current_version(db.engine) == 0
+        assert [v for v, _ in migrations.upgrade(db.engine, target=3)] == [1, 2, 3]
+        assert migrations.current_version(db.engine) == 3
+        assert [v for v, _ in migrations.upgrade(db.engine)] == list(range(4, migrations.head() + 1))
+        assert migrations.upgrade(db.engine) == []
+    # a second app on the now-current database only reads the version
+    with make_app().app_context():
+        assert migrations.current_version(db.engine) == migrations.head()
+
+
+# enums
+
+def test_status_enums_round_trip(app, make_event):
+    with app.app_context():
+        event_id, ticket_id, user_id = make_event()
+        db.session.add(Booking(booking_id="b1", event_id=event_id, user_id=user_id, ticket_type_id=ticket_id,
+                               qty=1, unit_price=Decimal("10.00"), total_amount=Decimal("10.00"), status="CONFIRMED"))
+        db.session.add(Payment(booking_id="b1", amount=Decimal("10.00"), currency="AUD", status=PaymentStatusEnum.CAPTURED))
+        db.session.commit()
+        db.session.expire_all()
+
+        booking = db.session.get(Booking, "b1")
+        assert booking.status is BookingStatusEnum.CONFIRMED
+        assert db.session.execute(select(Payment.status)).scalar_one() is PaymentStatusEnum.CAPTURED
+        assert db.session.execute(select(Booking.booking_id).where(Booking.status == "CONFIRMED")).scalar_one() == "b1"
+
+        booking.status = "CANCELLED"
+        db.session.commit()
+        db.session.expire_all()
+        assert db.session.get(Booking, "b1").status is BookingStatusEnum.CANCELLED
+
+
+def test_status_enums_reject_unknown_values(app, make_event):
+    with app.app_context():
+        event_id, ticket_id, user_id = make_event()
+        db.session.add(Booking(booking_id="b1", event_id=event_id, user_id=user_id, ticket_type_id=ticket_id,
+                               qty=1, unit_price=Decimal("10.00"), total_amount=Decimal("10.00"), status="LOST"))
+        with pytest.raises(StatementError):
+            db.session.commit()
+        db.session.rollback()
+
+        # and the database refuses them too: a native enum on PostgreSQL, a CHECK constraint on SQLite
+        with pytest.raises(DBAPIError):
+            db.session.execute(text(
+                "INSERT INTO bookings (booking_id, event_id, user_id, ticket_type_id, qty, unit_price, total_amount, status)"
+                " VALUES ('b2', :event, :user, :ticket, 1, 10, 10, 'LOST')"
+            ), {"event": event_id, "user": user_id, "ticket": ticket_id})
+        db.session.rollback()
+
+
+def test_status_columns_are_native_enums_on_postgres(app):
+    with app.app_context():
+        if db.engine.dialect.name != "postgresql":
+            pytest.skip("native enum types are PostgreSQL only")
+        types = {c["name"]: c["type"] for c in inspect(db.engine).get_columns("bookings")}
+        assert types["status"].name == "booking_status"
+        assert set(types["status"].enums) == {s.value for s in BookingStatusEnum}
+
+
+# timestamps
+
+def test_naive_utc_timestamps_round_trip(app, make_event):
+    with app.app_context():
+        event_id, _, _ = make_event()
+        start = datetime(2030, 6, 30, 23, 30, 15)
+        event = db.session.get(Event, event_id)
+        event.start_at = start
+        event.end_at = start + timedelta(hours=2)
+        db.session.commit()
+        db.session.expire_all()
+
+        event = db.session.get(Event, event_id)
+        assert event.start_at == start and event.start_at.tzinfo is None
+        # server-side now() is UTC wall-clock time on both backends
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        assert event.created_at.tzinfo is None
+        assert abs(event.created_at - now) < timedelta(minutes=1)
+        # comparisons in SQL see the same value
+        assert db.session.execute(select(Event.id).where(Event.start_at == start)).scalar_one() == event_id
+        if db.engine.dialect.name == "postgresql":
+            stored = db.session.execute(text("SELECT extract(epoch FROM start_at) FROM events WHERE id = :id"),
+                                        {"id": event_id}).scalar_one()
+            assert float(stored) == start.replace(tzinfo=timezone.utc).timestamp()
+
+
+
+# connection settings
+
+def test_sqlite_pragmas_are_per_app(make_app, database_url, tmp_path):
+    if not database_url.startswith("sqlite"):
+        pytest.skip("SQLite pragmas")
+    defaults = dict(SQLITE_PRAGMAS)
+    tuned = make_app(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'tuned.sqlite'}",
+                     SQLITE_PRAGMAS={**defaults, "journal_mode": "DELETE", "busy_timeout": 1234})
+    plain = make_app(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'plain.sqlite'}")
+    assert SQLITE_PRAGMAS == defaults
+
+    def pragmas(app):
+        with app.app_context():
+            db.engine.dispose()  # fresh connections, made after both apps exist
+            with db.engine.connect() as conn:
+                return tuple(conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                             for name in ("journal_mode", "busy_timeout", "foreign_keys"))
+
+    assert pragmas(tuned) == ("delete", 1234, 1)
+    assert pragmas(plain) == ("wal", 5000, 1)
@@ -0,0 +1,77 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import update
+
+from website import db, fragments
+from website.cache import event_changed
+from website.models import Event, TicketType
+
+
+@pytest.fixture
+def site(make_app, make_event, make_user):
+    app = make_app(WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        event_id, ticket_id, host_id = make_event(capacity=2, title="Fragment night", description="Original blurb")
+        make_user("bob")
+        host = db.session.get(Event, event_id).host.name
+    return app, event_id, ticket_id, host
+
+
+def _pages(app, event_id):
+    client = app.test_client()
+    return [client.get(url).get_data(as_text=True) for url in ("/home", f"/event/{event_id}")]
+
+
+def _badge(status):
+    return f'<span class="badge rounded-pill badge-{status.lower().replace(" ", "")}">{status}</span>'
+
+
+def _cached_keys(app, event_id):
+    with app.app_context():
+        return fragments.backend()._tags.get(fragments._tag(event_id), set())
+
+
+def test_pages_are_built_from_cached_fragments(site):
+    app, event_id, _, _ = site
+    _pages(app, event_id)
+    names = {key.split(":")[0] for key in _cached_keys(app, event_id)}
+    assert names == {"event-card", "event-panel", "event-about"}
+
+
+def test_changes_the_keys_miss_wait_for_event_changed(site):
+    app, event_id, ticket_id, _ = site
+    _pages(app, event_id)
+    with app.app_context():
+        # neither row's updated_at moves, so every fragment key stays the same
+        db.session.execute(update(Event).values(description="Rewritten blurb", updated_at=Event.updated_at))
+        db.session.execute(update(TicketType).values(price=Decimal("25.00"), updated_at=TicketType.updated_at))
+        db.session.commit()
+    home, event = _pages(app, event_id)
+    assert "Original blurb" in home and "Original blurb" in event
+
+    with app.app_context():
+        event_changed.send(event_id)
+    assert not _cached_keys(app, event_id)
+    home, event = _pages(app, event_id)
+    assert "Rewritten blurb" in home and "$25.00" in home
+    assert "Rewritten blurb" in event and "$25.00" in event
+    assert "Original blurb" not in home + event
+
+
+def test_booking_refreshes_sold_out_panels(site, login):
+    app, event_id, _, _ = site
+    assert all(_badge("Open") in page for page in _pages(app, event_id))
+
+    bob = login(app, "bob")
+    assert bob.post(f"/event/{event_id}/book", data={"qty": "2"}).status_code == 302
+    for page in _pages(app, event_id):
+        assert _badge("Sold Out") in page and _badge("Open") not in page
+
+
+def test_host_actions_refresh_fragments(site, login):
+    app, event_id, _, host = site
+    assert all(_badge("Open") in page for page in _pages(app, event_id))
+    assert login(app, host).post(f"/event/{event_id}/action", data={"action": "cancel"}).status_code == 302
+    for page in _pages(app, event_id):
+        assert _badge("Cancelled") in page and _badge("Open") not in page
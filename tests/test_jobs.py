@@ -0,0 +1,123 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Thread
+
+from sqlalchemy import event, select
+
+from website import db
+from website.jobs import _now, claim_next, enqueue, handler, run_job
+from website.models import Job, JobStatusEnum
+
+calls = []
+
+
+@handler("test.flaky")
+def _flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise ValueError(f"failure {len(calls)}")
+
+
+def _queue(app, count=1, **payload):
+    with app.app_context():
+        jobs = [enqueue("test.flaky", **payload) for _ in range(count)]
+        db.session.commit()
+        return [job.id for job in jobs]
+
+
+def test_failed_job_retries_with_backoff_then_fails(make_app):
+    # no background runner: the test claims and runs each attempt itself
+    app = make_app(JOBS_WORKERS=0, JOBS_MAX_ATTEMPTS=3, JOBS_BACKOFF=10.0)
+    calls.clear()
+    [job_id] = _queue(app, fail_times=99)
+    with app.app_context():
+        for attempt, base in [(1, 10), (2, 20)]:
+            assert claim_next(ignore_schedule=True) == job_id
+            before = _now()
+            assert run_job(job_id) == JobStatusEnum.QUEUED
+            job = db.session.get(Job, job_id)
+            assert job.attempts == attempt
+            assert job.last_error == f"ValueError: failure {attempt}"
+            assert job.locked_at is None
+            # exponential, with +-20% jitter
+            assert before + timedelta(seconds=base * 0.8) <= job.run_after <= _now() + timedelta(seconds=base * 1.2)
+            assert claim_next() is None  # still backing off
+            db.session.remove()
+
+        assert claim_next(ignore_schedule=True) == job_id
+        assert run_job(job_id) == JobStatusEnum.FAILED
+        job = db.session.get(Job, job_id)
+        assert job.attempts == job.max_attempts == 3
+        assert job.finished_at is not None
+        assert job.last_error == "ValueError: failure 3"
+        assert claim_next(ignore_schedule=True) is None  # failed jobs stay failed
+    assert len(calls) == 3
+
+
+def test_job_succeeds_on_retry(make_app):
+    app = make_app(JOBS_WORKERS=0, JOBS_BACKOFF=10.0)
+    calls.clear()
+    [job_id] = _queue(app, fail_times=1)
+    with app.app_context():
+        assert claim_next() == job_id
+        assert run_job(job_id) == JobStatusEnum.QUEUED
+        assert claim_next(ignore_schedule=True) == job_id
+        assert run_job(job_id) == JobStatusEnum.DONE
+        job = db.session.get(Job, job_id)
+        assert job.attempts == 2
+        assert job.last_error is None and job.finished_at is not None
+
+
+def test_claim_lost_to_another_runner_moves_on(make_app):
+    # two apps on one database stand in for two processes; the second claims
+    # the job the first has just selected, before the first's UPDATE runs
+    first = make_app(JOBS_WORKERS=0)
+    second = make_app(JOBS_WORKERS=0)
+    job_ids = _queue(first, count=2, fail_times=0)
+    stolen = []
+
+    with first.app_context():
+        engine = db.engine
+
+    def steal(conn, cursor, statement, *args):
+        if not stolen and statement.lstrip().upper().startswith("UPDATE JOBS"):
+            def claim():
+                with second.app_context():
+                    stolen.append(claim_next())
+                    db.session.remove()
+            thread = Thread(target=claim)
+            thread.start()
+            thread.join()
+
+    event.listen(engine, "before_cursor_execute", steal)
+    try:
+        with first.app_context():
+            assert claim_next() == job_ids[1]
+    finally:
+        event.remove(engine, "before_cursor_execute", steal)
+    assert stolen == [job_ids[0]]
+    with first.app_context():
+        jobs = db.session.execute(select(Job).order_by(Job.id)).scalars().all()
+        assert [(j.status, j.attempts) for j in jobs] == [(JobStatusEnum.RUNNING, 1)] * 2
+
+
+def test_concurrent_runners_never_claim_the_same_job(make_app):
+    apps = [make_app(JOBS_WORKERS=0, DB_POOL_SIZE=4, DB_MAX_OVERFLOW=0) for _ in range(2)]
+    job_ids = _queue(apps[0], count=200, fail_times=0)
+
+    def claim_all(app):
+        claimed = []
+        with app.app_context():
+            while (job_id := claim_next()) is not None:
+                claimed.append(job_id)
+            db.session.remove()
+        return claimed
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(claim_all, apps * 4))
+
+    claimed = [job_id for result in results for job_id in result]
+    assert sorted(claimed) == job_ids  # every job exactly once
+    with apps[0].app_context():
+        attempts = db.session.execute(select(Job.attempts)).scalars().all()
+        assert set(attempts) == {1}
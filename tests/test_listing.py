@@ -0,0 +1,147 @@
+import base64
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from website import db, listing
+from website.models import Event, TicketType, User
+
+HOME_SORTS = ["dateSoonest", "priceLowHigh", "priceHighLow", "popularity", "relevance"]
+HOST_SORTS = ["upcoming", "created", "title"]
+START = datetime(2030, 3, 1, 18)
+
+
+@pytest.fixture
+def events(app):
+    """31 events with plenty of ties: three start times (and undated ones), three prices, two sold counts, two titles."""
+    with app.app_context():
+        host = User(name="host", email="host@example.com", password_hash="x")
+        db.session.add(host)
+        db.session.flush()
+        for i in range(31):
+            event = Event(host_user_id=host.id, title=("Python night" if i % 2 else "python Night"),
+                          description="python meetup", capacity=100, sold_qty=5 * (i % 2),
+                          start_at=None if i % 7 == 0 else START + timedelta(days=i % 3))
+            db.session.add(event)
+            db.session.flush()
+            if i % 5:
+                db.session.add(TicketType(event_id=event.id, name="GA", price=Decimal(10 * (i % 3)),
+                                          is_free=(i % 3 == 0), currency="AUD", capacity=100))
+        db.session.commit()
+        return host.id
+
+
+def _home(sort, q_text=""):
+    qry, price_expr, sold_col, _, rank_col = listing.build_listing(q_text=q_text, with_price=listing.needs_price(sort))
+    return qry, listing.sort_keys(sort, price_expr, sold_col, rank_col)
+
+
+def _host(sort, host_id):
+    qry = db.session.query(Event, Event.sold_qty).filter(Event.host_user_id == host_id)
+    return qry, listing.host_sort_keys(sort)
+
+
+def _ids(rows):
+    return [row[0].id for row in rows]
+
+
+def _walk(qry, keys, scope, token=None, direction="next", per_page=4):
+    """Follow the next (or prev) links from token; returns the pages' ids in the order visited."""
+    pages = []
+    while True:
+        rows, prev_token, next_token = listing.keyset_page(qry, keys, per_page, listing.decode_cursor(token, scope), scope)
+        pages.append(_ids(rows))
+        token = next_token if direction == "next" else prev_token
+        if token is None:
+            return pages, prev_token if direction == "next" else next_token
+
+
+def _check_walks(qry, keys, scope):
+    expected = _ids(listing.apply_order(qry, keys).all())
+    assert len(expected) == len(set(expected)) == qry.count()
+
+    forward, last_prev = _walk(qry, keys, scope)
+    assert [i for page in forward for i in page] == expected
+    assert all(len(page) == 4 for page in forward[:-1])
+
+    # back from the last page to the first
+    backward, first_next = _walk(qry, keys, scope, last_prev, "prev")
+    assert [i for page in reversed(backward) for i in page] + forward[-1] == expected
+    assert all(len(page) == 4 for page in backward)
+    assert first_next is not None
+
+
+@pytest.mark.parametrize("sort", HOME_SORTS)
+def test_home_sorts_page_forward_and_back(app, events, sort):
+    with app.app_context():
+        q_text = "python" if sort == "relevance" else ""
+        qry, keys = _home(sort, q_text)
+        _check_walks(qry, keys, f"main.index:{sort}")
+
+
+@pytest.mark.parametrize("sort", HOST_SORTS)
+def test_host_sorts_page_forward_and_back(app, events, sort):
+    with app.app_context():
+        qry, keys = _host(sort, events)
+        _check_walks(qry, keys, f"mine:{sort}")
+
+
+def test_rows_inserted_between_pages_are_neither_skipped_nor_repeated(app, events):
+    with app.app_context():
+        qry, keys = _home("dateSoonest")
+        before = _ids(listing.apply_order(qry, keys).all())
+        rows, _, token = listing.keyset_page(qry, keys, 10, None, "main.index:dateSoonest")
+        seen = _ids(rows)
+
+        # one event sorting before the page already shown, one inside the rest, one after everything dated
+        new_ids = []
+        for start in (START - timedelta(days=1), START + timedelta(days=1), START + timedelta(days=30)):
+            event = Event(host_user_id=events, title="Late addition", capacity=10, start_at=start)
+            db.session.add(event)
+            db.session.flush()
+            new_ids.append(event.id)
+        db.session.commit()
+
+        while token:
+            rows, _, token = listing.keyset_page(qry, keys, 10, listing.decode_cursor(token, "main.index:dateSoonest"),
+                                                 "main.index:dateSoonest")
+            seen += _ids(rows)
+
+        assert len(seen) == len(set(seen))
+        assert set(before) <= set(seen)
+        assert new_ids[0] not in seen  # it sorts before the cursor
+        assert set(new_ids[1:]) <= set(seen)
+        assert seen == [i for i in _ids(listing.apply_order(qry, keys).all()) if i != new_ids[0]]
+
+
+def test_cursors_are_bound_to_their_scope_and_signed(app, events):
+    with app.app_context():
+        qry, keys = _home("dateSoonest")
+        _, _, token = listing.keyset_page(qry, keys, 4, None, "main.index:dateSoonest")
+        assert listing.decode_cursor(token, "main.index:dateSoonest")[0] == "next"
+
+        assert listing.decode_cursor(token, "main.index:priceLowHigh") is None
+        assert listing.decode_cursor(token, "main.search:dateSoonest") is None
+
+        body, sig = token.split(".")
+        payload = json.loads(base64.urlsafe_b64decode(body + "=" * (-len(body) % 4)))
+        payload["k"][-1] = 10 ** 6
+        forged = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+        assert listing.decode_cursor(f"{forged}.{sig}", "main.index:dateSoonest") is None
+        assert listing.decode_cursor(forged, "main.index:dateSoonest") is None
+        assert listing.decode_cursor(body + "." + sig[::-1], "main.index:dateSoonest") is None
+        for junk in ("", "not a cursor", "....", "%%%"):
+            assert listing.decode_cursor(junk, "main.index:dateSoonest") is None
+
+    app.secret_key = "another key"
+    with app.app_context():
+        assert listing.decode_cursor(token, "main.index:dateSoonest") is None
+
+
+def test_a_rejected_cursor_starts_from_the_first_page(app, events):
+    client = app.test_client()
+    first = client.get("/home?cursor=")
+    assert first.status_code == 200
+    assert client.get("/home?cursor=garbage").data == first.data
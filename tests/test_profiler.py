@@ -0,0 +1,45 @@
+import os
+import time
+
+import pytest
+
+from website.profiler import HEADER
+
+
+def _slow():
+    time.sleep(0.05)
+    return "done"
+
+
+@pytest.fixture
+def profiled(make_app, tmp_path):
+    def make(**config):
+        app = make_app(**{"PROFILER_ENABLED": True, "PROFILER_SAMPLE_RATE": 0, "PROFILER_INTERVAL_MS": 1,
+                          "PROFILER_DIR": str(tmp_path / "profiles"), **config})
+        app.add_url_rule("/slow", "slow", _slow)
+        return app
+    return make
+
+
+def test_profiles_are_not_served_without_a_secret(profiled, tmp_path):
+    client = profiled(PROFILER_SAMPLE_RATE=1.0, PROFILER_THRESHOLD_MS=0).test_client()
+    client.get("/slow")
+    # still sampled and saved, only not listed
+    assert any(name.endswith(".json") for name in os.listdir(tmp_path / "profiles"))
+    assert client.get("/_profiles").status_code == 404
+    assert client.get("/_profiles", headers={HEADER: ""}).status_code == 404
+
+
+def test_profiles_need_the_secret(profiled):
+    client = profiled(PROFILER_SECRET="s3cret").test_client()
+    assert client.get("/_profiles").status_code == 404
+    assert client.get("/_profiles?key=wrong").status_code == 404
+
+    # a wrong header doesn't force a profile either
+    assert HEADER not in client.get("/slow", headers={HEADER: "wrong"}).headers
+    name = client.get("/slow", headers={HEADER: "s3cret"}).headers[HEADER]
+
+    assert name in client.get("/_profiles?key=s3cret").get_data(as_text=True)
+    assert client.get(f"/_profiles/{name}.folded").status_code == 404
+    folded = client.get(f"/_profiles/{name}.folded", headers={HEADER: "s3cret"})
+    assert folded.status_code == 200 and b"_slow" in folded.data
@@ -0,0 +1,136 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from flask import g
+from sqlalchemy import event, select, update
+
+from website import db, replicas
+from website.models import Event, Tag
+
+
+@pytest.fixture
+def replicated(make_app, make_event, make_user, database_url, tmp_path):
+    """An app on two SQLite files; the replica holds the event as "Replica title", the primary as "Primary title"."""
+    if not database_url.startswith("sqlite"):
+        pytest.skip("two SQLite files stand in for a primary and its replica")
+    # no job runner: its dispatcher would show up on the primary between requests
+    app = make_app(DB_REPLICA_URL=f"sqlite:///{tmp_path / 'replica.sqlite'}", DB_READ_YOUR_WRITES=30,
+                   JOBS_WORKERS=0, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        event_id, _, _ = make_event(title="Replica title")
+        make_user("buyer")
+    result = app.test_cli_runner().invoke(args=["replica", "sync"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        db.session.execute(update(Event).where(Event.id == event_id).values(title="Primary title"))
+        db.session.commit()
+    return app, event_id
+
+
+@pytest.fixture
+def used(replicated):
+    """used(): the binds ("primary" / "replica") statements have run on since the last call."""
+    app, _ = replicated
+    log = []
+    with app.app_context():
+        engines = {"primary": db.engines[None], "replica": db.engines[replicas.REPLICA]}
+    listeners = {name: (lambda *args, name=name: log.append(name)) for name in engines}
+    for name, engine in engines.items():
+        event.listen(engine, "before_cursor_execute", listeners[name])
+
+    def drain():
+        names = set(log)
+        log.clear()
+        return names
+
+    yield drain
+    for name, engine in engines.items():
+        event.remove(engine, "before_cursor_execute", listeners[name])
+
+
+def _title(event_id):
+    return db.session.execute(select(Event.title).where(Event.id == event_id)).scalar()
+
+
+def test_replica_reads_views_read_from_the_replica(replicated, used):
+    app, event_id = replicated
+    client = app.test_client()
+    used()
+    body = client.get(f"/event/{event_id}").get_data(as_text=True)
+    assert "Replica title" in body and "Primary title" not in body
+    assert used() == {"replica"}
+    client.get("/home")
+    assert used() == {"replica"}
+
+
+def test_other_requests_use_the_primary(replicated, used):
+    app, event_id = replicated
+    used()
+    with app.test_request_context(f"/event/{event_id}"):
+        # no @replica_reads
+        assert _title(event_id) == "Primary title"
+        db.session.remove()
+    assert used() == {"primary"}
+    with app.app_context():
+        # outside a request (CLI, jobs)
+        assert _title(event_id) == "Primary title"
+        db.session.remove()
+    assert used() == {"primary"}
+
+
+def test_writes_and_later_reads_stay_on_the_primary(replicated, used):
+    app, event_id = replicated
+    used()
+    with app.test_request_context(f"/event/{event_id}"):
+        g._db_replica = True
+        assert _title(event_id) == "Replica title"
+        assert used() == {"replica"}
+        db.session.execute(update(Event).where(Event.id == event_id).values(capacity=20))
+        assert used() == {"primary"}
+        # the rest of the request sees its own (uncommitted) write
+        assert db.session.execute(select(Event.capacity).where(Event.id == event_id)).scalar() == 20
+        assert used() == {"primary"}
+        db.session.rollback()
+        db.session.remove()
+
+    with app.test_request_context(f"/event/{event_id}"):
+        g._db_replica = True
+        db.session.add(Tag(name="Flushed", slug="flushed"))
+        db.session.flush()
+        assert used() == {"primary"}
+        assert _title(event_id) == "Primary title"
+        assert used() == {"primary"}
+        db.session.rollback()
+        db.session.remove()
+
+    with app.test_request_context(f"/event/{event_id}"):
+        g._db_replica = True
+        replicas.force_primary()
+        assert _title(event_id) == "Primary title"
+        assert used() == {"primary"}
+        db.session.remove()
+
+
+def test_read_your_writes_window(replicated, used, login, monkeypatch):
+    app, event_id = replicated
+    buyer = login(app, "buyer")
+    assert buyer.post(f"/event/{event_id}/book", data={"qty": "1"}).status_code == 302
+    used()
+
+    # the buyer reads from the primary for DB_READ_YOUR_WRITES seconds; others don't
+    buyer.get(f"/event/{event_id}")
+    assert used() == {"primary"}
+    app.test_client().get(f"/event/{event_id}")
+    assert used() == {"replica"}
+
+    later = time.time() + 31
+    monkeypatch.setattr(replicas, "time", SimpleNamespace(time=lambda: later))
+    buyer.get(f"/event/{event_id}")
+    assert used() == {"replica"}
+
+
+def test_sync_needs_a_replica(make_app):
+    result = make_app().test_cli_runner().invoke(args=["replica", "sync"])
+    assert result.exit_code != 0
+    assert "DB_REPLICA_URL is not set" in result.output
@@ -0,0 +1,163 @@
+import pytest
+from sqlalchemy import create_engine, select, text
+
+from website import db, listing, search
+from website.models import Event, Event_Tag, Tag
+
+
+@pytest.fixture
+def fts_app(make_app, database_url):
+    if not database_url.startswith("sqlite"):
+        pytest.skip("the FTS5 index is SQLite only")
+    app = make_app()
+    with app.app_context():
+        if not search.enabled():
+            pytest.skip("this SQLite build has no FTS5")
+    return app
+
+
+def _hits(q_text):
+    """Event ids matching q_text, best first."""
+    hits = search.matches(q_text)
+    return db.session.execute(select(hits.c.event_id).order_by(hits.c.rank, hits.c.event_id)).scalars().all()
+
+
+def _indexed(event_id):
+    return db.session.execute(
+        text("SELECT title, description, location, tags FROM events_fts WHERE rowid = :id"), {"id": event_id}
+    ).first()
+
+
+def _triggers(conn):
+    return set(conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'trigger'").scalars())
+
+
+def test_triggers_follow_event_and_tag_writes(fts_app, make_event):
+    with fts_app.app_context():
+        event_id, _, _ = make_event(title="Python meetup", description="Talks and pizza", location_text="Hobart")
+        assert tuple(_indexed(event_id)) == ("Python meetup", "Talks and pizza", "Hobart", None)
+        assert _hits("python") == _hits("hobart") == [event_id]
+
+        event = db.session.get(Event, event_id)
+        event.title = "Rust meetup"
+        event.location_text = "Launceston"
+        db.session.commit()
+        assert _hits("python") == _hits("hobart") == []
+        assert _hits("rust") == _hits("launceston") == [event_id]
+
+        tag = Tag(name="Tech", slug="tech")
+        db.session.add(tag)
+        db.session.flush()
+        db.session.add(Event_Tag(event_id=event_id, tag_id=tag.id))
+        db.session.commit()
+        assert _indexed(event_id).tags == "Tech"
+        assert _hits("tech") == [event_id]
+
+        tag.name = "Programming"
+        db.session.commit()
+        assert _hits("tech") == []
+        assert _hits("programming") == [event_id]
+
+        db.session.execute(Event_Tag.__table__.delete().where(Event_Tag.event_id == event_id))
+        db.session.commit()
+        assert _indexed(event_id).tags is None
+
+        db.session.delete(db.session.get(Event, event_id))
+        db.session.commit()
+        assert _indexed(event_id) is None
+        assert _hits("rust") == []
+
+
+def test_bm25_ranks_by_column_weight(fts_app, make_event):
+    with fts_app.app_context():
+        in_description, _, _ = make_event(title="Evening session", description="Jazz", location_text="Town hall")
+        in_title, _, _ = make_event(title="Jazz session", description="Evening", location_text="Town hall")
+        in_location, _, _ = make_event(title="Evening session", description="Music", location_text="Jazz hall")
+        # title outweighs location, which outweighs description (RANK_WEIGHTS)
+        assert _hits("jazz") == [in_title, in_location, in_description]
+
+        qry, _, _, _, rank_col = listing.build_listing(q_text="jazz", with_price=False)
+        assert rank_col is not None
+        assert [event.id for event, *_ in qry.order_by(rank_col)] == [in_title, in_location, in_description]
+
+
+def test_prefix_queries(fts_app, make_event):
+    with fts_app.app_context():
+        python, _, _ = make_event(title="Python meetup", description="", location_text="Hobart")
+        pycon, _, _ = make_event(title="PyCon", description="Python conference", location_text="Sydney")
+        assert set(_hits("py")) == {python, pycon}
+        assert set(_hits("pyth")) == {python, pycon}
+        assert _hits("pyth meet") == [python]  # every word must match
+        assert _hits("ython") == []  # prefixes only, not substrings
+        assert _hits("Sydn") == [pycon]
+
+    assert search.match_query("C++ & Rust!") == '"c"* "rust"*'
+    assert search.match_query(" !? ") is None
+    assert search.matches("--") is None
+
+
+def test_ilike_fallback_without_fts5(make_app, make_event, monkeypatch, database_url):
+    # the migration finds no FTS5 and leaves the index out; PostgreSQL never has it
+    monkeypatch.setattr(search, "_fts5_supported", lambda conn: False)
+    app = make_app()
+    with app.app_context():
+        assert not search.enabled()
+        if database_url.startswith("sqlite"):
+            assert _triggers(db.session.connection()) == set()
+        python, _, _ = make_event(title="Python meetup", description="")
+        in_description, _, _ = make_event(title="Evening", description="Learn python basics")
+        make_event(title="Rust meetup", description="")
+
+        qry, _, _, _, rank_col = listing.build_listing(q_text="ython", with_price=False)
+        assert rank_col is None
+        # a substring match anywhere in the title or description, ignoring case
+        assert sorted(event.id for event, *_ in qry) == [python, in_description]
+
+
+def test_bulk_insert_swaps_insert_triggers(fts_app, make_event):
+    with fts_app.app_context():
+        all_triggers = _triggers(db.session.connection())
+        assert set(search._INSERT_TRIGGERS) < all_triggers
+        existing, _, host_id = make_event(title="Existing event")
+
+        def insert(title):
+            row = {"host_user_id": host_id, "title": title, "capacity": 10}
+            return db.session.execute(Event.__table__.insert().values(**row)).inserted_primary_key[0]
+
+        with search.bulk_insert(db.session.connection()) as indexed:
+            assert _triggers(db.session.connection()) == all_triggers - set(search._INSERT_TRIGGERS)
+            ids = [insert(f"Batch event {n}") for n in range(3)]
+            skipped = insert("Unlisted batch event")
+            # no trigger indexed these; the block does it for the listed ids on the way out
+            assert [_indexed(event_id) for event_id in ids + [skipped]] == [None] * 4
+            indexed += ids
+        assert _triggers(db.session.connection()) == all_triggers
+        db.session.commit()
+        assert sorted(_hits("batch")) == ids
+        assert _hits("existing") == [existing]
+        assert _hits("unlisted") == []
+
+        # a rollback restores the dropped triggers (SQLite DDL is transactional)
+        with pytest.raises(RuntimeError):
+            with search.bulk_insert(db.session.connection()) as indexed:
+                indexed.append(insert("Rolled back event"))
+                raise RuntimeError
+        db.session.rollback()
+        assert _triggers(db.session.connection()) == all_triggers
+        assert _hits("rolled") == []
+        later, _, _ = make_event(title="Later event")
+        assert _hits("later") == [later]
+
+
+def test_other_connections_keep_the_triggers_during_bulk_insert(fts_app):
+    with fts_app.app_context():
+        all_triggers = _triggers(db.session.connection())
+        db.session.commit()
+        other = create_engine(fts_app.config["SQLALCHEMY_DATABASE_URI"])
+        try:
+            with search.bulk_insert(db.session.connection()):
+                with other.connect() as conn:
+                    assert _triggers(conn) == all_triggers
+            db.session.rollback()
+        finally:
+            other.dispose()
@@ -0,0 +1,147 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+from sqlalchemy import update
+from werkzeug.datastructures import FileStorage
+
+from website import db, uploads
+from website.models import Blob
+from website.storage import IMMUTABLE, LocalStorage, S3Storage
+
+
+def test_local_put_moves_spooled_files_and_copies_others(tmp_path):
+    store = LocalStorage(tmp_path / "media")
+    spooled = os.path.join(store.spool_dir(), "upload.tmp")
+    with open(spooled, "wb") as fh:
+        fh.write(b"spooled")
+    os.chmod(spooled, 0o600)
+    store.put("ab/spooled.jpg", spooled)
+    assert not os.path.exists(spooled)
+    assert os.stat(os.path.join(store.root, "ab", "spooled.jpg")).st_mode & 0o777 == 0o644
+
+    elsewhere = tmp_path / "photo.jpg"
+    elsewhere.write_bytes(b"kept")
+    store.put("cd/kept.jpg", str(elsewhere))
+    assert elsewhere.read_bytes() == b"kept"
+
+    assert sorted(store.keys()) == ["ab/spooled.jpg", "cd/kept.jpg"]
+    with store.local_file("ab/spooled.jpg") as path:
+        assert open(path, "rb").read() == b"spooled"
+    store.delete("ab/spooled.jpg")
+    assert not store.exists("ab/spooled.jpg") and store.exists("cd/kept.jpg")
+
+
+def test_saved_uploads_are_stored_once(app):
+    data = b"\xff\xd8 not really a jpeg"
+    key = f"{hashlib.sha256(data).hexdigest()[:2]}/{hashlib.sha256(data).hexdigest()}.jpg"
+    with app.app_context():
+        urls = [uploads.save(FileStorage(io.BytesIO(data), filename="a.JPEG")) for _ in range(2)]
+        db.session.commit()
+        assert urls == [uploads.MEDIA_PREFIX + key] * 2
+        store = uploads.backend()
+        assert list(store.keys()) == [key]
+        assert os.listdir(store.spool_dir()) == []
+        with store.local_file(key) as path:
+            assert open(path, "rb").read() == data
+        assert db.session.get(Blob, key).size == len(data)
+
+
+# S3, against moto's in-process fake of the API
+
+@pytest.fixture
+def s3(monkeypatch):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    for name, value in {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test",
+                        "AWS_DEFAULT_REGION": "us-east-1"}.items():
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="media")
+        yield client
+
+
+def test_s3_storage(s3, tmp_path):
+    store = S3Storage("media", prefix="uploads/", client=s3)
+    src = tmp_path / "photo.jpg"
+    src.write_bytes(b"photo")
+    assert not store.exists("ab/photo.jpg")
+    store.put("ab/photo.jpg", str(src), "image/jpeg")
+    store.put("cd/other.jpg", str(src))
+    assert src.exists()  # S3 uploads never consume the source
+
+    head = s3.head_object(Bucket="media", Key="uploads/ab/photo.jpg")
+    assert head["ContentType"] == "image/jpeg" and head["CacheControl"] == IMMUTABLE
+    assert store.exists("ab/photo.jpg")
+    assert sorted(store.keys()) == ["ab/photo.jpg", "cd/other.jpg"]
+    with store.local_file("ab/photo.jpg") as path:
+        assert open(path, "rb").read() == b"photo"
+    assert not os.path.exists(path)
+
+    store.delete("ab/photo.jpg")
+    store.delete("ab/photo.jpg")  # already gone: not an error
+    assert not store.exists("ab/photo.jpg")
+    assert list(store.keys()) == ["cd/other.jpg"]
+
+
+def test_s3_uploads_are_served_and_collected(s3, make_app):
+    app = make_app(STORAGE_BACKEND="s3", S3_BUCKET="media", S3_PREFIX="site")
+    with app.app_context():
+        kept = uploads.save(FileStorage(io.BytesIO(b"kept"), filename="kept.png"))
+        dropped = uploads.save(FileStorage(io.BytesIO(b"dropped"), filename="dropped.png"))
+        uploads.retain(kept)
+        db.session.commit()
+        assert sorted(uploads.backend().keys()) == sorted(uploads.key_for(u) for u in (kept, dropped))
+
+        response = app.test_client().get(kept)
+        assert response.status_code == 302 and "/site/" in response.location
+        assert app.test_client().get(uploads.MEDIA_PREFIX + "ab/missing.png").status_code == 404
+
+        assert uploads.gc(grace=0) == 1
+        assert list(uploads.backend().keys()) == [uploads.key_for(kept)]
+        assert db.session.get(Blob, uploads.key_for(dropped)) is None
+
+
+def test_reupload_during_gc_keeps_its_file(app):
+    data = b"uploaded, dropped, uploaded again"
+    with app.app_context():
+        url = uploads.save(FileStorage(io.BytesIO(data), filename="a.png"))
+        key = uploads.key_for(url)
+        db.session.execute(update(Blob).values(released_at=datetime(2000, 1, 1)))
+        db.session.commit()
+        store = uploads.backend()
+
+    # gc() has deleted the row but not yet the file when the same bytes arrive
+    deleting = threading.Event()
+    real_delete = store.delete
+
+    def slow_delete(k):
+        deleting.set()
+        time.sleep(0.5)
+        real_delete(k)
+
+    def collect():
+        with app.app_context():
+            try:
+                return uploads.gc(grace=0)
+            finally:
+                db.session.remove()
+
+    store.delete = slow_delete
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        collected = pool.submit(collect)
+        assert deleting.wait(5)
+        with app.app_context():
+            assert uploads.save(FileStorage(io.BytesIO(data), filename="a.png")) == url
+            db.session.commit()
+        assert collected.result() == 1
+
+    with app.app_context():
+        assert db.session.get(Blob, key) is not None
+        assert store.exists(key)
@@ -0,0 +1,183 @@
+from flask import Blueprint, current_app, request, send_file, url_for, abort
+from flask.cli import AppGroup
+import click, gzip, hashlib, json, mimetypes, os, re
+from .storage import IMMUTABLE
+
+try:
+    import brotli
+except ImportError:  # optional: without it only .gz copies are written
+    brotli = None
+
+# Fingerprinted static assets. `flask assets build` copies every file under
+# static/ (except uploads) to ASSETS_ROOT as name.<hash>.ext, writes .gz / .br
+# copies of the text files next to them and a manifest.json mapping
+# "style/main.css" -> "style/main.1a2b3c4d5e6f.css". Templates link through
+# asset_url(), so a changed file gets a new url and everything can be cached
+# for a year without revalidation.
+
+assets_bp = Blueprint("assets", __name__)
+
+MANIFEST = "manifest.json"
+SKIP_DIRS = {"uploads"}
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".map", ".html"}
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+
+
+def _fingerprinted(rel, digest):
+    stem, ext = os.path.splitext(rel)
+    return f"{stem}.{digest[:12]}{ext}"
+
+
+def _sources(static_folder):
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if dirpath == static_folder:
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if not name.startswith("."):
+                path = os.path.join(dirpath, name)
+                yield os.path.relpath(path, static_folder).replace(os.sep, "/"), path
+
+
+def _rewrite_css(css, rel, manifest):
+    # point url(...) references at the fingerprinted copies, keeping them relative
+    base = os.path.dirname(rel)
+
+    def replace(match):
+        quote, target = match.groups()
+        if target.startswith(("data:", "http:", "https:", "//", "/", "#")):
+            return match.group(0)
+        # the fingerprint replaces any ?v= cache-buster; #fragments (svg fonts) are kept
+        path, _, fragment = target.partition("#")
+        path = path.partition("?")[0]
+        resolved = os.path.normpath(os.path.join(base, path)).replace(os.sep, "/")
+        if resolved not in manifest:
+            return match.group(0)
+        new = os.path.relpath(manifest[resolved], base or ".").replace(os.sep, "/")
+        return f"url({quote}{new}{'#' + fragment if fragment else ''}{quote})"
+
+    return _CSS_URL.sub(replace, css)
+
+
+def _write(dest, data):
+    # atomic, so a worker building concurrently never serves half a file
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, dest)
+
+
+def build(static_folder, out_dir, clean=False):
+    """Fingerprint and precompress everything under static_folder into out_dir; returns the manifest."""
+    sources = sorted(_sources(static_folder), key=lambda s: s[0].endswith(".css"))
+    manifest = {}
+    for rel, path in sources:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        # css is hashed after rewriting, so it changes when a file it references does
+        if rel.endswith(".css"):
+            data = _rewrite_css(data.decode("utf-8"), rel, manifest).encode("utf-8")
+        target = _fingerprinted(rel, hashlib.sha256(data).hexdigest())
+        manifest[rel] = target
+        dest = os.path.join(out_dir, target)
+        if os.path.exists(dest):
+            continue
+        _write(dest, data)
+        if os.path.splitext(rel)[1].lower() in COMPRESSIBLE:
+            _write(dest + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write(dest + ".br", brotli.compress(data, quality=11))
+    _write(os.path.join(out_dir, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+    if clean:
+        # old fingerprints are kept by default: pages cached before a deploy still link to them
+        keep = set(manifest.values())
+        for rel, path in _sources(out_dir):
+            original = rel[:-3] if rel.endswith((".gz", ".br")) else rel
+            if rel != MANIFEST and original not in keep:
+                os.remove(path)
+    return manifest
+
+
+def _stale(static_folder, out_dir):
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return True
+    built = os.path.getmtime(manifest_path)
+    with open(manifest_path, encoding="utf-8") as fh:
+        known = set(json.load(fh))
+    seen = set()
+    for rel, path in _sources(static_folder):
+        if rel not in known or os.path.getmtime(path) > built:
+            return True
+        seen.add(rel)
+    return seen != known
+
+
+def _load(app):
+    path = os.path.join(app.config["ASSETS_ROOT"], MANIFEST)
+    try:
+        with open(path, encoding="utf-8") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(filename, **values):
+    """
+    Drop-in for url_for("static", filename=...): the fingerprinted, cache-forever
+    url when the file has been built, the plain static url otherwise.
+    """
+    fingerprinted = current_app.extensions["assets"].get(filename)
+    if fingerprinted is None:
+        return url_for("static", filename=filename, **values)
+    return url_for("assets.asset", filename=fingerprinted, **values)
+
+
+@assets_bp.route("/assets/<path:filename>")
+def asset(filename):
+    if filename not in current_app.extensions["assets_files"]:
+        abort(404)
+    path = os.path.join(current_app.config["ASSETS_ROOT"], filename)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if request.accept_encodings[name] and os.path.exists(path + suffix):
+            path, encoding = path + suffix, name
+            break
+    response = send_file(path, mimetype=mimetype, max_age=31536000, conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if os.path.splitext(filename)[1].lower() in COMPRESSIBLE:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+# CLI: flask assets ...
+
+assets_cli = AppGroup("assets", help="Build fingerprinted static assets.")
+
+
+@assets_cli.command("build")
+@click.option("--clean", is_flag=True, help="Delete fingerprinted files that are no longer in the manifest.")
+def build_command(clean):
+    """Fingerprint and precompress static/ into ASSETS_ROOT."""
+    manifest = build(current_app.static_folder, current_app.config["ASSETS_ROOT"], clean)
+    if brotli is None:
+        click.echo("brotli is not installed: only gzip copies were written (pip install brotli).")
+    click.echo(f"Built {len(manifest)} asset(s) into {current_app.config['ASSETS_ROOT']}.")
+
+
+def init_app(app):
+    if not app.config.get("ASSETS_ROOT"):
+        app.config["ASSETS_ROOT"] = os.path.join(app.instance_path, "assets")
+    # building on startup keeps dev servers current; deploys run `flask assets build` instead
+    if app.config.get("ASSETS_AUTO_BUILD", True) and _stale(app.static_folder, app.config["ASSETS_ROOT"]):
+        build(app.static_folder, app.config["ASSETS_ROOT"])
+    manifest = _load(app)
+    app.extensions["assets"] = manifest
+    app.extensions["assets_files"] = set(manifest.values())
+    app.add_template_global(asset_url)
+    app.cli.add_command(assets_cli)
@@ -4,11 +4,10 @@ from flask_login import login_user, login_required, logout_user, current_user
 from .models import User
 from werkzeug.utils import secure_filename
 from .forms import LoginForm, RegisterForm, ProfileForm, LogoutForm
-import os
-from uuid import uuid4
-from . import db
+from . import db, images, uploads, metrics
 
 auth_bp = Blueprint('auth', __name__)
+metrics.instrument(auth_bp)
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -54,18 +53,18 @@ def register():
         pic_rel_path = None
         file = form.profile_pic.data
         if file:
-            uploads_dir = os.path.join(current_app.static_folder, 'uploads', 'profiles')
-            os.makedirs(uploads_dir, exist_ok=True)
-            filename = secure_filename(f"{uuid4().hex}_{file.filename}")
-            abs_path = os.path.join(uploads_dir, filename)
-            file.save(abs_path)
-            pic_rel_path = f"uploads/profiles/{filename}"
-
-        user = User(name=user_name, email=email, password_hash=generate_password_hash(form.password.data), mobile=mobile_val or None, first_name=form.first_name.data.strip(),last_name=form.last_name.data.strip(), street_address=(form.street_address.data or '').strip() or None, profile_pic_path=pic_rel_path)
+            pic_rel_path = uploads.save(file, secure_filename(file.filename or ""))
+
+        user = User(name=user_name, email=email, password_hash=generate_password_hash(form.password.data).decode("utf-8"), mobile=mobile_val or None, first_name=form.first_name.data.strip(),last_name=form.last_name.data.strip(), street_address=(form.street_address.data or '').strip() or None, profile_pic_path=pic_rel_path)
         if hasattr(user, 'mobile') and mobile_val:
             user.mobile = mobile_val
 
         db.session.add(user)
+        if pic_rel_path:
+            uploads.retain(pic_rel_path)
+            # resized variants are built in the background after the commit
+            db.session.flush()
+            images.queue_profile_variants(user)
         db.session.commit()
         login_user(user)
         flash('Registration successful. Welcome!', 'success')
@@ -141,33 +140,29 @@ def profile():
                 flash('Current password is incorrect.', 'danger')
                 return render_template('profile.html', form=form, user=current_user)
 
-            current_user.password_hash = generate_password_hash(form.new_password.data)
+            current_user.password_hash = generate_password_hash(form.new_password.data).decode("utf-8")
 
         # Profile picture logic
         file = form.profile_pic.data
         remove_requested = form.remove_profile_pic.data
 
-        uploads_dir = os.path.join(current_app.static_folder, 'uploads', 'profiles')
-        os.makedirs(uploads_dir, exist_ok=True)
-
         def _delete_old():
-            if current_user.profile_pic_path:
-                try:
-                    os.remove(os.path.join(current_app.static_folder, current_user.profile_pic_path))
-                except Exception:
-                    pass
+            # the file is garbage collected once nothing references it (see uploads.py)
+            uploads.release(current_user.profile_pic_path)
 
         if file:
             # Replace
-            filename = secure_filename(f"{uuid4().hex}_{file.filename}")
-            abs_path = os.path.join(uploads_dir, filename)
-            file.save(abs_path)
+            new_path = uploads.save(file, secure_filename(file.filename or ""))
             _delete_old()
-            current_user.profile_pic_path = f"uploads/profiles/{filename}"
+            uploads.retain(new_path)
+            current_user.profile_pic_path = new_path
+            current_user.profile_pic_variants = None
+            images.queue_profile_variants(current_user)
         elif remove_requested:
             # Remove only if no new file supplied
             _delete_old()
             current_user.profile_pic_path = None
+            current_user.profile_pic_variants = None
 
         db.session.commit()
         flash('Profile updated.', 'success')
@@ -1,13 +1,20 @@
-from flask import Blueprint, render_template, url_for, redirect, flash, request
+from flask import Blueprint, Response, render_template, url_for, redirect, flash, request, abort, stream_with_context
 from flask_login import login_required, current_user
-from datetime import datetime, timezone
-from sqlalchemy import func
-from . import db
-from .models import Booking, Event, TicketType
-import secrets
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, select, update, and_, exists, or_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased, joinedload
+from . import db, listing, images, metrics
+from .assets import asset_url
+from .cache import event_changed
+from .models import Booking, Event, TicketType, Payment, User
+from .replicas import replica_reads
+import csv, enum, io, secrets, random, time
+import click
 from decimal import Decimal
 
 bookings_bp = Blueprint("bookings", __name__)
+metrics.instrument(bookings_bp)
 
 def _status_for(event):
     if getattr(event, "cancelled", False):
@@ -17,16 +24,174 @@ def _status_for(event):
         return "Inactive"
     cap = getattr(event, "capacity", None)
     if cap is not None:
-        sold = (
-            db.session.query(func.coalesce(func.sum(Booking.qty), 0))
-            .filter(Booking.event_id == event.id, Booking.status == "CONFIRMED")
-            .scalar()
-            or 0
-        )
-        if sold >= int(cap or 0):
+        if int(event.sold_qty or 0) >= int(cap or 0):
             return "Sold Out"
     return "Open"
 
+def record_sale(event_id, ticket_type_id, qty):
+    """
+    Move the denormalised sold_qty counters on the event and ticket type by qty
+    (negative when a booking is cancelled). Runs in the caller's transaction so
+    the counters commit or roll back together with the booking row.
+    """
+    db.session.execute(
+        update(Event)
+        .where(Event.id == event_id)
+        .values(sold_qty=Event.sold_qty + qty, updated_at=Event.updated_at)
+    )
+    db.session.execute(
+        update(TicketType)
+        .where(TicketType.id == ticket_type_id)
+        .values(sold_qty=TicketType.sold_qty + qty, updated_at=TicketType.updated_at)
+    )
+
+def reserve_seats(event_id, ticket_type_id, qty) -> bool:
+    """
+    Atomically claim qty seats with a conditional UPDATE: the row only changes
+    while the event is not cancelled and sold_qty + qty still fits capacity, so
+    concurrent buyers can't both take the last seats (no check-then-act race).
+    Returns False, with nothing changed, when the seats aren't available.
+    """
+    claimed = db.session.execute(
+        update(Event)
+        .where(
+            Event.id == event_id,
+            Event.cancelled == False,
+            or_(Event.capacity == None, Event.sold_qty + qty <= Event.capacity),
+        )
+        .values(sold_qty=Event.sold_qty + qty, updated_at=Event.updated_at)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if claimed != 1:
+        return False
+    db.session.execute(
+        update(TicketType)
+        .where(TicketType.id == ticket_type_id)
+        .values(sold_qty=TicketType.sold_qty + qty, updated_at=TicketType.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    return True
+
+def release_booking(booking) -> bool:
+    """
+    Cancel a confirmed booking and give its seats back, in the caller's
+    transaction. The status changes with a conditional UPDATE, so of two
+    concurrent cancellations only one matches the CONFIRMED row and returns
+    the seats. Returns False, with nothing changed, when the booking wasn't
+    confirmed any more.
+    """
+    released = db.session.execute(
+        update(Booking)
+        .where(Booking.booking_id == booking.booking_id, Booking.status == "CONFIRMED")
+        .values(status="CANCELLED", cancelled_at=func.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if released != 1:
+        return False
+    record_sale(booking.event_id, booking.ticket_type_id, -booking.qty)
+    return True
+
+# PostgreSQL: serialization_failure, deadlock_detected, lock_not_available
+_RETRYABLE_SQLSTATES = {"40001", "40P01", "55P03"}
+
+def _is_lock_error(exc) -> bool:
+    if getattr(getattr(exc, "orig", None), "sqlstate", None) in _RETRYABLE_SQLSTATES:
+        return True
+    msg = str(getattr(exc, "orig", exc)).lower()
+    return "database is locked" in msg or "database is busy" in msg or "deadlock" in msg
+
+def place_booking(event_id, user_id, ticket_type, qty, retries=6, backoff=0.02):
+    """
+    Reserve seats and write the Booking + Payment in one transaction.
+    Returns the Booking, or None when the event no longer has room.
+    Lock contention ("database is locked" on SQLite, deadlocks and
+    serialization failures on PostgreSQL) is retried with
+    exponential backoff and jitter; any other error is raised after rollback.
+    """
+    tt_id = ticket_type.id
+    unit_price = Decimal(str(ticket_type.price or 0))
+    currency = ticket_type.currency or "AUD"
+    total_amount = unit_price * qty
+
+    for attempt in range(retries + 1):
+        try:
+            if not reserve_seats(event_id, tt_id, qty):
+                db.session.rollback()
+                return None
+
+            b = Booking(
+                booking_id=secrets.token_hex(12),
+                event_id=event_id,
+                user_id=user_id,
+                ticket_type_id=tt_id,
+                qty=qty,
+                unit_price=unit_price,
+                total_amount=total_amount,
+                status="CONFIRMED",
+            )
+            db.session.add(b)
+            db.session.flush()
+
+            p = Payment(
+                booking_id=b.booking_id,
+                provider="SIMULATED",
+                method_brand="VISA",
+                method_last4="4242",
+                amount=total_amount,
+                currency=currency,
+                status="CAPTURED",
+                authorised_at=func.now(),
+                captured_at=func.now(),
+            )
+            db.session.add(p)
+            db.session.commit()
+            return b
+        except OperationalError as exc:
+            db.session.rollback()
+            if not _is_lock_error(exc) or attempt == retries:
+                raise
+            time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+        except Exception:
+            db.session.rollback()
+            raise
+
+def reconcile_sales(session=None):
+    """
+    Recompute every sold_qty counter from confirmed bookings, fixing any drift.
+    Returns (events corrected, ticket types corrected); the caller commits.
+    """
+    session = session or db.session
+    event_sold = (
+        select(func.coalesce(func.sum(Booking.qty), 0))
+        .where(Booking.event_id == Event.id, Booking.status == "CONFIRMED")
+        .scalar_subquery()
+    )
+    type_sold = (
+        select(func.coalesce(func.sum(Booking.qty), 0))
+        .where(Booking.ticket_type_id == TicketType.id, Booking.status == "CONFIRMED")
+        .scalar_subquery()
+    )
+    events_fixed = session.execute(
+        update(Event)
+        .where(Event.sold_qty != event_sold)
+        .values(sold_qty=event_sold, updated_at=Event.updated_at)
+        .execution_options(synchronize_session="fetch")
+    ).rowcount
+    types_fixed = session.execute(
+        update(TicketType)
+        .where(TicketType.sold_qty != type_sold)
+        .values(sold_qty=type_sold, updated_at=TicketType.updated_at)
+        .execution_options(synchronize_session="fetch")
+    ).rowcount
+    return events_fixed, types_fixed
+
+@bookings_bp.cli.command("reconcile")
+def reconcile_command():
+    """Recompute the per-event and per-ticket-type sold counters from bookings."""
+    events_fixed, types_fixed = reconcile_sales()
+    db.session.commit()
+    click.echo(f"Sales counters reconciled: {events_fixed} event(s) and {types_fixed} ticket type(s) corrected.")
+
 def _can_cancel_event(event) -> bool:
     if getattr(event, "cancelled", False):
         return False
@@ -37,12 +202,17 @@ def _can_cancel_event(event) -> bool:
 @bookings_bp.route("/booking-history")
 @login_required
 def booking_history():
-    rows = (
+    page     = max((request.args.get("page", 1, type=int) or 1), 1)
+    per_page = min(max((request.args.get("per_page", 10, type=int) or 10), 1), 100)
+
+    # one page of bookings; events and their images come in bulk, not per row
+    qry = (
         db.session.query(Booking)
         .filter(Booking.user_id == current_user.id, Booking.status != "CANCELLED")
-        .order_by(Booking.created_at.desc())
-        .all()
+        .options(joinedload(Booking.event).selectinload(Event.images))
+        .order_by(Booking.created_at.desc(), Booking.booking_id)
     )
+    rows, total, pages = listing.paginate(qry, page, per_page)
     def fmt(dt, s):
         try: return dt.strftime(s)
         except Exception: return str(dt) if dt else ""
@@ -50,13 +220,15 @@ def booking_history():
     for r in rows:
         e = r.event
         cover = None
+        variants = None
         if e and getattr(e, "images", None):
             try:
                 cover = e.images[0].url
+                variants = e.images[0].variants
             except Exception:
                 cover = None
         if not cover:
-            cover = url_for("static", filename="img/founders-breakfast.jpg")
+            cover = asset_url("img/founders-breakfast.jpg")
         start_at = getattr(e, "start_at", None)
         end_at = getattr(e, "end_at", None)
         when_line = ""
@@ -69,7 +241,8 @@ def booking_history():
             "event_id": getattr(e, "id", None),
             "event_title": getattr(e, "title", "Event"),
             "image_url": cover,
-            "image_url": cover,
+            "image_variants": variants,
+            "thumb_url": images.variant_url(variants, "thumb", cover),
             "image_alt": f"Cover image for {getattr(e, 'title', 'Event')}",
             "when_line": when_line,
             "date_short": fmt(start_at, '%d %b %Y'),
@@ -81,10 +254,121 @@ def booking_history():
             "status": _status_for(e),
             "cancellable": (getattr(r, "status", "CONFIRMED") == "CONFIRMED") and _can_cancel_event(e),
         })
-    return render_template("history.html", active_page="bookinghistory", bookings=bookings)
+    return render_template(
+        "history.html",
+        active_page="bookinghistory",
+        bookings=bookings,
+        page=page,
+        per_page=per_page,
+        total=total,
+        pages=pages,
+        base_qs=listing.page_query_string(request.args),
+    )
+
+# attendee / sales export for hosts: one CSV row per booking, in booking order
+
+ATTENDEE_COLUMNS = (
+    "booking_id", "created_at", "status", "name", "email", "mobile", "ticket_type", "qty",
+    "unit_price", "total_amount", "cancelled_at", "payment_status", "payment_provider",
+    "payment_amount", "payment_currency", "captured_at", "refunded_at",
+)
+_EXPORT_BATCH = 1000
+
+def _attendee_rows(event_id, since=None, after=None):
+    """
+    Bookings of an event with their user, ticket type and latest payment,
+    streamed _EXPORT_BATCH at a time (a server-side cursor on PostgreSQL).
+    since / after resume a partial export: bookings created at or after
+    `since`, and at exactly `since` only those whose booking_id sorts after `after`.
+    """
+    # the booking's latest payment: an index lookup per row on both backends
+    # (PostgreSQL can't use one for a join on a correlated max())
+    newer = aliased(Payment)
+    latest_payment = and_(
+        Payment.booking_id == Booking.booking_id,
+        ~exists().where(newer.booking_id == Payment.booking_id, newer.id > Payment.id),
+    )
+    query = (
+        select(
+            Booking.booking_id, Booking.created_at, Booking.status,
+            User.name, User.email, User.mobile,
+            TicketType.name.label("ticket_type"),
+            Booking.qty, Booking.unit_price, Booking.total_amount, Booking.cancelled_at,
+            Payment.status.label("payment_status"), Payment.provider.label("payment_provider"),
+            Payment.amount.label("payment_amount"), Payment.currency.label("payment_currency"),
+            Payment.captured_at, Payment.refunded_at,
+        )
+        .join(User, User.id == Booking.user_id)
+        .join(TicketType, TicketType.id == Booking.ticket_type_id)
+        .outerjoin(Payment, latest_payment)
+        .where(Booking.event_id == event_id)
+        .order_by(Booking.created_at, Booking.booking_id)
+        .execution_options(yield_per=_EXPORT_BATCH)
+    )
+    if since is not None:
+        # SQLite keeps CURRENT_TIMESTAMP without fractions while bound datetimes
+        # carry them, so the SQL bound is a second early and the exact cut is here
+        query = query.where(Booking.created_at >= since - timedelta(seconds=1))
+    for row in db.session.execute(query):
+        if since is not None and (row.created_at < since or (
+                row.created_at == since and after is not None and row.booking_id <= after)):
+            continue
+        yield row
 
-def checkStatus(event_id):
-    e = db.session.get(Event, event_id)
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+def _csv_chunks(rows, flush_at=16384):
+    # the header goes out before the query runs; then ~16 KB chunks
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(ATTENDEE_COLUMNS)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        if buffer.tell() >= flush_at:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@bookings_bp.route("/event/<int:event_id>/attendees.csv")
+@login_required
+@replica_reads
+def export_attendees(event_id):
+    """
+    Stream an event's bookings as CSV (hosts only). Memory use doesn't grow
+    with the number of attendees. A partial download resumes with
+    ?since=<created_at of the last row>&after=<its booking_id>.
+    """
+    host_id = db.session.execute(select(Event.host_user_id).where(Event.id == event_id)).scalar()
+    if host_id is None or host_id != current_user.id:
+        abort(404)
+    try:
+        since = request.args.get("since")
+        since = datetime.fromisoformat(since).replace(tzinfo=None) if since else None
+    except ValueError:
+        abort(400)
+    rows = _attendee_rows(event_id, since, request.args.get("after") or None)
+    response = Response(stream_with_context(_csv_chunks(rows)), mimetype="text/csv")
+    response.headers["Content-Disposition"] = f'attachment; filename="event-{event_id}-attendees.csv"'
+    response.headers["Cache-Control"] = "private, no-store"
+    # don't let a buffering proxy (nginx) hold the stream back
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+def checkStatus(event_id, event=None):
+    # callers that already loaded the event pass it in to skip the extra get
+    e = event if event is not None else db.session.get(Event, event_id)
     now_utc = datetime.now(timezone.utc)
 
     # Cancelled
@@ -92,12 +376,7 @@ def checkStatus(event_id):
         return "Cancelled"
 
     # Sold Out
-    sold = (
-        db.session.query(func.coalesce(func.sum(Booking.qty), 0))
-        .filter(Booking.event_id == event_id, Booking.status == "CONFIRMED")
-        .scalar()
-        or 0
-    )
+    sold = int(e.sold_qty or 0)
     if e.capacity is not None and int(e.capacity or 0) <= 0:
         return "Sold Out"
     if e.capacity is not None and sold >= int(e.capacity):
@@ -134,24 +413,27 @@ def cancel_booking(booking_id):
 
     event = booking.event
     if not _can_cancel_event(event):
+        metrics.cancellation("rejected")
         flash("Only upcoming bookings can be cancelled.", "warning")
         return redirect(url_for("bookings.booking_history"))
 
     try:
-        if hasattr(booking, "status"):
-            booking.status = "CANCELLED"
-            if hasattr(booking, "cancelled_at"):
-                booking.cancelled_at = func.now()
-        else:
-            db.session.delete(booking)
-
+        cancelled = release_booking(booking)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
         print("Cancel failed:", repr(e))
+        metrics.cancellation("failed")
         flash("Could not cancel booking.", "danger")
         return redirect(url_for("bookings.booking_history"))
 
+    if not cancelled:
+        metrics.cancellation("rejected")
+        flash("This booking has already been cancelled.", "warning")
+        return redirect(url_for("bookings.booking_history"))
+
+    metrics.cancellation("cancelled")
+    event_changed.send(event.id)
     flash("Your booking was cancelled. No refunds will be issued and this exact booking cannot be reinstated.", "success",)
     return redirect(url_for("bookings.booking_history"))
 
@@ -165,11 +447,13 @@ def book_event(event_id):
 
     # cannot book if you're the host
     if current_user.id == event.host_user_id:
+        metrics.booking("rejected")
         flash("Hosts can’t book their own events.", "warning")
         return redirect(url_for("events.event", event_id=event_id))
 
     # must be Open
     if checkStatus(event_id) != "Open":
+        metrics.booking("rejected")
         flash("This event is not open for booking.", "warning")
         return redirect(url_for("events.event", event_id=event_id))
 
@@ -184,9 +468,9 @@ def book_event(event_id):
         qty = 12
 
     # capacity check
-    sold = db.session.query(func.coalesce(func.sum(Booking.qty), 0)).filter(Booking.event_id == event_id, Booking.status == "CONFIRMED").scalar() or 0
-    remaining = (event.capacity or 0) - int(sold)
+    remaining = (event.capacity or 0) - int(event.sold_qty or 0)
     if event.capacity is not None and qty > remaining:
+        metrics.booking("sold_out")
         flash(f"Only {remaining} tickets remaining.", "warning")
         return redirect(url_for("events.event", event_id=event_id))
 
@@ -197,47 +481,24 @@ def book_event(event_id):
         .first()
     )
     if not tt:
+        metrics.booking("rejected")
         flash("No tickets available for this event.", "danger")
         return redirect(url_for("events.event", event_id=event_id))
 
-    unit_price = Decimal(str(tt.price or 0))
-    total_amount = unit_price * qty
-
-    # create booking
-    booking_id = secrets.token_hex(12) 
-    b = Booking(
-        booking_id=booking_id,
-        event_id=event_id,
-        user_id=current_user.id,
-        ticket_type_id=tt.id,
-        qty=qty,
-        unit_price=unit_price,
-        total_amount=total_amount,
-        status="CONFIRMED",
-    )
-    db.session.add(b)
-    db.session.flush()
-
-    from .models import Payment
-    p = Payment(
-        booking_id=b.booking_id,
-        provider="SIMULATED",
-        method_brand="VISA",
-        method_last4="4242",
-        amount=total_amount,
-        currency=tt.currency or "AUD",
-        status="CAPTURED",
-        authorised_at=func.now(),
-        captured_at=func.now(),
-    )
-    db.session.add(p)
-
     try:
-        db.session.commit()
+        b = place_booking(event_id, current_user.id, tt, qty)
     except Exception:
-        db.session.rollback()
+        metrics.booking("failed")
         flash("Could not complete your booking.", "danger")
         return redirect(url_for("events.event", event_id=event_id))
 
+    if b is None:
+        # someone else took the last seats between the page load and now
+        metrics.booking("sold_out")
+        flash("Sorry, there aren’t enough tickets left for that quantity.", "warning")
+        return redirect(url_for("events.event", event_id=event_id))
+
+    metrics.booking("booked", qty)
+    event_changed.send(event_id)
     flash("Your purchase is complete. See it in Booking History.", "success")
     return redirect(url_for("bookings.booking_history"))
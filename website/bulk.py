@@ -0,0 +1,387 @@
+from sqlalchemy import insert, select, or_
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import csv, json, time
+from . import db, search, uploads
+from .cache import tags_changed
+from .models import Event, Event_Image, Event_Tag, Tag, TicketType, User
+
+# Bulk event import / export (flask events import|export), for hosts moving
+# hundreds or thousands of events in at once.
+#
+# Import streams the file and resolves host and tag names through in-memory
+# maps (a query per distinct host, one for all tags). Every `batch_size`
+# events go in as one transaction: a multi-row INSERT ... RETURNING for the
+# events, then one executemany each for their tags, images and ticket types;
+# the search index is updated once per batch rather than by per-row triggers.
+# Export streams the events with yield_per and loads each batch's tags,
+# images and ticket types with one IN query apiece, so memory use stays flat.
+#
+# JSON lines carry everything: the event columns, "host" (user name or
+# email), "tags" (names), "images" [{url, alt_text}] and "tickets" [{name,
+# price, currency, capacity, sales_start_at, sales_end_at}]. CSV has a row per
+# event with tags joined by "|" and one image and ticket type (the first).
+
+EVENT_FIELDS = (
+    "title", "description", "event_type", "event_timezone", "start_at", "end_at",
+    "rsvp_closes", "location_text", "join_url", "join_url_release_at", "capacity",
+    "cancelled", "is_active",
+)
+CSV_COLUMNS = (
+    "id", *EVENT_FIELDS, "host", "tags", "image_url", "image_alt",
+    "ticket_name", "ticket_price", "ticket_currency", "ticket_capacity",
+    "sales_start_at", "sales_end_at",
+)
+TAG_SEPARATOR = "|"
+DEFAULT_TICKET = "General Admission"
+DEFAULT_CURRENCY = "AUD"
+
+_DATETIMES = {"start_at", "end_at", "rsvp_closes", "join_url_release_at"}
+
+
+def format_for(path, fmt=None):
+    """csv or jsonl, from --format or the file's extension."""
+    if fmt:
+        return fmt
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    raise ValueError("can't tell the format from the file name; pass --format csv|jsonl")
+
+
+# parsing
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _datetime(value):
+    if _blank(value):
+        return None
+    # wall-clock time, stored naive like the create form does
+    return datetime.fromisoformat(str(value).strip()).replace(tzinfo=None)
+
+
+def _int(value):
+    return None if _blank(value) else int(value)
+
+
+def _bool(value, default):
+    if _blank(value):
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y", "t")
+
+
+def _decimal(value):
+    if _blank(value):
+        return None
+    try:
+        return Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"bad price {value!r}") from None
+
+
+def _from_csv(row):
+    # a CSV row in the JSON lines shape
+    record = {field: row.get(field) for field in EVENT_FIELDS}
+    record["host"] = row.get("host")
+    record["tags"] = [t.strip() for t in (row.get("tags") or "").split(TAG_SEPARATOR) if t.strip()]
+    record["images"] = [{"url": row["image_url"], "alt_text": row.get("image_alt")}] if not _blank(row.get("image_url")) else []
+    record["tickets"] = [] if _blank(row.get("ticket_price")) else [{
+        "name": row.get("ticket_name"),
+        "price": row.get("ticket_price"),
+        "currency": row.get("ticket_currency"),
+        "capacity": row.get("ticket_capacity"),
+        "sales_start_at": row.get("sales_start_at"),
+        "sales_end_at": row.get("sales_end_at"),
+    }]
+    return record
+
+
+def read_records(stream, fmt):
+    """(line number, record) for each event in a CSV or JSON lines stream."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, _from_csv(row)
+        return
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError as exc:
+                yield number, exc
+
+
+class _Hosts:
+    """User name / email -> id, one query per distinct value."""
+
+    def __init__(self, default=None):
+        self.default = default
+        self._ids = {}
+
+    def __call__(self, value):
+        value = (value or self.default or "").strip()
+        if not value:
+            raise ValueError("no host (add a host column or pass --host)")
+        if value not in self._ids:
+            self._ids[value] = db.session.execute(
+                select(User.id).where(or_(User.name == value, User.email == value))
+            ).scalar()
+        if self._ids[value] is None:
+            raise ValueError(f"unknown host {value!r}")
+        return self._ids[value]
+
+
+class _Tags:
+    """Tag name -> id, loaded once; unknown names are created when allowed."""
+
+    def __init__(self, create=False):
+        self.create = create
+        self.created = 0
+        self._ids = dict(db.session.execute(select(Tag.name, Tag.id)).all())
+
+    def __call__(self, name):
+        if name not in self._ids:
+            if not self.create:
+                raise ValueError(f"unknown tag {name!r} (pass --create-tags to add it)")
+            self._ids[name] = db.session.execute(insert(Tag).values(name=name).returning(Tag.id)).scalar_one()
+            self.created += 1
+        return self._ids[name]
+
+
+def _prepare(record, hosts, tags):
+    """(event row, tag ids, image rows, ticket rows) for a record; ValueError if it's invalid."""
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    event = {field: record.get(field) for field in EVENT_FIELDS}
+    event["title"] = (event["title"] or "").strip()
+    if not event["title"] or len(event["title"]) > 160:
+        raise ValueError("title is required (up to 160 characters)")
+    for field in _DATETIMES:
+        event[field] = _datetime(event[field])
+    event["capacity"] = _int(event["capacity"])
+    event["cancelled"] = _bool(event["cancelled"], False)
+    event["is_active"] = _bool(event["is_active"], not event["cancelled"])
+    event["host_user_id"] = hosts(record.get("host"))
+    # the events table's CHECK constraints, so one bad row can't fail its batch
+    start, end, rsvp = event["start_at"], event["end_at"], event["rsvp_closes"]
+    if start and end and start > end:
+        raise ValueError("end_at is before start_at")
+    if start and rsvp and rsvp > start:
+        raise ValueError("rsvp_closes is after start_at")
+    if event["capacity"] is not None and event["capacity"] < 0:
+        raise ValueError("negative capacity")
+
+    tag_ids = list(dict.fromkeys(tags(name) for name in record.get("tags") or []))
+    images = []
+    for image in record.get("images") or []:
+        if not _blank(image.get("url")) and image["url"] not in {i["url"] for i in images}:
+            images.append({"url": image["url"].strip(), "alt_text": image.get("alt_text") or None})
+    tickets = []
+    for ticket in record.get("tickets") or []:
+        price = _decimal(ticket.get("price"))
+        capacity = _int(ticket.get("capacity"))
+        capacity = event["capacity"] if capacity is None else capacity
+        currency = (ticket.get("currency") or DEFAULT_CURRENCY).strip().upper()
+        if price is None or price < 0:
+            raise ValueError("ticket price is required and can't be negative")
+        if capacity is None or capacity < 0:
+            raise ValueError("ticket capacity is required (or an event capacity)")
+        if len(currency) != 3:
+            raise ValueError(f"bad currency {currency!r}")
+        row = {
+            "name": (ticket.get("name") or DEFAULT_TICKET).strip(),
+            "price": price,
+            "is_free": price == 0,
+            "currency": currency,
+            "capacity": capacity,
+            "sales_start_at": _datetime(ticket.get("sales_start_at")),
+            "sales_end_at": _datetime(ticket.get("sales_end_at")),
+        }
+        if row["sales_start_at"] and row["sales_end_at"] and row["sales_start_at"] > row["sales_end_at"]:
+            raise ValueError("ticket sales end before they start")
+        tickets.append(row)
+    return event, tag_ids, images, tickets
+
+
+# import
+
+class ImportResult:
+    """Counts for the import's report."""
+
+    def __init__(self):
+        self.events = self.tags = self.images = self.tickets = 0
+        self.errors = []  # (line number, message)
+        self.started = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.events / self.seconds if self.seconds else 0.0
+
+
+def _insert_events(rows):
+    """Insert event rows (Core, no ORM bookkeeping); returns their ids in row order."""
+    events = Event.__table__
+    if db.session.get_bind().dialect.name != "sqlite":
+        # multi-row INSERT ... RETURNING, rows matched to ids by SQLAlchemy's sentinel
+        return db.session.execute(events.insert().returning(events.c.id, sort_by_parameter_order=True), rows).scalars().all()
+    # SQLite doesn't promise RETURNING order for a multi-row insert (and with
+    # sort_by_parameter_order SQLAlchemy would send a statement per row), but each
+    # new row gets max(rowid) + 1, so the returned ids, sorted, follow the rows
+    return sorted(db.session.execute(events.insert().returning(events.c.id), rows).scalars())
+
+
+def _insert_batch(batch, result):
+    # batch: prepared records, all valid; one transaction
+    with search.bulk_insert(db.session.connection()) as indexed:
+        ids = _insert_events([event for event, _, _, _ in batch])
+        tag_rows, image_rows, ticket_rows = [], [], []
+        for event_id, (_, tag_ids, images, tickets) in zip(ids, batch):
+            tag_rows += [{"event_id": event_id, "tag_id": tag_id} for tag_id in tag_ids]
+            image_rows += [{"event_id": event_id, **image} for image in images]
+            ticket_rows += [{"event_id": event_id, **ticket} for ticket in tickets]
+        for model, rows in ((Event_Tag, tag_rows), (Event_Image, image_rows), (TicketType, ticket_rows)):
+            if rows:
+                db.session.execute(model.__table__.insert(), rows)
+        indexed += ids
+    # stored uploads referenced by the new images
+    for row in image_rows:
+        uploads.retain(row["url"])
+    db.session.commit()
+    result.events += len(ids)
+    result.tags += len(tag_rows)
+    result.images += len(image_rows)
+    result.tickets += len(ticket_rows)
+
+
+def import_events(stream, fmt, default_host=None, create_tags=False, batch_size=1000, progress=None):
+    """
+    Insert the events in a CSV / JSON lines stream, batch_size per transaction.
+    Invalid records are skipped and listed in the result's errors; earlier
+    batches stay committed if a later one fails.
+    """
+    result = ImportResult()
+    hosts, tags = _Hosts(default_host), _Tags(create_tags)
+    batch = []
+    try:
+        for number, record in read_records(stream, fmt):
+            try:
+                if isinstance(record, Exception):
+                    raise ValueError(str(record))
+                batch.append(_prepare(record, hosts, tags))
+            except (ValueError, TypeError, AttributeError) as exc:
+                result.errors.append((number, str(exc)))
+                continue
+            if len(batch) >= batch_size:
+                _insert_batch(batch, result)
+                batch = []
+                if progress:
+                    progress(result)
+        if batch:
+            _insert_batch(batch, result)
+        else:
+            db.session.commit()  # tags created for records that were all skipped
+    finally:
+        if tags.created:
+            # also when a later batch failed: the earlier ones stay committed
+            tags_changed.send()
+    return result
+
+
+# export
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _grouped(query):
+    grouped = {}
+    for row in db.session.execute(query).mappings():
+        grouped.setdefault(row["event_id"], []).append(row)
+    return grouped
+
+
+def iter_records(batch_size=1000):
+    """Every event as a JSON lines record, streamed batch_size at a time."""
+    query = (
+        select(Event.id, *(getattr(Event, field) for field in EVENT_FIELDS), User.name.label("host"))
+        .join(User, User.id == Event.host_user_id)
+        .order_by(Event.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for partition in db.session.execute(query).mappings().partitions():
+        ids = [row["id"] for row in partition]
+        tags = _grouped(
+            select(Event_Tag.event_id, Tag.name)
+            .join(Tag, Tag.id == Event_Tag.tag_id)
+            .where(Event_Tag.event_id.in_(ids))
+            .order_by(Event_Tag.id)
+        )
+        images = _grouped(
+            select(Event_Image.event_id, Event_Image.url, Event_Image.alt_text)
+            .where(Event_Image.event_id.in_(ids))
+            .order_by(Event_Image.id)
+        )
+        tickets = _grouped(
+            select(
+                TicketType.event_id, TicketType.name, TicketType.price, TicketType.currency,
+                TicketType.capacity, TicketType.sales_start_at, TicketType.sales_end_at,
+            )
+            .where(TicketType.event_id.in_(ids))
+            .order_by(TicketType.id)
+        )
+        for row in partition:
+            record = {key: _value(value) for key, value in row.items()}
+            record["tags"] = [t["name"] for t in tags.get(row["id"], ())]
+            record["images"] = [{"url": i["url"], "alt_text": i["alt_text"]} for i in images.get(row["id"], ())]
+            record["tickets"] = [
+                {key: _value(value) for key, value in t.items() if key != "event_id"}
+                for t in tickets.get(row["id"], ())
+            ]
+            yield record
+
+
+def _csv_row(record):
+    image = record["images"][0] if record["images"] else {}
+    ticket = record["tickets"][0] if record["tickets"] else {}
+    row = {field: record.get(field) for field in ("id", *EVENT_FIELDS, "host")}
+    row.update({
+        "tags": TAG_SEPARATOR.join(record["tags"]),
+        "image_url": image.get("url"),
+        "image_alt": image.get("alt_text"),
+        "ticket_name": ticket.get("name"),
+        "ticket_price": ticket.get("price"),
+        "ticket_currency": ticket.get("currency"),
+        "ticket_capacity": ticket.get("capacity"),
+        "sales_start_at": ticket.get("sales_start_at"),
+        "sales_end_at": ticket.get("sales_end_at"),
+    })
+    return row
+
+
+def export_events(out, fmt, batch_size=1000):
+    """Write every event to out as CSV or JSON lines; returns how many."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, CSV_COLUMNS, lineterminator="\n")
+        writer.writeheader()
+        for record in iter_records(batch_size):
+            writer.writerow(_csv_row(record))
+            count += 1
+    else:
+        for record in iter_records(batch_size):
+            out.write(json.dumps(record) + "\n")
+            count += 1
+    return count
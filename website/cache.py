@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from threading import Lock
+from blinker import Namespace
+import time
+
+_signals = Namespace()
+
+# fired with the event id after anything that changes an event's listing data:
+# bookings, cancellations, edits, publish/cancel actions and new events
+event_changed = _signals.signal("event-changed")
+
+# fired after tags are added (flask events import --create-tags)
+tags_changed = _signals.signal("tags-changed")
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache with a per-entry TTL and hit/miss counters.
+    Safe to share between request threads; each process keeps its own copy,
+    so entries also expire on their TTL in case another worker changed the data.
+    """
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, maxsize=None, ttl=None):
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._trim()
+
+    def _trim(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached and still fresh."""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None or entry[0] < now:
+                    if entry is not None:
+                        del self._data[key]
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(key)
+                found[key] = entry[1]
+                self.hits += 1
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, items):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = (expires, value)
+                self._data.move_to_end(key)
+            self._trim()
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+# per-event listing aggregates: ("min_price", id), ("tags", id) and ("tag_names",)
+aggregate_cache = TTLCache()
+
+
+@event_changed.connect
+def _drop_event_aggregates(event_id, **kwargs):
+    aggregate_cache.delete(("min_price", event_id), ("tags", event_id))
+
+
+@tags_changed.connect
+def _drop_tag_names(sender=None, **kwargs):
+    aggregate_cache.delete(("tag_names",))
+
+
+def init_app(app):
+    aggregate_cache.configure(
+        maxsize=app.config.get("AGGREGATE_CACHE_SIZE", 4096),
+        ttl=app.config.get("AGGREGATE_CACHE_TTL", 300),
+    )
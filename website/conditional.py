@@ -0,0 +1,83 @@
+from flask import current_app, request, session, make_response
+from flask.globals import request_ctx
+from flask_login import current_user
+from functools import wraps
+import hashlib, os, time
+
+# Conditional GETs for pages that are expensive to build but rarely change.
+# A view decorated with @conditional(version) first calls version(**view_args),
+# a cheap query returning whatever the page depends on (updated_at, sold_qty...).
+# That, the query string and the logged-in user are hashed into an ETag; when
+# the browser already has it, a 304 is sent without running the view at all.
+
+
+def _csrf_window():
+    # pages embed CSRF tokens that expire; a new window forces a fresh copy in time
+    limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    return int(time.time() // max(limit // 2, 1)) if limit else 0
+
+
+def make_etag(version):
+    user = current_user.get_id() if current_user.is_authenticated else None
+    parts = (
+        current_app.extensions["conditional_salt"],
+        request.endpoint,
+        version,
+        user,
+        sorted(request.args.items(multi=True)),
+        _csrf_window(),
+    )
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()[:32]
+
+
+def _cache_headers(response, etag):
+    response.set_etag(etag, weak=True)
+    # stored by the browser but revalidated on every use; private once personalised
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    response.vary.add("Cookie")
+    return response
+
+
+def conditional(version):
+    """
+    Answer If-None-Match with 304 when version(**view_args) and the request
+    haven't changed. version returns any repr-able value, or None to always
+    render (e.g. the page doesn't exist).
+    """
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # pending flash messages are shown once, so that render can't be skipped
+            if request.method not in ("GET", "HEAD") or session.get("_flashes"):
+                return view(*args, **kwargs)
+            key = version(**kwargs)
+            if key is None:
+                return view(*args, **kwargs)
+            etag = make_etag(key)
+            if request.if_none_match.contains_weak(etag):
+                return _cache_headers(current_app.response_class(status=304), etag)
+            response = make_response(view(*args, **kwargs))
+            # nor one that displayed (or queued) a flash message
+            if response.status_code == 200 and not request_ctx.flashes and not session.get("_flashes"):
+                _cache_headers(response, etag)
+            return response
+        return wrapper
+    return decorate
+
+
+def _deploy_salt(app):
+    # a deploy that changes templates or assets must not be answered with an old page
+    digest = hashlib.sha256(app.config.get("ETAG_SALT", "").encode("utf-8"))
+    for dirpath, dirnames, filenames in os.walk(app.jinja_loader.searchpath[0]):
+        dirnames.sort()
+        for name in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    digest.update(repr(sorted(app.extensions.get("assets", {}).items())).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def init_app(app):
+    app.extensions["conditional_salt"] = _deploy_salt(app)
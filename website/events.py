@@ -1,17 +1,23 @@
 from flask import Blueprint, render_template, session, request, redirect, url_for, flash, abort
 from flask_login import login_required, current_user
 from sqlalchemy import func, or_, cast, Float
+from sqlalchemy.orm import selectinload, aliased
 from datetime import datetime, timezone
 from .forms import CreateEventForm, CommentForm, check_upload_file
 from .models import Event, Event_Image, Event_Tag, Tag, Comment, TicketType, Booking, User
 from .bookings import checkStatus
 from .forms import EventActionForm
 #from .views import check_upload_file
-from . import db
+from . import db, bulk, listing, search, images, uploads, metrics
+from .cache import event_changed
+from .conditional import conditional
+from .replicas import replica_reads
 from werkzeug.utils import secure_filename
 import os, time, uuid
+import click
 
 events_bp = Blueprint('events', __name__)
+metrics.instrument(events_bp)
 
 def _has_started(start_at):
     """
@@ -31,53 +37,108 @@ def _has_started(start_at):
         return start_utc_naive <= now_utc_naive
 
 
+def _load_event_page(event_id):
+    """
+    Everything the event page shows, in one round trip: the event, its host,
+    first image, first tag and cheapest ticket. Returns None if there's no such event.
+    """
+    img, link = aliased(Event_Image), aliased(Event_Tag)
+    first_image_id = (
+        db.select(img.id)
+        .where(img.event_id == Event.id)
+        .order_by(img.id)
+        .limit(1)
+        .correlate(Event)
+        .scalar_subquery()
+    )
+    first_tag_id = (
+        db.select(link.id)
+        .where(link.event_id == Event.id)
+        .order_by(link.id)
+        .limit(1)
+        .correlate(Event)
+        .scalar_subquery()
+    )
+    min_price = (
+        db.select(func.min(TicketType.price))
+        .where(TicketType.event_id == Event.id)
+        .scalar_subquery()
+    )
+    return db.session.execute(
+        db.select(
+            Event,
+            User.name.label("host_name"),
+            User.email.label("host_email"),
+            Event_Image.url.label("image_url"),
+            Event_Image.alt_text.label("image_alt"),
+            Event_Image.variants.label("image_variants"),
+            Tag.name.label("tag_name"),
+            min_price.label("min_price"),
+        )
+        .outerjoin(User, User.id == Event.host_user_id)
+        .outerjoin(Event_Image, Event_Image.id == first_image_id)
+        .outerjoin(Event_Tag, Event_Tag.id == first_tag_id)
+        .outerjoin(Tag, Tag.id == Event_Tag.tag_id)
+        .where(Event.id == event_id)
+    ).first()
+
+
+def _event_version(event_id):
+    """
+    What the event page depends on, in one small query: the event row and its
+    sales counter, its status (which flips when the start time passes), the
+    host, image and ticket prices. None when there's no such event.
+    """
+    img_changed = db.select(func.max(Event_Image.updated_at)).where(Event_Image.event_id == Event.id).scalar_subquery()
+    price_changed = db.select(func.max(TicketType.updated_at)).where(TicketType.event_id == Event.id).scalar_subquery()
+    # naive UTC, the clock checkStatus() renders the page's status with
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    row = db.session.execute(
+        db.select(
+            Event.updated_at, Event.sold_qty,
+            listing.status_expr(Event.sold_qty, now).label("status"),
+            User.updated_at.label("host_changed"),
+            img_changed.label("img_changed"),
+            price_changed.label("price_changed"),
+        )
+        .outerjoin(User, User.id == Event.host_user_id)
+        .where(Event.id == event_id)
+    ).first()
+    return tuple(row) if row is not None else None
+
+
 @events_bp.route('/event/<int:event_id>', methods=['GET', 'POST'])
+@replica_reads
+@conditional(_event_version)
 def event(event_id):
+    row = _load_event_page(event_id)
     #if event_id is invalid, redirect to home
-    if event_id not in [eid for (eid,) in db.session.execute(db.select(Event.id)).all()]:
+    if row is None:
         flash("Event not found.", "danger")
         return redirect(url_for('main.index'))
     session['event'] = event_id
     #form = CommentForm() 
     #if form.validate_on_submit():
     #    comment = Comment(event_id, current_user.id, form.comment.data)
-    title = db.session.execute(db.select(Event.title).where(Event.id==event_id)).scalar_one()
-    description = db.session.execute(db.select(Event.description).where(Event.id==event_id)).scalar_one()
-    capacity = db.session.execute(db.select(Event.capacity).where(Event.id==event_id)).scalar_one()
-    hostID = db.session.execute(db.select(Event.host_user_id).where(Event.id==event_id)).scalar_one()
-    hostName = db.session.execute(db.select(User.name).where(User.id==hostID)).scalar_one()
-    hostEmail = db.session.execute(db.select(User.email).where(User.id==hostID)).scalar_one()
-    imageAltText = db.session.execute(db.select(Event_Image.alt_text).where(Event_Image.event_id==event_id)).scalar_one_or_none()
-    formatType = db.session.execute(db.select(Event.event_type).where(Event.id==event_id)).scalar_one()
-    startAt = db.session.execute(db.select(Event.start_at).where(Event.id==event_id)).scalar_one()
-    tagId = db.session.execute(db.select(Event_Tag.tag_id).where(Event_Tag.event_id==event_id)).scalar_one()
-    tagName = db.session.execute(db.select(Tag.name).where(Tag.id==tagId)).scalar_one()
-    price = db.session.execute(
-        db.select(func.min(TicketType.price)).where(TicketType.event_id==event_id)
-    ).scalar()
-    
-    startAt = db.session.execute(db.select(Event.start_at).where(Event.id == event_id)).scalar_one()
+    e = row.Event
+    capacity = e.capacity
+    hostID = e.host_user_id
+
+    startAt = e.start_at
     startAtDate = startAt.strftime("%a, %d %b %Y") if startAt else ""
     startAtTime = startAt.strftime("%I:%M %p").lstrip("0") if startAt else ""
 
-    endAt_dt = db.session.execute(
-        db.select(Event.end_at).where(Event.id == event_id)
-    ).scalar_one()
-
+    endAt_dt = e.end_at
     endAt = endAt_dt.strftime("%I:%M %p").lstrip("0") if endAt_dt else ""
 
-
-    image = db.session.execute(
-        db.select(Event_Image.url).where(Event_Image.event_id==event_id)
-    ).scalar_one_or_none()
-    status = checkStatus(event_id)
+    status = checkStatus(event_id, event=e)
     
     is_host = False
     if hasattr(current_user, "is_authenticated") and current_user.is_authenticated:
         is_host = (current_user.id == hostID)
         
-    # sold quantity (sum of bookings)
-    sold_qty = db.session.query(func.coalesce(func.sum(Booking.qty), 0)).filter(Booking.event_id == event_id, Booking.status == "CONFIRMED").scalar() or 0
+    # sold quantity (maintained counter, see bookings.record_sale)
+    sold_qty = e.sold_qty or 0
     remaining = None
     if capacity is not None:
         try:
@@ -85,10 +146,11 @@ def event(event_id):
         except Exception:
             remaining = None
     
-    return render_template('event.html', event_id=event_id, host_email=hostEmail,
-    title=title, status=status, price=price, description=description, category=tagName, format_type = formatType, capacity=capacity,
-    host_name=hostName, start_at_date=startAtDate, start_at_time=startAtTime, end_at=endAt, image=image, active_page='event',
-    image_alt_text=imageAltText, is_host=is_host, remaining=remaining, sold_qty=sold_qty,)
+    return render_template('event.html', event_id=event_id, host_email=row.host_email,
+    title=e.title, status=status, price=row.min_price, description=e.description, category=row.tag_name, format_type = e.event_type, capacity=capacity,
+    host_name=row.host_name, start_at_date=startAtDate, start_at_time=startAtTime, end_at=endAt, image=row.image_url, active_page='event',
+    image_variants=row.image_variants, image_alt_text=row.image_alt, is_host=is_host, remaining=remaining, sold_qty=sold_qty,
+    updated_at=e.updated_at,)
 
 @events_bp.route('/update/<int:event_id>', methods=['GET', 'POST'])
 @login_required
@@ -145,19 +207,23 @@ def update(event_id):
     if form.validate_on_submit():
         if form.event_image.data:
             #delete old image
-            old_image_path = event_image.url
-            if old_image_path:
-                old_image_full_path = os.path.join(os.path.dirname(__file__), old_image_path.lstrip("/"))
-                if os.path.exists(old_image_full_path):
-                    os.remove(old_image_full_path)
+            #(garbage collected once nothing references it, see uploads.py)
+            uploads.release(event_image.url)
             #upload new image
             db_file_path = check_upload_file(form)  
             event_image.url = db_file_path
+            event_image.variants = None
+            #resized variants are built in the background
+            if db_file_path:
+                uploads.retain(db_file_path)
+                images.queue_variants(event_image)
         else:
             form.event_image.data = db.session.execute(db.select(Event_Image.url).where(Event_Image.event_id==event.id)).scalar_one()
         
         event.cancelled = False
         event.is_active = True
+        # bumped even when only the tag/price/image changed, so cached pages (ETags) refresh
+        event.updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
         msg = "Event updated."
         cat = "success"
         
@@ -193,6 +259,7 @@ def update(event_id):
         db.session.add(event_tag)
         db.session.add(ticket_type)
         db.session.commit()
+        event_changed.send(event_id)
         flash(msg, cat)
         return redirect(url_for('events.my_events'))
     
@@ -276,7 +343,13 @@ def createUpdate():
         db.session.add(event_img)
         db.session.add(event_tag)
         db.session.add(ticket_type)
+        #resized image variants are built in the background after the commit
+        if db_file_path:
+            uploads.retain(db_file_path)
+            db.session.flush()
+            images.queue_variants(event_img)
         db.session.commit()
+        event_changed.send(event.id)
         
         flash("Event published.", "success")
 
@@ -293,6 +366,7 @@ def createUpdate():
 
 @events_bp.route("/my-events")
 @login_required
+@replica_reads
 def my_events():
     # read query params
     view  = (request.args.get("view") or "grid").strip()
@@ -307,17 +381,21 @@ def my_events():
     status_selected   = request.args.getlist("status")
     category_selected = request.args.getlist("category")
 
-    # base query with metrics
+    page              = max((request.args.get("page", 1, type=int) or 1), 1)
+    per_page          = min(max((request.args.get("per_page", 24, type=int) or 24), 1), 100)
+
+    # base query with metrics; filters, status and paging all run in SQL
+    sold_col = Event.sold_qty
+    status_col = listing.status_expr(sold_col)
+
     qry = (
         db.session.query(
             Event,
-            func.min(cast(TicketType.price, Float)).label("min_price"),
-            func.coalesce(func.sum(Booking.qty), 0).label("sold_count"),
+            sold_col.label("sold_count"),
+            status_col.label("status"),
         )
-        .outerjoin(TicketType, TicketType.event_id == Event.id)
-        .outerjoin(Booking, Booking.event_id == Event.id)
         .filter(Event.host_user_id == current_user.id)
-        .group_by(Event.id)
+        .options(selectinload(Event.images))
     )
     
     filters_cleared = not (q_text or status_selected or category_selected or (price_min is not None) or (price_max is not None))
@@ -334,91 +412,58 @@ def my_events():
     if fmt:
         qry = qry.filter(Event.event_type == fmt)
 
-    # sorting
-    if sort == "upcoming":
-        qry = qry.order_by((Event.start_at == None).asc(), Event.start_at.asc())
-    elif sort == "created":
-        qry = qry.order_by(Event.created_at.desc())
-    elif sort == "title":
-        qry = qry.order_by(func.lower(Event.title).asc())
+    # search
+    if q_text:
+        qry = qry.filter(Event.title.ilike(f"%{q_text}%"))
+
+    # status (OR), compared the way the checkboxes send it: "Sold Out" -> "soldout"
+    if status_selected:
+        status_allow_set = {s.lower().replace(" ", "") for s in status_selected}
+        qry = qry.filter(func.replace(func.lower(status_col), " ", "").in_(status_allow_set))
+
+    # categories (OR)
+    if category_selected:
+        qry = qry.filter(or_(*[listing.category_filter(c) for c in category_selected]))
+
+    # price range (only then is the ticket price aggregate joined)
+    if price_min is not None or price_max is not None:
+        price_sq = listing.price_subquery()
+        price_expr = func.coalesce(price_sq.c.min_price, 0.0)
+        qry = qry.outerjoin(price_sq, price_sq.c.event_id == Event.id)
+    if price_min is not None:
+        qry = qry.filter(price_expr >= price_min)
+    if price_max is not None:
+        qry = qry.filter(price_expr <= price_max)
+
+    # sorting + paging (?cursor= for keyset paging, page/per_page otherwise)
+    keys = listing.host_sort_keys(sort)
+    cursor_mode = "cursor" in request.args
+    prev_cursor = next_cursor = None
+    if cursor_mode:
+        scope = f"mine:{sort}"
+        cursor = listing.decode_cursor(request.args.get("cursor"), scope)
+        rows, prev_cursor, next_cursor = listing.keyset_page(qry, keys, per_page, cursor, scope)
+        total, pages = None, 1
     else:
-        qry = qry.order_by((Event.start_at == None).asc(), Event.start_at.asc())
+        rows, total, pages = listing.paginate(listing.apply_order(qry, keys), page, per_page)
 
-    rows = qry.all()
+    events = [e for (e, _, _) in rows]
 
-    # metrics/status for all rows
-    metrics = {}
-    for e, mp, sold in rows:
-        sold = int(sold or 0)
-        if e.cancelled:
-            status = "Cancelled"
-        else:
-            # default Open until checks change it
-            status = "Open"
+    # cached per-event aggregates for the displayed rows
+    prices = listing.min_prices([e.id for e in events])
+    tags_map: dict[int, list[str]] = listing.tags_for([e.id for e in events])
 
-            # Sold Out
-            if e.capacity is not None and (sold or 0) >= e.capacity:
-                status = "Sold Out"
-
-            # Inactive when the start time has been reached
-            if status == "Open" and _has_started(e.start_at):
-                status = "Inactive"
-                
+    # metrics/status for displayed rows
+    metrics = {}
+    for e, sold, status in rows:
         metrics[e.id] = {
-            "min_price": float(mp or 0.0),
-            "sold": sold,
+            "min_price": prices.get(e.id, 0.0),
+            "sold": int(sold or 0),
             "status": status,
         }
 
     # categories list
-    all_categories = [name for (name,) in db.session.query(Tag.name).order_by(Tag.name).all()]
-
-    # tags map
-    tags_by_event_all: dict[int, list[str]] = {}
-    if rows:
-        all_event_ids = [e.id for (e, _, _) in rows]
-        tag_rows = (
-            db.session.query(Event_Tag.event_id, Tag.name)
-            .join(Tag, Tag.id == Event_Tag.tag_id)
-            .filter(Event_Tag.event_id.in_(all_event_ids))
-            .all()
-        )
-        for eid, name in tag_rows:
-            tags_by_event_all.setdefault(eid, []).append(name)
-
-    # apply filters (search, status multi, category multi, price range)
-    filtered_events = []
-    status_allow_set = {s.lower().replace(" ", "") for s in status_selected} if status_selected else set()
-
-    for e, _, _ in rows:
-        m = metrics[e.id]
-
-        # search
-        if q_text and q_text.lower() not in (e.title or "").lower():
-            continue
-
-        # status (OR)
-        if status_allow_set and m["status"].lower().replace(" ", "") not in status_allow_set:
-            continue
-
-        # categories (OR)
-        if category_selected:
-            ev_cats = set(tags_by_event_all.get(e.id, []))
-            if not ev_cats.intersection(category_selected):
-                continue
-
-        # price range
-        if price_min is not None and m["min_price"] < price_min:
-            continue
-        if price_max is not None and m["min_price"] > price_max:
-            continue
-
-        filtered_events.append(e)
-
-    events = filtered_events
-
-    # tags map for displayed events only
-    tags_map: dict[int, list[str]] = {e.id: tags_by_event_all.get(e.id, []) for e in events}
+    all_categories = listing.all_tag_names()
 
     return render_template(
         "my-events.html",
@@ -436,8 +481,64 @@ def my_events():
         status_selected=status_selected,
         category_selected=category_selected,
         all_categories=all_categories,
+        page=page,
+        per_page=per_page,
+        total=total,
+        pages=pages,
+        base_qs=listing.page_query_string(request.args),
+        cursor_mode=cursor_mode,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+    )
+
+@events_bp.cli.command("reindex")
+def reindex_command():
+    """Rebuild the full-text search index from the events table."""
+    if not search.enabled():
+        raise click.ClickException("Full-text search (SQLite FTS5) isn't available; search uses ILIKE.")
+    count = search.rebuild_index(db.engine)
+    click.echo(f"Search index rebuilt: {count} event(s) indexed.")
+
+@events_bp.cli.command("import")
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), help="Default: from the file extension.")
+@click.option("--host", help="User name or email for records without a host.")
+@click.option("--create-tags", is_flag=True, help="Add tags that don't exist yet instead of rejecting the record.")
+@click.option("--batch-size", default=1000, show_default=True, help="Events per transaction.")
+def import_command(path, fmt, host, create_tags, batch_size):
+    """Bulk-insert events (with tags, images, ticket types) from a CSV or JSON lines file ("-" for stdin)."""
+    try:
+        fmt = bulk.format_for(path, fmt)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    with click.open_file(path, encoding="utf-8") as stream:
+        result = bulk.import_events(stream, fmt, host, create_tags, batch_size)
+    for number, message in result.errors[:20]:
+        click.echo(f"line {number}: {message}", err=True)
+    if len(result.errors) > 20:
+        click.echo(f"... and {len(result.errors) - 20} more", err=True)
+    click.echo(
+        f"Imported {result.events} event(s), {result.tickets} ticket type(s), {result.images} image(s), "
+        f"{result.tags} tag link(s) in {result.seconds:.1f}s ({result.rate:,.0f} events/s); "
+        f"skipped {len(result.errors)} invalid record(s)."
     )
 
+@events_bp.cli.command("export")
+@click.argument("path", default="-")
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), help="Default: from the file extension, jsonl for stdout.")
+@click.option("--batch-size", default=1000, show_default=True, help="Events fetched per round trip.")
+def export_command(path, fmt, batch_size):
+    """Stream every event to a CSV or JSON lines file (default stdout), in the format import reads."""
+    try:
+        fmt = bulk.format_for(path, fmt or ("jsonl" if path == "-" else None))
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    started = time.perf_counter()
+    with click.open_file(path, "w", encoding="utf-8") as out:
+        count = bulk.export_events(out, fmt, batch_size)
+    elapsed = time.perf_counter() - started
+    click.echo(f"Exported {count} event(s) in {elapsed:.1f}s.", err=True)
+
 @events_bp.post("/event/<int:event_id>/action")
 @login_required
 def event_action(event_id):
@@ -464,4 +565,5 @@ def event_action(event_id):
         return redirect(url_for("events.my_events", view=request.args.get("view", "table")))
 
     db.session.commit()
+    event_changed.send(event_id)
     return redirect(url_for("events.my_events", view=request.args.get("view", "table")))
\ No newline at end of file
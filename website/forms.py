@@ -6,6 +6,7 @@ from werkzeug.utils import secure_filename
 from flask_wtf.file import FileAllowed
 from wtforms import HiddenField
 import os, time, uuid
+from . import uploads
 
 # creates the login information
 class LoginForm(FlaskForm):
@@ -86,20 +87,8 @@ def check_upload_file(form):
     if ext not in ALLOWED:
         return None
 
-    # unique filename to avoid collisions / caching issues
-    unique_name = f"{root}_{int(time.time())}_{uuid.uuid4().hex[:6]}{ext}"
-    
-    
-    # get the current path of the module file… store image file relative to this path  
-    BASE_PATH = os.path.dirname(__file__)
-    # upload file location – directory of this file/static/img
-    upload_dir = os.path.join(BASE_PATH, 'static', 'uploads')
-    os.makedirs(upload_dir, exist_ok=True)
-    # store relative path in DB as image location in HTML is relative
-    upload_path = os.path.join(upload_dir, unique_name)
-    # save the file and return the db upload path  
-    fp.save(upload_path)
-    return f"/static/uploads/{unique_name}"
+    # stored once per distinct content (see uploads.py); returns the "/media/..." url
+    return uploads.save(fp, filename)
 
 
 class ProfileForm(FlaskForm):
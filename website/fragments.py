@@ -0,0 +1,204 @@
+from flask import current_app, has_app_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from threading import Lock
+import hashlib
+from .cache import TTLCache, event_changed
+
+try:
+    import redis
+except ImportError:  # only needed for the shared backend
+    redis = None
+
+# Rendered-fragment cache. In a template:
+#
+#   {% cache "event-card", e.id, e.updated_at, r.sold_count, r.status %} ... {% endcache %}
+#
+# caches the block's HTML under the name, the event id and every value after
+# it. Anything the block shows should be part of the key, so a change to any
+# of it is simply a new key; all of an event's fragments are also dropped when
+# event_changed fires for it (edits, publish/cancel, bookings, new images).
+
+
+class LocalFragments:
+    """In-process LRU (per worker) with a per-event index for invalidation."""
+
+    def __init__(self, maxsize=2048, ttl=600):
+        self.cache = TTLCache(maxsize, ttl)
+        self._tags = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, html, tag):
+        self.cache.set(key, html)
+        with self._lock:
+            # keys the LRU evicted linger here until the event changes; a few per event
+            self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate(self, tag):
+        with self._lock:
+            keys = self._tags.pop(tag, ())
+        self.cache.delete(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._tags.clear()
+        self.cache.clear()
+
+    def stats(self):
+        return {"backend": "local", **self.cache.stats()}
+
+
+class RedisFragments:
+    """
+    Shared by every worker, so an invalidation reaches all of them. `client` can
+    be any object with the redis-py API (e.g. fakeredis as a local stand-in).
+    """
+
+    def __init__(self, url=None, ttl=600, prefix="frag:", client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("the redis fragment cache needs redis (pip install redis)")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def set(self, key, html, tag):
+        tag_key = self.prefix + "tag:" + tag
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, html.encode("utf-8"), ex=self.ttl)
+        pipe.sadd(tag_key, self.prefix + key)
+        pipe.expire(tag_key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, tag):
+        tag_key = self.prefix + "tag:" + tag
+        keys = self.client.smembers(tag_key)
+        self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "redis",
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+class NullFragments:
+    """FRAGMENT_CACHE_BACKEND = "none": always render."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, html, tag):
+        pass
+
+    def invalidate(self, tag):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {"backend": "none"}
+
+
+def from_config(app):
+    """Build the backend named by FRAGMENT_CACHE_BACKEND ("local", "redis" or "none")."""
+    backend = app.config.get("FRAGMENT_CACHE_BACKEND", "local")
+    ttl = app.config.get("FRAGMENT_CACHE_TTL", 600)
+    if backend == "local":
+        return LocalFragments(app.config.get("FRAGMENT_CACHE_SIZE", 2048), ttl)
+    if backend == "redis":
+        return RedisFragments(app.config["FRAGMENT_CACHE_URL"], ttl)
+    if backend == "none":
+        return NullFragments()
+    raise ValueError(f"unknown FRAGMENT_CACHE_BACKEND {backend!r}")
+
+
+def backend():
+    return current_app.extensions["fragment_cache"]
+
+
+def _tag(event_id):
+    return f"event:{event_id}"
+
+
+def fragment_key(name, event_id, parts):
+    # the deploy salt keeps a shared cache from serving markup of older templates
+    digest = hashlib.sha256(repr((current_app.extensions["conditional_salt"], parts)).encode("utf-8"))
+    return f"{name}:{event_id}:{digest.hexdigest()[:24]}"
+
+
+def cached(name, event_id, parts, render):
+    """The cached HTML for (name, event_id, parts), calling render() to build it on a miss."""
+    key = fragment_key(name, event_id, parts)
+    html = backend().get(key)
+    if html is None:
+        html = str(render())
+        backend().set(key, html, _tag(event_id))
+    return Markup(html)
+
+
+def invalidate(event_id):
+    backend().invalidate(_tag(event_id))
+
+
+def stats():
+    return backend().stats()
+
+
+@event_changed.connect
+def _drop_event_fragments(event_id, **kwargs):
+    if has_app_context() and "fragment_cache" in current_app.extensions:
+        invalidate(event_id)
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache name, event_id, *key_parts %} ... {% endcache %}"""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        if len(args) < 2:
+            parser.fail("cache needs a name and an event id", lineno)
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        call = self.call_method("_render", [args[0], args[1], nodes.List(args[2:])])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, name, event_id, parts, caller):
+        return cached(name, event_id, tuple(parts), caller)
+
+
+def init_app(app):
+    app.extensions["fragment_cache"] = from_config(app)
+    app.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,258 @@
+from flask import current_app
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+from sqlalchemy import update
+import click, os, shutil, tempfile
+from . import db, jobs, uploads
+from .assets import asset_url
+from .cache import event_changed
+from .models import Blob, Event_Image, User
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pillow missing: uploads are kept and served as-is
+    Image = None
+
+# resized copies made for every upload: name -> bounding box (w, h).
+# Aspect ratio is kept; images are only ever scaled down.
+EVENT_VARIANTS = {
+    "thumb": (160, 120),    # booking history rows
+    "card": (640, 480),     # home / my-events grid cards (~300-420px wide, 1.5-2x density)
+    "hero": (1600, 1200),   # event page
+}
+PROFILE_VARIANTS = {
+    "avatar_sm": (96, 96),
+    "avatar": (280, 280),   # 140px circle on the profile page at 2x
+}
+
+_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+# every variant is written as WebP with a JPEG fallback for older browsers
+FORMATS = (
+    ("webp", "WEBP", {"quality": 80, "method": 4}),
+    ("jpg", "JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+)
+
+
+
+def _open_clean(path):
+    with Image.open(path) as original:
+        fmt = original.format
+        # apply the EXIF orientation before the EXIF block is dropped
+        img = ImageOps.exif_transpose(original)
+        img.load()
+    # dropping .info means nothing (exif, icc_profile, xmp, comments) is written back
+    img.info = {}
+    return img, fmt
+
+
+def _flatten(img):
+    if img.mode not in ("RGB", "L"):
+        # flatten transparency onto white, JPEG has no alpha
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        rgba = img.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        img = background
+    return img.convert("RGB")
+
+
+# the two steps below need no app context, so jobs.run_cpu can run them in a worker process
+
+def _strip(path, workdir):
+    """Re-encode `path` without metadata into workdir; returns the new file's path or None."""
+    try:
+        img, fmt = _open_clean(path)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    # named by the real format, so the same picture uploaded as .png / .jpeg dedupes too
+    out = os.path.join(workdir, "clean." + _EXTENSIONS.get(fmt, fmt.lower()))
+    options = {"quality": 90} if fmt in ("JPEG", "WEBP") else {}
+    img.save(out, fmt, **options)
+    return out
+
+
+def _resize(path, sizes, workdir):
+    """Write every size as WebP + JPEG into workdir; returns {name: {"w", "h", "webp", "jpg"}} of paths."""
+    img = _flatten(_open_clean(path)[0])
+    made = {}
+    for name, box in sizes.items():
+        resized = img.copy()
+        resized.thumbnail(box, Image.LANCZOS)
+        entry = {"w": resized.width, "h": resized.height}
+        for ext, fmt, options in FORMATS:
+            out = os.path.join(workdir, f"{name}.{ext}")
+            # a fresh image carries no exif/icc/xmp, so nothing is copied across
+            resized.save(out, fmt, **options)
+            entry[ext] = out
+        made[name] = entry
+    return made
+
+
+def process(url, sizes, force=False):
+    """
+    Strip the metadata from a stored upload and build its resized variants.
+    The cleaned image is stored as its own blob and owns the variants, so an
+    image uploaded twice is only resized once. Returns (clean url, variants for
+    `sizes`), or None for urls outside storage / unreadable images / no pillow.
+    """
+    key = uploads.key_for(url)
+    if key is None or Image is None:
+        return None
+    workdir = tempfile.mkdtemp(prefix="images-")
+    try:
+        with uploads.backend().local_file(key) as src:
+            clean = jobs.run_cpu(_strip, src, workdir)
+        if clean is None:
+            return None
+        clean_url = uploads.store_file(clean)
+        blob = db.session.get(Blob, uploads.key_for(clean_url))
+        variants = dict(blob.variants or {})
+        missing = sizes if force else {n: box for n, box in sizes.items() if n not in variants}
+        if missing:
+            made = jobs.run_cpu(_resize, clean, missing, workdir)
+            for name, entry in made.items():
+                stored = {"w": entry["w"], "h": entry["h"]}
+                for ext, _, _ in FORMATS:
+                    stored[ext] = uploads.put_derived(f"variants/{blob.sha256}_{name}.{ext}", entry[ext])
+                variants[name] = stored
+            blob.variants = variants
+        return clean_url, {name: variants[name] for name in sizes}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# background jobs: uploads are saved in the request, everything else runs after commit
+
+def queue_variants(image):
+    """Build an Event_Image's variants once the current transaction commits (image must be flushed)."""
+    jobs.enqueue("images.event_variants", image_id=image.id, url=image.url)
+
+
+def queue_profile_variants(user):
+    """Same for a user's profile picture."""
+    jobs.enqueue("images.profile_variants", user_id=user.id, path=user.profile_pic_path)
+
+
+def _swap(model, row_id, column, variants_column, url, sizes, force=False):
+    # point the row at the cleaned image, unless it was changed while we worked
+    result = process(url, sizes, force)
+    if result is None:
+        return False
+    clean_url, variants = result
+    swapped = db.session.execute(
+        update(model)
+        .where(model.id == row_id, column == url)
+        .values({column: clean_url, variants_column: variants})
+    ).rowcount
+    if swapped and clean_url != url:
+        uploads.retain(clean_url)
+        uploads.release(url)
+    db.session.commit()
+    return bool(swapped)
+
+
+@jobs.handler("images.event_variants")
+def _event_variants_job(image_id, url, force=False):
+    if _swap(Event_Image, image_id, Event_Image.url, Event_Image.variants, url, EVENT_VARIANTS, force):
+        event_id = db.session.execute(db.select(Event_Image.event_id).where(Event_Image.id == image_id)).scalar()
+        event_changed.send(event_id)
+
+
+@jobs.handler("images.profile_variants")
+def _profile_variants_job(user_id, path, force=False):
+    _swap(User, user_id, User.profile_pic_path, User.profile_pic_variants, path, PROFILE_VARIANTS, force)
+
+
+# templates
+
+def static_src(path):
+    """
+    Image url for a stored path: uploads ("/media/...") via the storage backend,
+    bundled files ("/static/..." or relative to static/) via their fingerprinted
+    copy, other absolute urls as-is.
+    """
+    if not path:
+        return ""
+    if uploads.key_for(path):
+        return uploads.public_url(path)
+    static_prefix = current_app.static_url_path + "/"
+    if path.startswith(static_prefix):
+        return asset_url(path[len(static_prefix):])
+    if path.startswith("/") or "://" in path:
+        return path
+    return asset_url(path)
+
+
+def variant_url(variants, name, fallback=None, ext="jpg"):
+    """Url of one variant, or of `fallback` (the original) when it wasn't generated."""
+    entry = (variants or {}).get(name)
+    if entry and entry.get(ext):
+        return static_src(entry[ext])
+    return static_src(fallback)
+
+
+def responsive_img(src, variants=None, use=("card", "hero"), sizes="100vw", alt="", **attrs):
+    """
+    <picture> with a WebP srcset and a JPEG <img> fallback built from the named
+    variants, so the browser downloads the smallest copy that fits `sizes`.
+    Without variants it's a plain <img> of `src`. Extra keyword arguments become
+    attributes of the <img> (class_ for class).
+    """
+    entries = [variants[name] for name in use if variants and name in variants]
+    attrs = {k.rstrip("_").replace("_", "-"): v for k, v in attrs.items() if v is not None}
+    attrs.setdefault("loading", "lazy")
+    attrs.setdefault("decoding", "async")
+
+    def render_attrs(values):
+        return "".join(f' {k}="{escape(v)}"' for k, v in values.items())
+
+    if not entries:
+        return Markup(f'<img src="{escape(static_src(src))}" alt="{escape(alt)}"{render_attrs(attrs)}>')
+
+    entries.sort(key=lambda e: e["w"])
+    # src (for browsers without srcset) and the intrinsic size come from the largest copy
+    largest = entries[-1]
+
+    def srcset(ext):
+        return ", ".join(f"{static_src(e[ext])} {e['w']}w" for e in entries)
+
+    img_attrs = {"width": largest["w"], "height": largest["h"], **attrs}
+    return Markup(
+        # display: contents keeps the <img> laid out as if it were the direct child
+        '<picture style="display: contents">'
+        f'<source type="image/webp" srcset="{escape(srcset("webp"))}" sizes="{escape(sizes)}">'
+        f'<img src="{escape(static_src(largest["jpg"]))}" srcset="{escape(srcset("jpg"))}" '
+        f'sizes="{escape(sizes)}" alt="{escape(alt)}"{render_attrs(img_attrs)}>'
+        "</picture>"
+    )
+
+
+# backfill
+
+@click.command("images")
+@click.option("--force", is_flag=True, help="Rebuild variants that already exist.")
+@with_appcontext
+def images_command(force):
+    """Build resized WebP/JPEG variants for stored event images and profile pictures."""
+    if Image is None:
+        raise click.ClickException("Pillow is not installed (pip install pillow).")
+
+    done = skipped = 0
+    rows = [(_event_variants_job, img.id, img.url, img.variants) for img in db.session.query(Event_Image).all()]
+    rows += [(_profile_variants_job, u.id, u.profile_pic_path, u.profile_pic_variants)
+             for u in db.session.query(User).filter(User.profile_pic_path != None).all()]
+    for job, row_id, url, variants in rows:
+        if (variants and not force) or not uploads.key_for(url):
+            skipped += 1
+            continue
+        job(row_id, url, force)
+        done += 1
+    click.echo(f"Processed {done} image(s), skipped {skipped} "
+               "(images outside storage need flask uploads import first).")
+
+
+def init_app(app):
+    app.add_template_global(responsive_img)
+    app.add_template_global(variant_url)
+    app.add_template_global(static_src)
+    app.cli.add_command(images_command)
@@ -0,0 +1,362 @@
+from flask import current_app
+from flask.cli import AppGroup
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from sqlalchemy import event, func, update
+from sqlalchemy.orm import Session
+from threading import BoundedSemaphore, Event as ThreadEvent, Lock, Thread
+import atexit, click, random
+from . import db
+from .models import Job, JobStatusEnum
+
+# Work that shouldn't hold up a request (image transcoding, deleting replaced
+# files, notifications) is written to the jobs table in the same transaction as
+# the change that caused it, so a job exists exactly when that change commits.
+# After the commit a bounded pool of worker threads picks it up; failures are
+# retried with exponential backoff. Jobs survive restarts: whatever is still
+# queued (or was running when the process died) is picked up again.
+
+_handlers = {}
+
+
+def handler(kind):
+    """Register the function that runs jobs of `kind`; it's called with the payload as kwargs."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+def _now():
+    # naive UTC, the same clock as the CURRENT_TIMESTAMP server defaults
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue(kind, delay=0, max_attempts=None, **payload):
+    """
+    Add a job to the current session; it's committed (and run) with the caller's
+    transaction. The payload must be JSON-serialisable.
+    """
+    job = Job(
+        kind=kind,
+        payload=payload,
+        status=JobStatusEnum.QUEUED,
+        attempts=0,
+        max_attempts=max_attempts or current_app.config.get("JOBS_MAX_ATTEMPTS", 5),
+        run_after=_now() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    db.session.info["jobs_enqueued"] = True
+    return job
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_after_commit(session):
+    if session.info.pop("jobs_enqueued", False):
+        runner = current_app.extensions.get("jobs")
+        if runner is not None:
+            runner.wake()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop("jobs_enqueued", None)
+
+
+def backoff(attempts):
+    """Seconds to wait before retry number `attempts`: exponential, capped, with jitter."""
+    base = current_app.config.get("JOBS_BACKOFF", 2.0)
+    delay = min(base * (2 ** (attempts - 1)), current_app.config.get("JOBS_BACKOFF_MAX", 600.0))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def recover_stale():
+    """Requeue jobs left RUNNING by a worker that died; returns how many."""
+    cutoff = _now() - timedelta(seconds=current_app.config.get("JOBS_LOCK_TIMEOUT", 600))
+    result = db.session.execute(
+        update(Job)
+        .where(Job.status == JobStatusEnum.RUNNING, Job.locked_at < cutoff)
+        .values(status=JobStatusEnum.QUEUED, locked_at=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claim_next(ignore_schedule=False):
+    """
+    Atomically move the next due job from QUEUED to RUNNING and return its id
+    (None when nothing is due). The conditional UPDATE means two workers, even in
+    different processes, can never claim the same job.
+    """
+    now = _now()
+    for _ in range(5):
+        qry = db.session.query(Job.id).filter(Job.status == JobStatusEnum.QUEUED)
+        if not ignore_schedule:
+            qry = qry.filter(Job.run_after <= now)
+        job_id = qry.order_by(Job.run_after, Job.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == JobStatusEnum.QUEUED)
+            .values(status=JobStatusEnum.RUNNING, attempts=Job.attempts + 1, locked_at=now)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def run_job(job_id):
+    """
+    Run one claimed job. Handlers may commit their own work; the job is then
+    marked DONE, or on error requeued with backoff until max_attempts is reached.
+    Returns the final status.
+    """
+    job = db.session.get(Job, job_id)
+    fn = _handlers.get(job.kind)
+    try:
+        if fn is None:
+            raise LookupError(f"no handler for job kind {job.kind!r}")
+        fn(**(job.payload or {}))
+        job = db.session.get(Job, job_id)
+        job.status = JobStatusEnum.DONE
+        job.finished_at = _now()
+        job.last_error = None
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.last_error = f"{type(exc).__name__}: {exc}"[:2000]
+        if job.attempts >= job.max_attempts:
+            job.status = JobStatusEnum.FAILED
+            job.finished_at = _now()
+            current_app.logger.error("job %s (%s) failed for good: %s", job.id, job.kind, job.last_error)
+        else:
+            job.status = JobStatusEnum.QUEUED
+            job.run_after = _now() + timedelta(seconds=backoff(job.attempts))
+            current_app.logger.warning("job %s (%s) attempt %s failed, retrying: %s",
+                                       job.id, job.kind, job.attempts, job.last_error)
+        job.locked_at = None
+        db.session.commit()
+    return job.status
+
+
+def drain(ignore_schedule=False, limit=None):
+    """Run due jobs in the calling thread until none are left; returns how many ran."""
+    recover_stale()
+    ran = 0
+    while limit is None or ran < limit:
+        job_id = claim_next(ignore_schedule)
+        if job_id is None:
+            break
+        run_job(job_id)
+        ran += 1
+    return ran
+
+
+def run_cpu(fn, *args):
+    """
+    Run a CPU-heavy, picklable function in the process pool when JOBS_PROCESSES
+    is set, otherwise in the calling worker thread. Returns its result.
+    """
+    runner = current_app.extensions.get("jobs")
+    pool = runner.process_pool() if runner is not None else None
+    if pool is None:
+        return fn(*args)
+    return pool.submit(fn, *args).result()
+
+
+class JobRunner:
+    """
+    Dispatcher thread + bounded worker thread pool for one app. Started lazily
+    (first commit that queues a job, or first request), so CLI commands and
+    scripts that never touch the queue don't spin up threads.
+    """
+
+    def __init__(self, app, workers=2, processes=0, poll_interval=5.0):
+        self.app = app
+        self.workers = workers
+        self.processes = processes
+        self.poll_interval = poll_interval
+        self._wake = ThreadEvent()
+        self._stop = ThreadEvent()
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max(workers, 1))
+        self._threads = None
+        self._processes = None
+        self._dispatcher = None
+
+    def start(self):
+        if self.workers <= 0 or self._dispatcher is not None:
+            return
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jobs")
+            self._dispatcher = Thread(target=self._loop, name="jobs-dispatcher", daemon=True)
+            self._dispatcher.start()
+            atexit.register(self.stop)
+
+    def after_fork(self):
+        # in a forked child: forget the parent's threads and pools; start() makes new ones
+        self._wake = ThreadEvent()
+        self._stop = ThreadEvent()
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max(self.workers, 1))
+        self._threads = None
+        self._processes = None
+        self._dispatcher = None
+
+    def process_pool(self):
+        if self.processes <= 0:
+            return None
+        with self._lock:
+            if self._processes is None:
+                # spawn: forking a process that has threads running isn't safe
+                self._processes = ProcessPoolExecutor(max_workers=self.processes, mp_context=get_context("spawn"))
+            return self._processes
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if wait and self._dispatcher is not None:
+            self._dispatcher.join()
+        if self._threads is not None:
+            self._threads.shutdown(wait=wait)
+        if self._processes is not None:
+            self._processes.shutdown(wait=wait)
+
+    def _loop(self):
+        with self.app.app_context():
+            recover_stale()
+        while not self._stop.is_set():
+            # wait for a free worker before claiming, so claimed jobs never sit in a backlog
+            self._slots.acquire()
+            try:
+                with self.app.app_context():
+                    job_id = claim_next()
+            except Exception:
+                self.app.logger.exception("job dispatcher could not claim a job")
+                job_id = None
+            if job_id is None:
+                self._slots.release()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            try:
+                self._threads.submit(self._run, job_id)
+            except RuntimeError:
+                # the pool was shut down (process exiting): hand the job back instead of
+                # leaving it RUNNING until the lock times out
+                self._slots.release()
+                with self.app.app_context():
+                    db.session.execute(
+                        update(Job)
+                        .where(Job.id == job_id, Job.status == JobStatusEnum.RUNNING)
+                        .values(status=JobStatusEnum.QUEUED, attempts=Job.attempts - 1, locked_at=None)
+                    )
+                    db.session.commit()
+                break
+
+    def _run(self, job_id):
+        try:
+            with self.app.app_context():
+                run_job(job_id)
+        except Exception:
+            self.app.logger.exception("job %s crashed the worker", job_id)
+        finally:
+            self._slots.release()
+            # there may be more due work queued behind this one
+            self._wake.set()
+
+
+# CLI
+
+jobs_cli = AppGroup("jobs", help="Inspect and run background jobs.")
+
+
+@jobs_cli.command("list")
+@click.option("--status", type=click.Choice([s.value for s in JobStatusEnum], case_sensitive=False))
+@click.option("--limit", default=20, show_default=True)
+def list_command(status, limit):
+    """Show the most recent jobs."""
+    qry = db.session.query(Job)
+    if status:
+        qry = qry.filter(Job.status == status.upper())
+    for job in qry.order_by(Job.id.desc()).limit(limit).all():
+        error = f"  {job.last_error}" if job.last_error else ""
+        click.echo(f"{job.id:>6}  {job.status.value:<8} {job.kind:<28} "
+                   f"attempts {job.attempts}/{job.max_attempts}  run_after {job.run_after:%Y-%m-%d %H:%M:%S}{error}")
+
+
+@jobs_cli.command("stats")
+def stats_command():
+    """Count jobs per status."""
+    counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    for status in JobStatusEnum:
+        click.echo(f"{status.value:<8} {counts.get(status, 0)}")
+
+
+@jobs_cli.command("drain")
+@click.option("--all", "ignore_schedule", is_flag=True, help="Also run jobs still waiting out a retry backoff.")
+@click.option("--limit", type=int, help="Stop after this many jobs.")
+def drain_command(ignore_schedule, limit):
+    """Run queued jobs in the foreground until the queue is empty."""
+    ran = drain(ignore_schedule, limit)
+    click.echo(f"Ran {ran} job(s).")
+
+
+@jobs_cli.command("retry")
+@click.argument("job_ids", nargs=-1, type=int)
+@click.option("--failed", "all_failed", is_flag=True, help="Requeue every failed job.")
+def retry_command(job_ids, all_failed):
+    """Requeue failed jobs with a fresh set of attempts."""
+    qry = update(Job).where(Job.status == JobStatusEnum.FAILED)
+    if not all_failed:
+        if not job_ids:
+            raise click.UsageError("Give job ids or --failed.")
+        qry = qry.where(Job.id.in_(job_ids))
+    count = db.session.execute(
+        qry.values(status=JobStatusEnum.QUEUED, attempts=0, run_after=_now(), finished_at=None)
+    ).rowcount
+    db.session.commit()
+    click.echo(f"Requeued {count} job(s).")
+
+
+@jobs_cli.command("purge")
+@click.option("--days", default=7, show_default=True, help="Delete finished jobs older than this.")
+@click.option("--include-failed", is_flag=True)
+def purge_command(days, include_failed):
+    """Delete old finished jobs."""
+    statuses = [JobStatusEnum.DONE] + ([JobStatusEnum.FAILED] if include_failed else [])
+    cutoff = _now() - timedelta(days=days)
+    count = (
+        db.session.query(Job)
+        .filter(Job.status.in_(statuses), Job.finished_at < cutoff)
+        .delete(synchronize_session=False)
+    )
+    db.session.commit()
+    click.echo(f"Deleted {count} job(s).")
+
+
+def init_app(app):
+    runner = JobRunner(
+        app,
+        workers=app.config.get("JOBS_WORKERS", 2),
+        processes=app.config.get("JOBS_PROCESSES", 0),
+        poll_interval=app.config.get("JOBS_POLL_INTERVAL", 5.0),
+    )
+    app.extensions["jobs"] = runner
+    app.cli.add_command(jobs_cli)
+
+    # pick up anything left queued from a previous run once the app serves traffic
+    @app.before_request
+    def _start_jobs():
+        runner.start()
@@ -0,0 +1,368 @@
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, or_, cast, Float, case, exists, and_, type_coerce, String, DateTime
+from urllib.parse import urlencode
+import base64, binascii, hashlib, hmac, json
+from . import db, search
+from .cache import aggregate_cache
+from .models import Event, Event_Image, Event_Tag, Tag, TicketType
+
+# statuses shown on the home page, in the order the filters list them
+STATUSES = ("Open", "Sold Out", "Cancelled", "Inactive")
+
+# sorts that order by the cheapest ticket price
+PRICE_SORTS = ("priceLowHigh", "priceHighLow")
+
+
+def price_subquery():
+    """
+    MIN(ticket price) per event, pre-grouped so it can be outer joined onto events.
+    """
+    return (
+        db.session.query(
+            TicketType.event_id.label("event_id"),
+            func.min(cast(TicketType.price, Float)).label("min_price"),
+        )
+        .group_by(TicketType.event_id)
+        .subquery()
+    )
+
+
+def status_expr(sold_col, now=None):
+    """
+    SQL version of the Cancelled / Sold Out / Inactive / Open rules used on the listing.
+    Start times are stored naive, so they are compared with the server's local time.
+    """
+    now = now or datetime.now()
+    return case(
+        (Event.cancelled == True, "Cancelled"),
+        (and_(Event.capacity != None, Event.capacity <= sold_col), "Sold Out"),
+        (and_(Event.start_at != None, Event.start_at <= now), "Inactive"),
+        else_="Open",
+    )
+
+
+def category_filter(category):
+    """
+    EXISTS semi-join on the event's tags, so filtering never multiplies rows.
+    """
+    return exists().where(
+        Event_Tag.event_id == Event.id,
+        Event_Tag.tag_id == Tag.id,
+        Tag.name == category,
+    )
+
+
+def build_listing(q_text="", category="", fmt="", price_min=None, price_max=None, status="", with_price=True):
+    """
+    Build the home listing query with every filter applied in SQL.
+    The ticket_types aggregate is only joined when with_price is set (price
+    filters/sorts); otherwise callers show prices from min_prices().
+    Returns (query, price_expr, sold_col, status_col, rank_col); price_expr is
+    None when the price isn't joined, rank_col is None unless the full-text
+    index served the keyword search.
+    """
+    # maintained counter (see bookings.record_sale), no aggregate over bookings
+    sold_col = Event.sold_qty
+    status_col = status_expr(sold_col)
+
+    qry = db.session.query(Event, sold_col.label("sold_qty"), status_col.label("status"))
+
+    price_expr = None
+    if with_price or price_min is not None or price_max is not None:
+        price_sq = price_subquery()
+        price_expr = func.coalesce(price_sq.c.min_price, 0.0)
+        qry = qry.outerjoin(price_sq, price_sq.c.event_id == Event.id)
+
+    rank_col = None
+    if q_text:
+        qry, rank_col = text_search(qry, q_text)
+    if category:
+        qry = qry.filter(category_filter(category))
+    if fmt:
+        qry = qry.filter(Event.event_type == fmt)
+    if price_min is not None:
+        qry = qry.filter(price_expr >= price_min)
+    if price_max is not None:
+        qry = qry.filter(price_expr <= price_max)
+    if status:
+        qry = qry.filter(status_col == status)
+
+    return qry, price_expr, sold_col, status_col, rank_col
+
+
+def text_search(qry, q_text):
+    """
+    Keyword filter: the FTS5 index (prefix match, bm25 rank) when it's available,
+    otherwise the original ILIKE on title/description.
+    Returns (query, rank_col); rank_col is None on the ILIKE fallback.
+    """
+    hits = search.matches(q_text) if search.enabled() else None
+    if hits is None:
+        ilike = f"%{q_text}%"
+        return qry.filter(or_(Event.title.ilike(ilike), Event.description.ilike(ilike))), None
+    return qry.join(hits, hits.c.event_id == Event.id), hits.c.rank
+
+
+def needs_price(sort, price_min=None, price_max=None):
+    """True when the price aggregate has to be part of the SQL (filtering or ordering on it)."""
+    return sort in PRICE_SORTS or price_min is not None or price_max is not None
+
+
+# cached per-event aggregates, see cache.aggregate_cache
+
+def min_prices(event_ids):
+    """
+    {event_id: cheapest ticket price} for the given events. Cached values are
+    used where present; the rest come from one grouped query over ticket_types.
+    """
+    event_ids = list(dict.fromkeys(event_ids))
+    cached = aggregate_cache.get_many([("min_price", eid) for eid in event_ids])
+    prices = {key[1]: value for key, value in cached.items()}
+    missing = [eid for eid in event_ids if eid not in prices]
+    if missing:
+        fetched = {eid: 0.0 for eid in missing}
+        rows = (
+            db.session.query(TicketType.event_id, func.min(cast(TicketType.price, Float)))
+            .filter(TicketType.event_id.in_(missing))
+            .group_by(TicketType.event_id)
+            .all()
+        )
+        for eid, mp in rows:
+            fetched[eid] = float(mp or 0.0)
+        aggregate_cache.set_many({("min_price", eid): mp for eid, mp in fetched.items()})
+        prices.update(fetched)
+    return prices
+
+
+def tags_for(event_ids):
+    """
+    {event_id: [tag names]} for the given events, cached the same way as min_prices().
+    """
+    event_ids = list(dict.fromkeys(event_ids))
+    cached = aggregate_cache.get_many([("tags", eid) for eid in event_ids])
+    tags = {key[1]: value for key, value in cached.items()}
+    missing = [eid for eid in event_ids if eid not in tags]
+    if missing:
+        fetched = {eid: [] for eid in missing}
+        rows = (
+            db.session.query(Event_Tag.event_id, Tag.name)
+            .join(Tag, Tag.id == Event_Tag.tag_id)
+            .filter(Event_Tag.event_id.in_(missing))
+            .order_by(Event_Tag.id)
+            .all()
+        )
+        for eid, name in rows:
+            fetched[eid].append(name)
+        aggregate_cache.set_many({("tags", eid): names for eid, names in fetched.items()})
+        tags.update(fetched)
+    return tags
+
+
+def all_tag_names():
+    """Every tag name, alphabetical; the tag list changes rarely so it's cached."""
+    names = aggregate_cache.get(("tag_names",))
+    if names is None:
+        names = [name for (name,) in db.session.query(Tag.name).order_by(Tag.name).all()]
+        aggregate_cache.set(("tag_names",), names)
+    return names
+
+
+def _undated():
+    # 1 for events without a start time, so they sort after dated ones on any backend
+    return case((Event.start_at.is_(None), 1), else_=0)
+
+
+def sort_keys(sort, price_expr, sold_col, rank_col=None):
+    """
+    The ordering of the home listing as (expression, descending) pairs.
+    Event.id is always the last key so every row has a unique position, which
+    keeps LIMIT/OFFSET pages stable and lets the same keys drive cursors.
+    """
+    start_null = _undated()
+    if sort == "relevance" and rank_col is not None:
+        # bm25: lower is a better match
+        return [(rank_col, False), (Event.id, False)]
+    if sort == "priceLowHigh":
+        return [(price_expr, False), (Event.id, False)]
+    if sort == "priceHighLow":
+        return [(price_expr, True), (Event.id, False)]
+    if sort == "popularity":
+        return [(sold_col, True), (start_null, False), (Event.start_at, False), (Event.id, False)]
+    # dateSoonest, relevance without a search and anything unknown: soonest first, undated last
+    return [(start_null, False), (Event.start_at, False), (Event.id, False)]
+
+
+def host_sort_keys(sort):
+    """
+    The ordering of a host's My Events page, in the same form as sort_keys().
+    """
+    if sort == "created":
+        return [(Event.created_at, True), (Event.id, True)]
+    if sort == "title":
+        return [(func.lower(Event.title), False), (Event.id, False)]
+    # upcoming and anything unknown
+    return [(_undated(), False), (Event.start_at, False), (Event.id, False)]
+
+
+def apply_order(qry, keys):
+    return qry.order_by(*[(expr.desc() if desc else expr.asc()) for expr, desc in keys])
+
+
+def paginate(qry, page, per_page):
+    """
+    Run a COUNT for the total and fetch only the requested page with LIMIT/OFFSET.
+    Returns (rows, total, pages).
+    """
+    total = qry.order_by(None).count()
+    pages = max((total + per_page - 1) // per_page, 1)
+    rows = qry.limit(per_page).offset((page - 1) * per_page).all()
+    return rows, total, pages
+
+
+def listing_version():
+    """
+    One aggregate row that changes whenever any listing page could: an event
+    edited, added or removed, a ticket sold, a price or image changed, or an
+    event starting (its status flips to Inactive). Used for the page ETags.
+    """
+    now = datetime.now()
+    return tuple(db.session.execute(
+        db.select(
+            func.count(Event.id),
+            func.max(Event.updated_at),
+            func.sum(Event.sold_qty),
+            func.sum(case((Event.start_at <= now, 1), else_=0)),
+            db.select(func.max(TicketType.updated_at)).scalar_subquery(),
+            db.select(func.max(Event_Image.updated_at)).scalar_subquery(),
+        )
+    ).one())
+
+
+def page_query_string(args):
+    """
+    Current query string minus the paging params, for building page/cursor links.
+    Multi-value params (e.g. status=open&status=soldout) are kept.
+    """
+    params = {
+        k: [v for v in vs if v not in (None, "")]
+        for k, vs in args.to_dict(flat=False).items()
+        if k not in ("page", "per_page", "cursor")
+    }
+    return urlencode({k: vs for k, vs in params.items() if vs}, doseq=True)
+
+
+# keyset (cursor) pagination
+
+def _dump_key(value):
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _load_key(value):
+    if isinstance(value, dict) and "dt" in value:
+        return datetime.fromisoformat(value["dt"])
+    return value
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _signature(raw):
+    # keyed on SECRET_KEY: the key values are bound into SQL, so only ones we issued are accepted
+    key = current_app.secret_key
+    key = key.encode() if isinstance(key, str) else key
+    return hmac.new(key, b"cursor:" + raw, hashlib.sha256).digest()[:16]
+
+
+def encode_cursor(scope, values, direction="next"):
+    """
+    Opaque, signed token holding the sort key of a boundary row. `scope` ties the
+    token to one page + sort so a token can't be replayed against a different ordering.
+    """
+    payload = {"s": scope, "d": direction, "k": [_dump_key(v) for v in values]}
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return f"{_b64(raw)}.{_b64(_signature(raw))}"
+
+
+def decode_cursor(token, scope):
+    """
+    Return (direction, key values) for a token, or None if it's empty, malformed,
+    tampered with or was issued for another scope (callers then start from the
+    first page).
+    """
+    if not token:
+        return None
+    try:
+        body, _, sig = token.partition(".")
+        raw = _unb64(body)
+        if not hmac.compare_digest(_unb64(sig), _signature(raw)):
+            return None
+        payload = json.loads(raw)
+        if payload.get("s") != scope or payload.get("d") not in ("next", "prev"):
+            return None
+        return payload["d"], [_load_key(v) for v in payload["k"]]
+    except (ValueError, TypeError, KeyError, AttributeError, binascii.Error):
+        return None
+
+
+def _after(keys, values):
+    """
+    Rows strictly after `values` in the ordering `keys`:
+    (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...
+    NULL-safe equality is used so undated events still page correctly.
+    """
+    clauses = []
+    for i, ((expr, desc), value) in enumerate(zip(keys, values)):
+        if value is None:
+            # nothing sorts past NULL within its group
+            continue
+        prefix = [k.is_not_distinct_from(v) for (k, _), v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*prefix, expr < value if desc else expr > value))
+    return or_(*clauses)
+
+
+def keyset_page(qry, keys, per_page, cursor, scope):
+    """
+    Fetch one page by seeking past the cursor row instead of using OFFSET.
+    `cursor` is the result of decode_cursor() (or None for the first page).
+    Returns (rows, prev_token, next_token); tokens are None at either end.
+    """
+    direction, values = cursor if cursor else ("next", None)
+    backwards = direction == "prev"
+    # compare datetimes exactly as stored: SQLite keeps them as text, and server
+    # defaults (no microseconds) would never equal a re-bound Python datetime
+    keys = [(type_coerce(expr, String) if isinstance(expr.type, DateTime) else expr, desc) for expr, desc in keys]
+    # walking backwards = same keys, every direction flipped, then reverse the page
+    walk = [(expr, desc != backwards) for expr, desc in keys]
+
+    if values is not None and len(values) == len(keys):
+        qry = qry.filter(_after(walk, values))
+    else:
+        values = None
+
+    n = len(keys)
+    qry = apply_order(qry.add_columns(*[expr for expr, _ in keys]).order_by(None), walk)
+    fetched = qry.limit(per_page + 1).all()
+
+    more = len(fetched) > per_page
+    fetched = fetched[:per_page]
+    if backwards:
+        fetched.reverse()
+
+    rows = [tuple(r[:-n]) for r in fetched]
+    has_prev = more if backwards else values is not None
+    has_next = (values is not None) if backwards else more
+
+    prev_token = next_token = None
+    if fetched and has_prev:
+        prev_token = encode_cursor(scope, list(fetched[0][-n:]), "prev")
+    if fetched and has_next:
+        next_token = encode_cursor(scope, list(fetched[-1][-n:]), "next")
+    return rows, prev_token, next_token
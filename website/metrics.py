@@ -0,0 +1,173 @@
+from flask import Blueprint, current_app, g, request, abort
+from sqlalchemy import event
+import os, time
+from .cache import aggregate_cache
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:  # METRICS_ENABLED = None turns metrics off without it
+    prometheus_client = None
+
+# Prometheus metrics at /metrics: request latency per endpoint and status (hooks
+# on the site's blueprints, see instrument()), booking and cancellation
+# counters, connection pool gauges and the caches' hit counts.
+#
+# With several worker processes (gunicorn), set PROMETHEUS_MULTIPROC_DIR to an
+# empty directory before the app is imported: every worker then writes its
+# samples there (mmap files, no cross-process locking) and a scrape of any
+# worker reports the sum. wsgi.py clears it on start and drops the live gauges
+# of exited workers.
+
+metrics_bp = Blueprint("metrics", __name__)
+
+# seconds; pages are mostly 5-50 ms, bookings and uploads slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+if prometheus_client is not None:
+    REQUEST_LATENCY = Histogram(
+        "bondra_request_duration_seconds", "Time to build a response.",
+        ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS,
+    )
+    BOOKINGS = Counter(
+        "bondra_bookings_total", "Booking attempts by outcome (booked, sold_out, rejected, failed).",
+        ["outcome"],
+    )
+    TICKETS = Counter("bondra_tickets_booked_total", "Tickets in successful bookings.")
+    CANCELLATIONS = Counter(
+        "bondra_booking_cancellations_total", "Cancellation attempts by outcome (cancelled, rejected, failed).",
+        ["outcome"],
+    )
+    POOL_IN_USE = Gauge(
+        "bondra_db_connections_in_use", "Connections checked out of the pool.",
+        ["bind"], multiprocess_mode="livesum",
+    )
+    POOL_OPEN = Gauge(
+        "bondra_db_connections_open", "Connections the pool holds open.",
+        ["bind"], multiprocess_mode="livesum",
+    )
+    POOL_SIZE = Gauge(
+        "bondra_db_pool_size", "Configured pool size (without overflow).",
+        ["bind"], multiprocess_mode="livesum",
+    )
+
+
+def _multiprocess():
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+class CacheCollector:
+    """The in-process caches' counters, read at scrape time (per worker)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        labels = ["cache", "worker"]
+        hits = CounterMetricFamily("bondra_cache_hits", "Cache lookups that found an entry.", labels=labels)
+        misses = CounterMetricFamily("bondra_cache_misses", "Cache lookups that missed.", labels=labels)
+        size = GaugeMetricFamily("bondra_cache_entries", "Entries held.", labels=labels)
+        worker = str(os.getpid())
+        caches = [("aggregate", aggregate_cache.stats())]
+        fragments = self.app.extensions.get("fragment_cache")
+        if fragments is not None:
+            caches.append(("fragment", fragments.stats()))
+        for name, stats in caches:
+            if "hits" in stats:
+                hits.add_metric([name, worker], stats["hits"])
+                misses.add_metric([name, worker], stats["misses"])
+            if "size" in stats:
+                size.add_metric([name, worker], stats["size"])
+        return [hits, misses, size]
+
+
+def _enabled():
+    return current_app.extensions.get("metrics") is not None
+
+
+# request latency
+
+def _start_timer():
+    g._metrics_started = time.perf_counter()
+
+
+def _observe(response):
+    started = g.pop("_metrics_started", None)
+    if started is not None and _enabled():
+        REQUEST_LATENCY.labels(
+            request.endpoint or "", request.method, str(response.status_code)
+        ).observe(time.perf_counter() - started)
+    return response
+
+
+def instrument(blueprint):
+    """Time every request the blueprint handles."""
+    blueprint.before_request(_start_timer)
+    blueprint.after_request(_observe)
+
+
+# counters for the booking views
+
+def booking(outcome, tickets=0):
+    if _enabled():
+        BOOKINGS.labels(outcome).inc()
+        if tickets:
+            TICKETS.inc(tickets)
+
+
+def cancellation(outcome):
+    if _enabled():
+        CANCELLATIONS.labels(outcome).inc()
+
+
+# pool gauges, kept current by pool events
+
+def _watch_pool(engine, bind):
+    in_use, open_ = POOL_IN_USE.labels(bind), POOL_OPEN.labels(bind)
+
+    def connected(*args):
+        open_.inc()
+        # set in every worker process (a forked child starts from zero)
+        size = getattr(engine.pool, "size", None)
+        if callable(size):
+            POOL_SIZE.labels(bind).set(size())
+
+    event.listen(engine, "checkout", lambda *args: in_use.inc())
+    event.listen(engine, "checkin", lambda *args: in_use.dec())
+    event.listen(engine, "connect", connected)
+    event.listen(engine, "close", lambda *args: open_.dec())
+    event.listen(engine, "detach", lambda *args: open_.dec())
+
+
+@metrics_bp.route("/metrics")
+def scrape():
+    if not _enabled():
+        abort(404)
+    body = b"".join(prometheus_client.generate_latest(r) for r in current_app.extensions["metrics"])
+    return current_app.response_class(body, mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """
+    METRICS_ENABLED: None (default) turns metrics on when prometheus_client is
+    installed, True requires it, False leaves /metrics a 404.
+    """
+    wanted = app.config.get("METRICS_ENABLED")
+    if wanted and prometheus_client is None:
+        raise RuntimeError("METRICS_ENABLED needs prometheus_client (pip install prometheus_client)")
+    if wanted is False or prometheus_client is None:
+        app.extensions["metrics"] = None
+        return
+    if _multiprocess():
+        shared = CollectorRegistry()
+        multiprocess.MultiProcessCollector(shared)
+    else:
+        shared = prometheus_client.REGISTRY
+    caches = CollectorRegistry()
+    caches.register(CacheCollector(app))
+    app.extensions["metrics"] = (shared, caches)
+    from . import db
+    with app.app_context():
+        for bind, engine in db.engines.items():
+            _watch_pool(engine, bind or "primary")
@@ -0,0 +1,223 @@
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect, insert, select
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn, CreateTable
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import click, time
+from . import db
+from .models import SchemaVersion, Tag
+
+# Versioned schema migrations. schema_version has a row per applied step.
+# create_app() reads max(version), a single query; only when the database is
+# behind (and AUTO_MIGRATE is on) does it apply the missing steps. Production
+# turns AUTO_MIGRATE off and runs `flask db upgrade` before starting workers.
+#
+# Each step runs in its own transaction holding a database-wide lock
+# (pg_advisory_xact_lock on PostgreSQL, BEGIN IMMEDIATE on SQLite), so when
+# several processes start at once the step is applied once and the others
+# find it recorded. Step 1 creates every table from the current models, so
+# later steps must check before they add anything (see add_column).
+
+MIGRATIONS = []  # (version, name, step(conn)), in order
+
+# pg_advisory_xact_lock key; any constant unique to this app
+_LOCK_KEY = 207_027
+
+
+def migration(version, name):
+    def register(step):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "migrations must be declared in order"
+        MIGRATIONS.append((version, name, step))
+        return step
+    return register
+
+
+def head() -> int:
+    return MIGRATIONS[-1][0]
+
+
+def add_column(conn, column) -> bool:
+    """
+    Add a model column that the existing table is missing. The DDL is compiled
+    from the model for the backend, so the column must be nullable or have a
+    server_default. Returns True when it was added.
+    """
+    table = column.table.name
+    if column.name in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return False
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {ddl}")
+    return True
+
+
+# steps
+
+@migration(1, "create tables")
+def _create_tables(conn):
+    db.metadata.create_all(conn)
+
+
+# columns added to tables before migrations were versioned
+_ADDED_COLUMNS = (
+    ("events", "is_active"),
+    ("events", "sold_qty"),
+    ("ticket_types", "sold_qty"),
+    ("users", "first_name"),
+    ("users", "last_name"),
+    ("users", "street_address"),
+    ("users", "profile_pic_path"),
+    ("users", "profile_pic_variants"),
+    ("event_images", "variants"),
+)
+
+
+@migration(2, "add unversioned columns")
+def _add_columns(conn):
+    added = {(t, c) for t, c in _ADDED_COLUMNS if add_column(conn, db.metadata.tables[t].c[c])}
+    # denormalised sales counters; backfill from bookings when first added
+    if {("events", "sold_qty"), ("ticket_types", "sold_qty")} & added:
+        from .bookings import reconcile_sales
+        with Session(bind=conn) as session:
+            reconcile_sales(session)
+
+
+@migration(3, "create indexes")
+def _create_indexes(conn):
+    # indexes declared on the models, for tables that predate them
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+@migration(4, "event search index")
+def _search_index(conn):
+    # SQLite FTS5; other backends search with ILIKE
+    from . import search
+    search.install(conn)
+
+
+@migration(5, "default tags")
+def _default_tags(conn):
+    names = ["Tech & AI", "Marketing", "Finance", "Health", "Education"]
+    existing = set(conn.execute(select(Tag.name).where(Tag.name.in_(names))).scalars())
+    missing = [{"name": name} for name in names if name not in existing]
+    if missing:
+        conn.execute(insert(Tag), missing)
+
+
+@migration(6, "bookings export index")
+def _bookings_export_index(conn):
+    # created with the table on new databases
+    bookings = db.metadata.tables["bookings"]
+    next(i for i in bookings.indexes if i.name == "ix_bookings_event_created").create(conn, checkfirst=True)
+
+
+# running
+
+def current_version(engine) -> int:
+    """The highest applied migration; 0 for a database without schema_version."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        return 0
+
+
+@contextmanager
+def _locked(engine, timeout):
+    # a transaction holding the migration lock; committed when the block succeeds
+    deadline = time.monotonic() + timeout
+    while True:
+        conn = engine.connect()
+        try:
+            if engine.dialect.name == "sqlite":
+                # take the write lock up front (busy_timeout waits for it)
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            elif engine.dialect.name == "postgresql":
+                conn.execute(select(func.pg_advisory_xact_lock(_LOCK_KEY)))
+            break
+        except OperationalError as exc:
+            conn.close()
+            if "locked" not in str(exc).lower() or time.monotonic() > deadline:
+                raise
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def upgrade(engine, target=None, timeout=300):
+    """Apply the migrations up to target (default: all); returns the (version, name) pairs applied."""
+    applied = []
+    if current_version(engine) >= (target or head()):
+        return applied
+    for version, name, step in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with _locked(engine, timeout) as conn:
+            conn.execute(CreateTable(SchemaVersion.__table__, if_not_exists=True))
+            done = conn.execute(select(SchemaVersion.version).where(SchemaVersion.version == version)).first()
+            if done:
+                continue
+            step(conn)
+            conn.execute(insert(SchemaVersion), {
+                "version": version,
+                "name": name,
+                "applied_at": datetime.now(timezone.utc).replace(tzinfo=None),
+            })
+        applied.append((version, name))
+    return applied
+
+
+# CLI: flask db ...
+
+db_cli = AppGroup("db", help="Database schema migrations.")
+
+
+@db_cli.command("upgrade")
+@click.option("--to", "target", type=int, help="Stop at this version.")
+def upgrade_command(target):
+    """Apply pending migrations."""
+    applied = upgrade(db.engine, target, current_app.config.get("MIGRATION_LOCK_TIMEOUT", 300))
+    for version, name in applied:
+        click.echo(f"Applied {version}: {name}")
+    click.echo(f"Database at version {current_version(db.engine)} (latest {head()}).")
+
+
+@db_cli.command("current")
+def current_command():
+    """Show the database's schema version."""
+    click.echo(f"{current_version(db.engine)} (latest {head()})")
+
+
+@db_cli.command("history")
+def history_command():
+    """List the migrations and when each was applied."""
+    try:
+        applied = {sv.version: sv.applied_at for sv in db.session.execute(db.select(SchemaVersion)).scalars()}
+    except (OperationalError, ProgrammingError):
+        db.session.rollback()
+        applied = {}
+    for version, name, _ in MIGRATIONS:
+        when = applied.get(version)
+        click.echo(f"{version:>4}  {when:%Y-%m-%d %H:%M:%S}  {name}" if when else f"{version:>4}  {'pending':<19}  {name}")
+
+
+def init_app(app):
+    app.cli.add_command(db_cli)
+    with app.app_context():
+        version = current_version(db.engine)
+        if version >= head():
+            return
+        if not app.config.get("AUTO_MIGRATE", True):
+            app.logger.warning("database schema is at version %s of %s; run `flask db upgrade`", version, head())
+            return
+        for applied, name in upgrade(db.engine, timeout=app.config.get("MIGRATION_LOCK_TIMEOUT", 300)):
+            app.logger.info("applied migration %s: %s", applied, name)
@@ -1,7 +1,7 @@
 from . import db
 from datetime import datetime
 from flask_login import UserMixin
-from sqlalchemy import Numeric, func, CheckConstraint, Enum as SAEnum, Index, text, Boolean
+from sqlalchemy import Numeric, func, CheckConstraint, Enum as SAEnum, Index, text, true, Boolean
 import enum
 
 # enums for Booking status, instead of storing them as strings
@@ -19,8 +19,17 @@ class PaymentStatusEnum(str, enum.Enum):
     REFUNDED = "REFUNDED"
     FAILED = "FAILED"
 
-BookingStatus = SAEnum(BookingStatusEnum, name='booking_status', native_enum=False, create_constraint=True, validate_strings=True)
-PaymentStatus = SAEnum(PaymentStatusEnum, name='payment_status', native_enum=False, create_constraint=True, validate_strings=True)
+# enums for background Job status
+class JobStatusEnum(str, enum.Enum):
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+# native types on PostgreSQL, VARCHAR + CHECK on SQLite
+BookingStatus = SAEnum(BookingStatusEnum, name='booking_status', native_enum=True, create_constraint=True, validate_strings=True)
+PaymentStatus = SAEnum(PaymentStatusEnum, name='payment_status', native_enum=True, create_constraint=True, validate_strings=True)
+JobStatus = SAEnum(JobStatusEnum, name='job_status', native_enum=False, create_constraint=True, validate_strings=True)
 
 class TimestampMixin(object):
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -36,6 +45,8 @@ class User(TimestampMixin, db.Model, UserMixin):
     last_name = db.Column(db.String(80))
     street_address = db.Column(db.String(160))
     profile_pic_path = db.Column(db.String(255))
+    # resized WebP/JPEG copies, see images.PROFILE_VARIANTS
+    profile_pic_variants = db.Column(db.JSON)
 	# password should never stored in the DB, an encrypted password is stored
 	# the storage should be at least 255 chars long, depending on your hashing algorithm
     password_hash = db.Column(db.String(255), nullable=False)
@@ -65,7 +76,9 @@ class Event(TimestampMixin, db.Model):
     join_url_release_at = db.Column(db.DateTime(timezone=True))
     capacity = db.Column(db.Integer)
     cancelled = db.Column(db.Boolean, default=False, nullable=False)
-    is_active = db.Column(db.Boolean, nullable=False, server_default=text("1"))
+    is_active = db.Column(db.Boolean, nullable=False, server_default=true())
+    # confirmed tickets sold; kept in step with bookings by bookings.record_sale()
+    sold_qty = db.Column(db.Integer, nullable=False, default=0, server_default=text("0"))
     # ... Create the Comments db.relationship
 	# relation to call destination.comments and comment.destination
     comments = db.relationship('Comment', back_populates='event', cascade='all, delete-orphan', passive_deletes=True)
@@ -115,6 +128,8 @@ class TicketType(TimestampMixin, db.Model):
     capacity = db.Column(db.Integer, nullable=False)
     sales_start_at = db.Column(db.DateTime(timezone=True))
     sales_end_at = db.Column(db.DateTime(timezone=True))
+    # confirmed tickets sold of this type; kept in step with bookings by bookings.record_sale()
+    sold_qty = db.Column(db.Integer, nullable=False, default=0, server_default=text("0"))
     
     __table_args__ = (
         CheckConstraint('capacity >= 0', name='ck_ticket_capacity_nonneg'), # can't have a negative capacity of tickets
@@ -187,6 +202,8 @@ class Event_Image(TimestampMixin, db.Model):
     event_id = db.Column(db.Integer, db.ForeignKey('events.id', ondelete='CASCADE'), index=True, nullable=False)
     url = db.Column(db.String(255), nullable=False)
     alt_text = db.Column(db.String(160))
+    # resized WebP/JPEG copies, see images.EVENT_VARIANTS
+    variants = db.Column(db.JSON)
     
     event = db.relationship('Event', back_populates='images')
 
@@ -224,20 +241,75 @@ class Tag(db.Model):
     def __repr__(self):
         return f"Tag: {self.name}"
     
+
+# one stored upload, keyed by content hash and shared by every row that uses it (see uploads.py)
+class Blob(TimestampMixin, db.Model):
+    __tablename__ = 'blobs'
+    key = db.Column(db.String(120), primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.Integer, nullable=False)
+    content_type = db.Column(db.String(80))
+    # Event_Image / User rows pointing at this blob; unreferenced blobs are garbage collected
+    refcount = db.Column(db.Integer, nullable=False, default=0, server_default=text("0"))
+    released_at = db.Column(db.DateTime)
+    # resized copies, owned by (and deleted with) this blob
+    variants = db.Column(db.JSON)
+
+    # string print method
+    def __repr__(self):
+        return f"Blob: {self.key}"
+
+# durable queue for work done after the request (see jobs.py)
+class Job(TimestampMixin, db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(80), nullable=False, index=True)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(JobStatus, nullable=False, default=JobStatusEnum.QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    # string print method
+    def __repr__(self):
+        return f"Job {self.id}: {self.kind}"
+
+# one row per applied schema migration (see migrations.py)
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(120), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+    # string print method
+    def __repr__(self):
+        return f"SchemaVersion {self.version}: {self.name}"
     
 #Indexing for improved performance
 
 # Events list/sort/search
 Index('ix_events_start_cancel', Event.start_at, Event.cancelled)
 Index('ix_events_host_start', Event.host_user_id, Event.start_at)
+Index('ix_events_sold', Event.sold_qty)
 
 # Bookings: user history & event sales
 Index('ix_bookings_user_created', Booking.user_id, Booking.created_at.desc())
 Index('ix_bookings_event_status', Booking.event_id, Booking.status)
+# Bookings: a host's attendee export, in booking order
+Index('ix_bookings_event_created', Booking.event_id, Booking.created_at, Booking.booking_id)
 
 # Payments: lookup by booking + status
 Index('ix_payments_booking_status', Payment.booking_id, Payment.status)
 
+# Blobs: garbage collection scan
+Index('ix_blobs_refcount_released', Blob.refcount, Blob.released_at)
+
+# Jobs: the worker's "next due job" lookup
+Index('ix_jobs_status_run_after', Job.status, Job.run_after)
+
 # Tags: quick lookup by name/slug
 Index('ix_tags_name', Tag.name)
 Index('ix_tags_slug', Tag.slug)
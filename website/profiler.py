@@ -0,0 +1,253 @@
+from flask import Blueprint, current_app, g, request, abort, render_template, send_file
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+import hmac, json, os, random, secrets, sys, time
+
+# Opt-in profiling of slow requests (PROFILER_ENABLED). A sampled share of
+# requests (PROFILER_SAMPLE_RATE), or one sent with an X-Profile header equal
+# to PROFILER_SECRET, is watched by a sampling thread that records the
+# request thread's Python stack every PROFILER_INTERVAL_MS. When the request
+# took PROFILER_THRESHOLD_MS or longer (or the header asked for it) the stacks
+# are saved as a folded-stack file ("frame;frame;frame count" lines, the input
+# of flamegraph.pl and speedscope) with a JSON summary next to it. PROFILER_DIR
+# keeps the newest PROFILER_KEEP profiles; /_profiles lists them for requests
+# carrying the secret, and is a 404 when no PROFILER_SECRET is set.
+#
+# Sampling costs the watched request little (the sampler reads its frames from
+# another thread) and the rest nothing, so a small rate is safe in production.
+
+profiler_bp = Blueprint("profiler", __name__)
+
+HEADER = "X-Profile"
+_MAX_DEPTH = 128
+
+# where a sample's time goes: the innermost frame from one of these packages
+_CATEGORIES = (
+    ("sql", ("sqlalchemy/engine", "sqlalchemy/pool", "sqlalchemy/dialects", "sqlite3", "psycopg")),
+    ("orm", ("sqlalchemy/",)),
+    ("templates", ("jinja2/", "<template>", ".html")),
+)
+
+
+def _label(code):
+    path = code.co_filename.replace("\\", "/")
+    for marker in ("site-packages/", "/lib/python", "/website/"):
+        if marker in path:
+            path = path.rsplit(marker, 1)[1]
+            if marker == "/lib/python":
+                path = path.split("/", 1)[-1]
+            elif marker == "/website/":
+                path = "website/" + path
+            break
+    return f"{code.co_qualname} ({path}:{code.co_firstlineno})"
+
+
+def _category(frames):
+    for frame in reversed(frames):
+        for name, markers in _CATEGORIES:
+            if any(marker in frame for marker in markers):
+                return name
+    return "app"
+
+
+class Sampler:
+    """One thread taking stack samples of the request threads being profiled."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._watched = {}  # thread id -> Counter of folded stacks
+        self._lock = Lock()
+        self._wake = Event()
+        self._thread = None
+
+    def watch(self, ident):
+        with self._lock:
+            self._watched[ident] = Counter()
+            # (re)started lazily: a forked worker doesn't inherit the thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self, ident):
+        """Stop sampling the thread; returns its stacks."""
+        with self._lock:
+            return self._watched.pop(ident, None)
+
+    def _run(self):
+        own = get_ident()
+        while True:
+            if not self._watched:
+                self._wake.clear()
+                if not self._watched:  # watch() may have run since the check
+                    self._wake.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._watched.items():
+                    frame = frames.get(ident)
+                    if frame is not None and ident != own:
+                        stacks[_fold(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def _fold(frame):
+    labels = []
+    while frame is not None and len(labels) < _MAX_DEPTH:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class ProfileStore:
+    """A directory of the newest `keep` profiles (shared by the worker processes)."""
+
+    def __init__(self, root, keep):
+        self.root = root
+        self.keep = keep
+
+    def save(self, summary, stacks):
+        os.makedirs(self.root, exist_ok=True)
+        name = f"{time.time_ns() // 1_000_000}-{os.getpid()}-{secrets.token_hex(3)}"
+        summary["id"] = name
+        with open(os.path.join(self.root, name + ".folded"), "w", encoding="utf-8") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        # the summary last: the index only lists profiles that have one
+        tmp = os.path.join(self.root, name + ".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(summary, f)
+        os.replace(tmp, os.path.join(self.root, name + ".json"))
+        self._trim()
+        return name
+
+    def _names(self):
+        try:
+            files = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted((f[:-5] for f in files if f.endswith(".json")), reverse=True)
+
+    def _trim(self):
+        for name in self._names()[self.keep:]:
+            for ext in (".json", ".folded"):
+                try:
+                    os.remove(os.path.join(self.root, name + ext))
+                except FileNotFoundError:
+                    pass  # another worker got there first
+
+    def list(self):
+        summaries = []
+        for name in self._names():
+            try:
+                with open(os.path.join(self.root, name + ".json"), encoding="utf-8") as f:
+                    summaries.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        return summaries
+
+    def path(self, name):
+        if not name.replace("-", "").isalnum():
+            return None
+        path = os.path.join(self.root, name + ".folded")
+        return path if os.path.exists(path) else None
+
+
+# request hooks
+
+def _secret_matches(value):
+    secret = current_app.config.get("PROFILER_SECRET")
+    return bool(secret and value and hmac.compare_digest(value.encode(), secret.encode()))
+
+
+def _start():
+    forced = _secret_matches(request.headers.get(HEADER))
+    rate = current_app.config.get("PROFILER_SAMPLE_RATE", 0)
+    if forced or (rate > 0 and random.random() < rate):
+        ident = get_ident()
+        g._profile = (ident, time.perf_counter(), forced)
+        current_app.extensions["profiler"][0].watch(ident)
+
+
+def _finish(response):
+    profile = g.pop("_profile", None)
+    if profile is None:
+        return response
+    ident, started, forced = profile
+    sampler, store = current_app.extensions["profiler"]
+    stacks = sampler.stop(ident)
+    ms = (time.perf_counter() - started) * 1000
+    if not stacks or (ms < current_app.config.get("PROFILER_THRESHOLD_MS", 250) and not forced):
+        return response
+    samples = sum(stacks.values())
+    split = Counter()
+    for stack, count in stacks.items():
+        split[_category(stack.split(";"))] += count
+    summary = {
+        "at": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),  # UTC
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "ms": round(ms, 1),
+        "samples": samples,
+        "forced": forced,
+        "split": {name: round(count * 100 / samples, 1) for name, count in split.most_common()},
+    }
+    sql = g.get("_sql_stats")  # sqlstats.py, when it measured this request
+    if sql is not None:
+        summary["queries"] = sql.queries
+        summary["db_ms"] = round(sql.seconds * 1000, 1)
+    name = store.save(summary, stacks)
+    if forced:
+        response.headers[HEADER] = name
+    return response
+
+
+def _release(exc):
+    # a request that failed before _finish ran
+    profile = g.pop("_profile", None)
+    if profile is not None:
+        current_app.extensions["profiler"][0].stop(profile[0])
+
+
+# index page and downloads (PROFILER_SECRET as X-Profile or ?key=): profiles
+# show request paths, query strings and the app's call stacks
+
+def _allowed():
+    if not current_app.config.get("PROFILER_ENABLED"):
+        return False
+    return _secret_matches(request.headers.get(HEADER) or request.args.get("key"))
+
+
+@profiler_bp.route("/_profiles")
+def index():
+    if not _allowed():
+        abort(404)
+    store = current_app.extensions["profiler"][1]
+    return render_template("profiles.html", profiles=store.list(), key=request.args.get("key"))
+
+
+@profiler_bp.route("/_profiles/<name>.folded")
+def download(name):
+    if not _allowed():
+        abort(404)
+    path = current_app.extensions["profiler"][1].path(name)
+    if path is None:
+        abort(404)
+    return send_file(path, mimetype="text/plain", as_attachment=request.args.get("download") is not None,
+                     download_name=name + ".folded", max_age=0)
+
+
+def init_app(app):
+    if not app.config.get("PROFILER_DIR"):
+        app.config["PROFILER_DIR"] = os.path.join(app.instance_path, "profiles")
+    if not app.config.get("PROFILER_ENABLED"):
+        return
+    if not app.config.get("PROFILER_SECRET"):
+        app.logger.warning("PROFILER_SECRET is not set: profiles are saved to %s but /_profiles is off",
+                           app.config["PROFILER_DIR"])
+    sampler = Sampler(app.config.get("PROFILER_INTERVAL_MS", 5) / 1000)
+    app.extensions["profiler"] = (sampler, ProfileStore(app.config["PROFILER_DIR"], app.config.get("PROFILER_KEEP", 100)))
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_release)
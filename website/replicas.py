@@ -0,0 +1,92 @@
+from flask import current_app, g, has_request_context, request, session
+from flask.cli import AppGroup
+from flask_sqlalchemy.session import Session
+from functools import wraps
+import click, os, sqlite3, time
+
+# Read replicas. With DB_REPLICA_URL set, views decorated with @replica_reads
+# run their SELECTs on the "replica" bind; every other request, every write,
+# and every statement after a request's first write use the primary. A browser
+# that has just written something reads from the primary for DB_READ_YOUR_WRITES
+# seconds, so a booking or edit shows up on the next page even while the
+# replica lags. force_primary() pins the rest of a request to the primary.
+
+REPLICA = "replica"
+_PRIMARY_UNTIL = "_db_primary_until"
+
+
+def replica_reads(view):
+    """Let a GET view read from the replica (when one is configured)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ("GET", "HEAD"):
+            g._db_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def force_primary():
+    """Send the rest of this request's statements to the primary."""
+    g._db_primary = True
+
+
+def _use_replica():
+    if not has_request_context() or not g.get("_db_replica") or g.get("_db_primary"):
+        return False
+    return session.get(_PRIMARY_UNTIL, 0) < time.time()
+
+
+def _wrote():
+    if has_request_context():
+        # the replica can't see this transaction (nor, for a while, its commit)
+        g._db_primary = True
+        g._db_wrote = True
+
+
+class RoutingSession(Session):
+    """db.session: plain SELECTs may go to the replica, anything else goes to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or getattr(clause, "is_dml", False):
+                _wrote()
+            elif getattr(clause, "is_select", False) and REPLICA in self._db.engines and _use_replica():
+                return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _remember_write(response):
+    window = current_app.config.get("DB_READ_YOUR_WRITES", 0)
+    if g.get("_db_wrote") and window and current_app.config.get("DB_REPLICA_URL"):
+        session[_PRIMARY_UNTIL] = time.time() + window
+    return response
+
+
+def _sqlite_path(engine):
+    return engine.url.database if engine.dialect.name == "sqlite" else None
+
+
+# CLI: flask replica ...
+
+replica_cli = AppGroup("replica", help="Read replica helpers.")
+
+
+@replica_cli.command("sync")
+def sync_command():
+    """Copy a SQLite primary into the SQLite replica file (a local stand-in for replication)."""
+    from . import db
+    if REPLICA not in db.engines:
+        raise click.ClickException("DB_REPLICA_URL is not set.")
+    source, target = _sqlite_path(db.engines[None]), _sqlite_path(db.engines[REPLICA])
+    if not (source and target):
+        raise click.ClickException("sync only copies SQLite files; use the server's own replication.")
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+    db.engines[REPLICA].dispose()
+    click.echo(f"Copied {source} to {target}.")
+
+
+def init_app(app):
+    app.after_request(_remember_write)
+    app.cli.add_command(replica_cli)
@@ -0,0 +1,194 @@
+from flask import current_app
+from sqlalchemy import select, func, literal_column, table, column
+from sqlalchemy.exc import OperationalError
+from contextlib import contextmanager
+import json, re
+from . import db
+
+# SQLite FTS5 index over event title, description, location and tag names.
+# rowid is the event id. Triggers keep it in sync with events / event_tags / tags,
+# so every write path (ORM, bulk inserts, raw SQL) is covered.
+events_fts = table(
+    "events_fts",
+    column("rowid"),
+    column("title"),
+    column("description"),
+    column("location"),
+    column("tags"),
+)
+
+# bm25 column weights: title, description, location, tags
+RANK_WEIGHTS = (10.0, 1.0, 2.0, 5.0)
+
+_TAGS_OF = (
+    "(SELECT group_concat(t.name, ' ') FROM event_tags et "
+    "JOIN tags t ON t.id = et.tag_id WHERE et.event_id = {ref})"
+)
+
+_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5("
+    "title, description, location, tags, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+
+    "CREATE TRIGGER IF NOT EXISTS events_fts_ai AFTER INSERT ON events BEGIN "
+    "INSERT INTO events_fts (rowid, title, description, location, tags) "
+    f"VALUES (new.id, new.title, new.description, new.location_text, {_TAGS_OF.format(ref='new.id')}); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS events_fts_au AFTER UPDATE OF title, description, location_text ON events BEGIN "
+    "UPDATE events_fts SET title = new.title, description = new.description, location = new.location_text "
+    "WHERE rowid = new.id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS events_fts_ad AFTER DELETE ON events BEGIN "
+    "DELETE FROM events_fts WHERE rowid = old.id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS event_tags_fts_ai AFTER INSERT ON event_tags BEGIN "
+    f"UPDATE events_fts SET tags = {_TAGS_OF.format(ref='new.event_id')} WHERE rowid = new.event_id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS event_tags_fts_au AFTER UPDATE ON event_tags BEGIN "
+    f"UPDATE events_fts SET tags = {_TAGS_OF.format(ref='old.event_id')} WHERE rowid = old.event_id; "
+    f"UPDATE events_fts SET tags = {_TAGS_OF.format(ref='new.event_id')} WHERE rowid = new.event_id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS event_tags_fts_ad AFTER DELETE ON event_tags BEGIN "
+    f"UPDATE events_fts SET tags = {_TAGS_OF.format(ref='old.event_id')} WHERE rowid = old.event_id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS tags_fts_au AFTER UPDATE OF name ON tags BEGIN "
+    f"UPDATE events_fts SET tags = {_TAGS_OF.format(ref='events_fts.rowid')} "
+    "WHERE rowid IN (SELECT event_id FROM event_tags WHERE tag_id = new.id); "
+    "END",
+]
+
+
+_HAS_INDEX = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts'"
+
+
+def _fts5_supported(conn) -> bool:
+    try:
+        conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS temp._fts5_probe USING fts5(x)")
+        conn.exec_driver_sql("DROP TABLE temp._fts5_probe")
+        return True
+    except OperationalError:
+        return False
+
+
+def _fill(conn) -> int:
+    conn.exec_driver_sql("DELETE FROM events_fts")
+    conn.exec_driver_sql(
+        "INSERT INTO events_fts (rowid, title, description, location, tags) "
+        f"SELECT e.id, e.title, e.description, e.location_text, {_TAGS_OF.format(ref='e.id')} "
+        "FROM events e"
+    )
+    return conn.exec_driver_sql("SELECT count(*) FROM events_fts").scalar()
+
+
+def _index_events(conn, ids):
+    conn.exec_driver_sql(
+        "INSERT INTO events_fts (rowid, title, description, location, tags) "
+        f"SELECT e.id, e.title, e.description, e.location_text, {_TAGS_OF.format(ref='e.id')} "
+        "FROM events e WHERE e.id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(ids)),),
+    )
+
+
+# the row-at-a-time triggers a bulk insert replaces with one _index_events
+_INSERT_TRIGGERS = {"events_fts_ai": _DDL[1], "event_tags_fts_ai": _DDL[4]}
+
+
+@contextmanager
+def bulk_insert(conn):
+    """
+    For inserting many new events (with their tags) inside conn's transaction:
+    the insert triggers are dropped for the block, and the events whose ids
+    are added to the yielded list are indexed in one statement at the end.
+    SQLite DDL is transactional, so no other connection sees the triggers
+    missing, and a rollback restores them.
+    """
+    ids = []
+    if conn.dialect.name != "sqlite" or conn.exec_driver_sql(_HAS_INDEX).first() is None:
+        yield ids
+        return
+    if not conn.connection.dbapi_connection.in_transaction:
+        # pysqlite only opens a transaction before DML; the DDL must be inside it
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    for name in _INSERT_TRIGGERS:
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+    yield ids
+    _index_events(conn, ids)
+    for ddl in _INSERT_TRIGGERS.values():
+        conn.exec_driver_sql(ddl)
+
+
+def rebuild_index(engine) -> int:
+    """Repopulate events_fts from the events table; returns the number of events indexed."""
+    with engine.begin() as conn:
+        return _fill(conn)
+
+
+def install(conn) -> bool:
+    """
+    Create the FTS5 table and triggers (a schema migration, see migrations.py);
+    a new index is filled from existing events. Returns False on backends or
+    SQLite builds without FTS5, which keep using the ILIKE search.
+    """
+    if conn.dialect.name != "sqlite" or not _fts5_supported(conn):
+        return False
+    existed = conn.exec_driver_sql(_HAS_INDEX).first() is not None
+    for ddl in _DDL:
+        conn.exec_driver_sql(ddl)
+    if not existed:
+        _fill(conn)
+    return True
+
+
+def _installed(engine) -> bool:
+    if engine.dialect.name != "sqlite":
+        return False
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(_HAS_INDEX).first() is not None
+
+
+def init_app(app):
+    # probed on the first search rather than at startup
+    app.extensions["event_search_fts"] = None
+
+
+def enabled() -> bool:
+    flag = current_app.extensions.get("event_search_fts")
+    if flag is None:
+        flag = current_app.extensions["event_search_fts"] = _installed(db.engine)
+    return flag
+
+
+def match_query(q_text):
+    """
+    Turn free text into an FTS5 query: every word must match, each as a prefix
+    ("pyth" finds "Python"). Returns None when there's nothing searchable.
+    """
+    words = re.findall(r"\w+", q_text.lower())
+    if not words:
+        return None
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def matches(q_text):
+    """
+    Subquery of (event_id, rank) for events matching q_text, best match = lowest
+    rank (bm25). Returns None when q_text has no searchable words.
+    """
+    match = match_query(q_text)
+    if match is None:
+        return None
+    fts = literal_column("events_fts")
+    return (
+        select(
+            events_fts.c.rowid.label("event_id"),
+            func.bm25(fts, *RANK_WEIGHTS).label("rank"),
+        )
+        .where(fts.op("MATCH")(match))
+        .subquery("search_hits")
+    )
@@ -0,0 +1,156 @@
+from flask import Blueprint, current_app, g, has_request_context, jsonify, request, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+from threading import Lock
+import json, logging, random, time
+
+# Per-request SQL accounting. For a sampled request (SQL_STATS_SAMPLE_RATE) the
+# cursor events count every statement and its time, keep the slowest one and
+# how often each statement ran; one repeated SQL_STATS_REPEAT_LIMIT times or
+# more is reported as a likely N+1 (the same query per row of a list). Each
+# sampled response gets a Server-Timing header and a JSON "sql" log line, and
+# adds to the per-endpoint totals served at /_stats/sql (SQL_STATS_ENDPOINT;
+# each worker process keeps its own).
+
+logger = logging.getLogger(__name__)
+
+sqlstats_bp = Blueprint("sqlstats", __name__)
+
+_SQL_PREVIEW = 300
+
+
+class RequestStats:
+    """What one request sent to the database."""
+
+    __slots__ = ("started", "queries", "seconds", "slowest", "slowest_sql", "statements")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = None
+        self.statements = Counter()
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+        if seconds > self.slowest:
+            self.slowest, self.slowest_sql = seconds, statement
+
+    def repeated(self, limit):
+        return [(sql, n) for sql, n in self.statements.most_common() if n >= limit]
+
+
+class EndpointTotals:
+    """Running totals per endpoint, for /_stats/sql."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = Lock()
+
+    def add(self, endpoint, stats, n_plus_one):
+        with self._lock:
+            row = self._data.setdefault(endpoint or "(unmatched)", {
+                "requests": 0, "queries": 0, "max_queries": 0, "db_ms": 0.0,
+                "max_db_ms": 0.0, "n_plus_one": 0,
+            })
+            db_ms = stats.seconds * 1000
+            row["requests"] += 1
+            row["queries"] += stats.queries
+            row["max_queries"] = max(row["max_queries"], stats.queries)
+            row["db_ms"] += db_ms
+            row["max_db_ms"] = max(row["max_db_ms"], db_ms)
+            row["n_plus_one"] += bool(n_plus_one)
+
+    def snapshot(self):
+        """One row per endpoint, the most total database time first."""
+        with self._lock:
+            rows = [{"endpoint": endpoint, **row} for endpoint, row in self._data.items()]
+        for row in rows:
+            row["avg_queries"] = round(row["queries"] / row["requests"], 2)
+            row["avg_db_ms"] = round(row["db_ms"] / row["requests"], 3)
+            row["db_ms"] = round(row["db_ms"], 3)
+            row["max_db_ms"] = round(row["max_db_ms"], 3)
+        return sorted(rows, key=lambda row: -row["db_ms"])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# engine events (every engine in the process; only sampled requests pay for them)
+
+def _current():
+    return g.get("_sql_stats") if has_request_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _current() is not None:
+        context._sql_stats_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_sql_stats_started", None)
+    if started is not None:
+        stats = _current()
+        if stats is not None:
+            stats.record(statement, time.perf_counter() - started)
+
+
+# request hooks
+
+def _start():
+    rate = current_app.config.get("SQL_STATS_SAMPLE_RATE", 1.0)
+    if rate > 0 and (rate >= 1 or random.random() < rate):
+        g._sql_stats = RequestStats()
+
+
+def _finish(response):
+    stats = g.pop("_sql_stats", None)
+    if stats is None:
+        return response
+    config = current_app.config
+    repeated = stats.repeated(config.get("SQL_STATS_REPEAT_LIMIT", 5))
+    db_ms = stats.seconds * 1000
+    if config.get("SQL_STATS_SERVER_TIMING", True):
+        total_ms = (time.perf_counter() - stats.started) * 1000
+        response.headers.add("Server-Timing", f'db;dur={db_ms:.1f};desc="{stats.queries} queries"')
+        response.headers.add("Server-Timing", f"app;dur={total_ms:.1f}")
+    current_app.extensions["sql_stats"].add(request.endpoint, stats, repeated)
+    record = {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "queries": stats.queries,
+        "db_ms": round(db_ms, 3),
+        "slowest_ms": round(stats.slowest * 1000, 3),
+        "slowest": stats.slowest_sql[:_SQL_PREVIEW] if stats.slowest_sql else None,
+    }
+    if repeated:
+        record["n_plus_one"] = [{"count": n, "sql": sql[:_SQL_PREVIEW]} for sql, n in repeated]
+    logger.log(logging.WARNING if repeated else logging.INFO, "sql %s", json.dumps(record))
+    return response
+
+
+@sqlstats_bp.route("/_stats/sql")
+def endpoint_totals():
+    if not current_app.config.get("SQL_STATS_ENDPOINT"):
+        abort(404)
+    totals = current_app.extensions["sql_stats"]
+    snapshot = totals.snapshot()
+    if request.args.get("reset"):
+        totals.clear()
+    return jsonify(snapshot)
+
+
+def init_app(app):
+    app.extensions["sql_stats"] = EndpointTotals()
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    app.before_request(_start)
+    app.after_request(_finish)
@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from flask import send_from_directory, redirect, abort
+import os, shutil, tempfile
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed for the S3 backend
+    boto3 = None
+
+# Where uploaded blobs are kept. Keys are content-addressed paths like
+# "ab/abcdef...89.jpg", so an object never changes once written; backends only
+# need put / exists / delete / fetch and a way to serve or link to a key.
+
+# served with far-future caching: a key's content never changes
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+class LocalStorage:
+    """Blobs in a local directory (default: instance/media), served by the /media route."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._spool = os.path.join(self.root, ".incoming")
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise ValueError(f"bad storage key {key!r}")
+        return path
+
+    def spool_dir(self):
+        # uploads are streamed to a temp file on the same filesystem, so put() can
+        # rename it into place rather than write the bytes a second time
+        os.makedirs(self._spool, exist_ok=True)
+        return self._spool
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def put(self, key, src_path, content_type=None):
+        """Store src_path under key. A file in spool_dir() is moved there; any other is copied."""
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.commonpath([os.path.abspath(src_path), self._spool]) == self._spool:
+            # mkstemp files are owner-only; stored blobs are world-readable like copied ones
+            os.chmod(src_path, 0o644)
+            # atomic, and the bytes aren't written again
+            os.replace(src_path, dest)
+            return
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        shutil.copyfile(src_path, tmp)
+        # atomic: readers see the whole file or nothing
+        os.replace(tmp, dest)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def local_file(self, key):
+        yield self._path(key)
+
+    def keys(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if not name.endswith(".tmp"):
+                    yield os.path.relpath(os.path.join(dirpath, name), self.root).replace(os.sep, "/")
+
+    def public_url(self, key):
+        return None  # served by the app
+
+    def serve(self, key):
+        response = send_from_directory(self.root, key, max_age=31536000)
+        response.headers["Cache-Control"] = IMMUTABLE
+        return response
+
+
+class S3Storage:
+    """
+    Blobs in an S3 bucket, or anything speaking the S3 API (MinIO, localstack...)
+    via endpoint_url. With a public_url (bucket website / CDN) links point there
+    directly; otherwise /media redirects to a short-lived presigned url.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, public_url=None, client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("the S3 storage backend needs boto3 (pip install boto3)")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.public_base = public_url.rstrip("/") + "/" if public_url else None
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def spool_dir(self):
+        return None  # system temp dir
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put(self, key, src_path, content_type=None):
+        extra = {"CacheControl": IMMUTABLE}
+        if content_type:
+            extra["ContentType"] = content_type
+        self.client.upload_file(src_path, self.bucket, self._key(key), ExtraArgs=extra)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    @contextmanager
+    def local_file(self, key):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self._key(key), path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def keys(self):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(self.prefix):]
+
+    def public_url(self, key):
+        return self.public_base + key if self.public_base else None
+
+    def serve(self, key):
+        if not self.exists(key):
+            abort(404)
+        url = self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._key(key)}, ExpiresIn=3600
+        )
+        return redirect(url)
+
+
+def from_config(app):
+    """Build the backend named by STORAGE_BACKEND ("local" or "s3")."""
+    backend = app.config.get("STORAGE_BACKEND", "local")
+    if backend == "local":
+        return LocalStorage(app.config.get("STORAGE_ROOT") or os.path.join(app.instance_path, "media"))
+    if backend == "s3":
+        return S3Storage(
+            app.config["S3_BUCKET"],
+            prefix=app.config.get("S3_PREFIX", ""),
+            endpoint_url=app.config.get("S3_ENDPOINT_URL"),
+            public_url=app.config.get("STORAGE_PUBLIC_URL"),
+        )
+    raise ValueError(f"unknown STORAGE_BACKEND {backend!r}")
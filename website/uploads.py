@@ -0,0 +1,304 @@
+from flask import Blueprint, current_app, abort
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, delete, case, select
+from sqlalchemy.dialects import postgresql, sqlite
+import click, hashlib, mimetypes, os, tempfile
+from . import db, jobs, storage
+from .models import Blob, Event_Image, User
+
+# Content-addressed uploads: every file is stored once under the SHA-256 of its
+# bytes ("ab/<sha256>.jpg") and referenced from Event_Image.url /
+# User.profile_pic_path as "/media/<key>". Blob.refcount counts those
+# references (retain/release); blobs nobody references are deleted by gc()
+# after a grace period, so an upload that nothing ended up using doesn't linger
+# and a shared file is never deleted while something still uses it.
+
+uploads_bp = Blueprint("uploads", __name__)
+
+MEDIA_PREFIX = "/media/"
+CHUNK_SIZE = 64 * 1024
+_EXT_ALIASES = {".jpeg": ".jpg"}
+
+
+def backend():
+    return current_app.extensions["storage"]
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def key_for(url):
+    """Storage key of a stored "/media/..." url, None for anything else (bundled or legacy files)."""
+    if url and url.startswith(MEDIA_PREFIX):
+        return url[len(MEDIA_PREFIX):]
+    return None
+
+
+def public_url(url):
+    """Where browsers should fetch a stored url from (the backend's public/CDN url if it has one)."""
+    key = key_for(url)
+    if key is None:
+        return url
+    return backend().public_url(key) or url
+
+
+def _ext(filename):
+    ext = os.path.splitext(filename or "")[1].lower()
+    return _EXT_ALIASES.get(ext, ext)
+
+
+def _insert_ignore(**values):
+    """INSERT a blobs row unless the key exists; returns True when a row was added."""
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    stmt = insert(Blob).values(**values).on_conflict_do_nothing(index_elements=["key"])
+    return db.session.execute(stmt).rowcount > 0
+
+
+def _store(path, sha, size, ext):
+    key = f"{sha[:2]}/{sha}{ext}"
+    content_type = mimetypes.guess_type("x" + ext)[0]
+    # the row first: while gc() is deleting this key the insert waits for it, and
+    # a row we create always gets its file written, even if gc() has just
+    # removed the old one. A new blob starts unreferenced; if nothing retains
+    # it, gc() removes it later. If the request rolls back instead, the file is
+    # left without a row (`flask uploads gc --orphans` removes those).
+    inserted = _insert_ignore(key=key, sha256=sha, size=size, content_type=content_type,
+                              refcount=0, released_at=_now())
+    if inserted or not backend().exists(key):
+        backend().put(key, path, content_type)
+    if inserted:
+        _schedule_gc()
+    return MEDIA_PREFIX + key
+
+
+def save(file_storage, filename=None):
+    """
+    Stream an uploaded file (werkzeug FileStorage) to a temp file, hashing it on
+    the way, and store it unless identical content is already stored. Returns the
+    "/media/..." url; the caller retain()s it when a row starts using it.
+    """
+    ext = _ext(filename or file_storage.filename)
+    fd, tmp = tempfile.mkstemp(suffix=ext, dir=backend().spool_dir())
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file_storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        return _store(tmp, digest.hexdigest(), size, ext)
+    finally:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass  # moved into place by LocalStorage.put
+
+
+def store_file(path):
+    """Store a file that's already on disk (it's copied, not moved). Returns its url."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return _store(path, digest.hexdigest(), os.path.getsize(path), _ext(path))
+
+
+def put_derived(key, path):
+    """Store a file derived from a blob (e.g. a resized variant) under a fixed key; returns its url."""
+    if not backend().exists(key):
+        backend().put(key, path, mimetypes.guess_type(key)[0])
+    return MEDIA_PREFIX + key
+
+
+def retain(url):
+    """Count one more reference to a stored url (no-op for other urls). Part of the caller's transaction."""
+    key = key_for(url)
+    if key is None:
+        return
+    db.session.execute(
+        update(Blob).where(Blob.key == key).values(refcount=Blob.refcount + 1, released_at=None)
+    )
+
+
+def release(url):
+    """Drop one reference; when none are left the blob becomes eligible for gc()."""
+    key = key_for(url)
+    if key is None:
+        return
+    db.session.execute(
+        update(Blob)
+        .where(Blob.key == key, Blob.refcount > 0)
+        .values(
+            refcount=Blob.refcount - 1,
+            released_at=case((Blob.refcount <= 1, _now()), else_=Blob.released_at),
+        )
+    )
+    if db.session.execute(select(Blob.refcount).where(Blob.key == key)).scalar() == 0:
+        _schedule_gc()
+
+
+def _schedule_gc():
+    # runs once the grace period is over; several pending gc jobs are harmless
+    jobs.enqueue("uploads.gc", delay=current_app.config.get("UPLOAD_GC_GRACE", 3600) + 60)
+
+
+def _variant_keys(variants):
+    for entry in (variants or {}).values():
+        for value in entry.values():
+            key = key_for(value) if isinstance(value, str) else None
+            if key:
+                yield key
+
+
+def gc(grace=None):
+    """
+    Delete blobs (and their variants) that have had no references for `grace`
+    seconds. The row is removed with a conditional DELETE first, so a blob that
+    was retained again in the meantime is kept, and only committed once the
+    files are gone: an upload of the same bytes meanwhile waits on the row and
+    then writes the file again. Returns how many were deleted.
+    """
+    grace = current_app.config.get("UPLOAD_GC_GRACE", 3600) if grace is None else grace
+    cutoff = _now() - timedelta(seconds=grace)
+    candidates = db.session.execute(
+        select(Blob.key, Blob.variants).where(Blob.refcount <= 0, Blob.released_at <= cutoff)
+    ).all()
+    deleted = 0
+    for key, variants in candidates:
+        gone = db.session.execute(
+            delete(Blob).where(Blob.key == key, Blob.refcount <= 0, Blob.released_at <= cutoff)
+        ).rowcount
+        try:
+            if gone:
+                backend().delete(key)
+                for variant_key in _variant_keys(variants):
+                    backend().delete(variant_key)
+            db.session.commit()
+        except Exception:
+            # the row stays for the next run; a re-upload rewrites a missing file
+            db.session.rollback()
+            raise
+        deleted += gone
+    return deleted
+
+
+def recount():
+    """Recompute every refcount from the referencing rows (repairs drift). Returns rows changed."""
+    counts = Counter()
+    for (url,) in db.session.query(Event_Image.url).all():
+        counts[key_for(url)] += 1
+    for (url,) in db.session.query(User.profile_pic_path).all():
+        counts[key_for(url)] += 1
+    changed = 0
+    for blob in db.session.query(Blob).all():
+        refs = counts.get(blob.key, 0)
+        if blob.refcount != refs:
+            blob.refcount = refs
+            changed += 1
+        if refs and blob.released_at is not None:
+            blob.released_at = None
+        elif not refs and blob.released_at is None:
+            blob.released_at = _now()
+    db.session.commit()
+    return changed
+
+
+@jobs.handler("uploads.gc")
+def _gc_job():
+    gc()
+
+
+@uploads_bp.route("/media/<path:key>")
+def media(key):
+    try:
+        return backend().serve(key)
+    except ValueError:
+        abort(404)
+
+
+# CLI: flask uploads ...
+
+@uploads_bp.cli.command("gc")
+@click.option("--grace", type=int, help="Seconds a blob must have been unreferenced (default UPLOAD_GC_GRACE).")
+@click.option("--recount", "do_recount", is_flag=True, help="Recompute reference counts first.")
+@click.option("--orphans", is_flag=True, help="Also delete stored objects that have no blobs row.")
+def gc_command(grace, do_recount, orphans):
+    """Delete unreferenced uploads."""
+    if do_recount:
+        click.echo(f"Fixed {recount()} reference count(s).")
+    click.echo(f"Deleted {gc(grace)} unreferenced blob(s).")
+    if orphans:
+        known = set()
+        for key, variants in db.session.execute(select(Blob.key, Blob.variants)).all():
+            known.add(key)
+            known.update(_variant_keys(variants))
+        stray = [key for key in backend().keys() if key not in known]
+        for key in stray:
+            backend().delete(key)
+        click.echo(f"Deleted {len(stray)} orphaned object(s).")
+
+
+@uploads_bp.cli.command("stats")
+def stats_command():
+    """Show stored blobs, bytes and how many are unreferenced."""
+    blobs = db.session.query(Blob).all()
+    unreferenced = [b for b in blobs if b.refcount <= 0]
+    refs = sum(max(b.refcount, 0) for b in blobs)
+    click.echo(f"blobs: {len(blobs)} ({sum(b.size for b in blobs)} bytes)")
+    click.echo(f"references: {refs} (dedup saves {max(refs - len(blobs) + len(unreferenced), 0)} copies)")
+    click.echo(f"unreferenced: {len(unreferenced)} ({sum(b.size for b in unreferenced)} bytes)")
+
+
+@uploads_bp.cli.command("import")
+@click.option("--delete-legacy", is_flag=True, help="Remove the imported files from static/uploads afterwards.")
+def import_command(delete_legacy):
+    """Move images stored the old way (static/...) into content-addressed storage."""
+    from . import images
+
+    def legacy_path(url):
+        rel = url[len("/static/"):] if url.startswith("/static/") else url.lstrip("/")
+        return os.path.join(current_app.static_folder, rel)
+
+    imported, legacy_files = 0, set()
+    rows = [(img, "url") for img in db.session.query(Event_Image).all()]
+    rows += [(user, "profile_pic_path") for user in db.session.query(User).filter(User.profile_pic_path != None).all()]
+    for row, attr in rows:
+        url = getattr(row, attr)
+        if not url or key_for(url) or "://" in url:
+            continue
+        path = legacy_path(url)
+        if not os.path.isfile(path):
+            continue
+        new_url = store_file(path)
+        retain(new_url)
+        setattr(row, attr, new_url)
+        if isinstance(row, Event_Image):
+            row.variants = None
+            images.queue_variants(row)
+        else:
+            row.profile_pic_variants = None
+            images.queue_profile_variants(row)
+        imported += 1
+        # bundled images (static/img) stay; only former uploads are removable
+        if os.path.commonpath([os.path.abspath(path), os.path.join(current_app.static_folder, "uploads")]) == \
+                os.path.join(current_app.static_folder, "uploads"):
+            legacy_files.add(path)
+    db.session.commit()
+    if delete_legacy:
+        for path in legacy_files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    click.echo(f"Imported {imported} image(s); variants are built by the job queue.")
+
+
+def init_app(app):
+    app.extensions["storage"] = storage.from_config(app)
@@ -1,15 +1,19 @@
 from flask import Blueprint, render_template, session, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 from sqlalchemy import func, or_, cast, Float
+from sqlalchemy.orm import selectinload
 from datetime import datetime, timezone
 from .forms import CreateEventForm, CommentForm
 from .models import Event, Event_Image, Event_Tag, Tag, Comment, TicketType, Booking, User
-from . import db
+from . import db, listing, metrics
+from .conditional import conditional
+from .replicas import replica_reads
 from werkzeug.utils import secure_filename
 import os, time, uuid
 from urllib.parse import urlencode
 
 main_bp = Blueprint('main', __name__)
+metrics.instrument(main_bp)
 
 def _has_started(start_at):
     """
@@ -32,130 +36,64 @@ def _index():
     # redirect base url to /home
     return redirect(url_for('main.index'))
 
-@main_bp.route('/home')
-def index():
-    session['event'] = None
-
+def _render_listing(endpoint, default_sort):
+    """
+    Shared by /home and /search: filters, status, ordering and paging all run
+    in SQL through listing.build_listing, and only one page of events is loaded.
+    """
     # read filters from query string
     q_text = (request.args.get('q') or '').strip()
     category = (request.args.get('category') or '').strip()
     fmt = (request.args.get('format') or '').strip()
     price_min = request.args.get('price_min', type=float)
     price_max = request.args.get('price_max', type=float)
-    sort = (request.args.get('sort') or 'dateSoonest').strip()
+    sort = (request.args.get('sort') or default_sort).strip()
 
     status_filter = (request.args.get('status') or '').strip()
     page      = max((request.args.get('page', 1, type=int) or 1), 1)
-    per_page  = request.args.get('per_page', 9, type=int)
+    per_page  = min(max((request.args.get('per_page', 9, type=int) or 9), 1), 100)
 
-    # subquery: MIN(ticket price) per event
-    price_sq = (
-        db.session.query(
-            TicketType.event_id.label("event_id"),
-            func.min(cast(TicketType.price, Float)).label("min_price"),
-        )
-        .group_by(TicketType.event_id)
-        .subquery()
-    )
-    price_expr = func.coalesce(price_sq.c.min_price, 0.0)
-
-    sold_sq = (
-        db.session.query(
-            Booking.event_id.label("event_id"),
-            func.coalesce(func.sum(Booking.qty), 0).label("sold_qty"),
-        )
-        .filter(Booking.status == "CONFIRMED")
-        .group_by(Booking.event_id)
-        .subquery()
-    )
-
-    sold_qty_col = func.coalesce(sold_sq.c.sold_qty, 0).label("sold_qty")
-    
-    # base query
-    qry = (
-        db.session.query(
-            Event,
-            price_expr.label("min_price"),
-            sold_qty_col,
-        )
-        .outerjoin(price_sq, price_sq.c.event_id == Event.id)
-        .outerjoin(sold_sq, sold_sq.c.event_id == Event.id)
-        .group_by(Event.id)
+    # filters, status and ordering all run in SQL; only one page of events is loaded
+    qry, price_expr, sold_col, _, rank_col = listing.build_listing(
+        q_text=q_text,
+        category=category,
+        fmt=fmt,
+        price_min=price_min,
+        price_max=price_max,
+        status=status_filter,
+        with_price=listing.needs_price(sort, price_min, price_max),
     )
-
-    # filters
-    if q_text:
-        ilike = f"%{q_text}%"
-        qry = qry.filter(or_(Event.title.ilike(ilike), Event.description.ilike(ilike)))
-    if category:
-        qry = qry.filter(Tag.name == category)
-    if fmt:
-        qry = qry.filter(Event.event_type == fmt)
-    if price_min is not None:
-        qry = qry.filter(price_expr >= price_min)
-    if price_max is not None:
-        qry = qry.filter(price_expr <= price_max)
-
-    # sorting
-    if sort == 'dateSoonest':
-        qry = qry.order_by(Event.start_at.asc().nulls_last())
-    elif sort == 'priceLowHigh':
-        qry = qry.order_by(price_expr.asc())
-    elif sort == 'priceHighLow':
-        qry = qry.order_by(price_expr.desc())
-    elif sort == 'popularity':
-        qry = qry.order_by(sold_qty_col.desc(), Event.start_at.asc())
+    keys = listing.sort_keys(sort, price_expr, sold_col, rank_col)
+    qry = qry.options(selectinload(Event.images))
+
+    # ?cursor= switches to keyset paging (no OFFSET, no COUNT); page/per_page keep working
+    cursor_mode = 'cursor' in request.args
+    prev_cursor = next_cursor = None
+    if cursor_mode:
+        scope = f"{endpoint}:{sort}"
+        cursor = listing.decode_cursor(request.args.get('cursor'), scope)
+        rows, prev_cursor, next_cursor = listing.keyset_page(qry, keys, per_page, cursor, scope)
+        total, pages = None, 1
     else:
-        qry = qry.order_by(Event.start_at.asc().nulls_last())
-
-    rows = qry.all()
-
-    now_utc = datetime.now(timezone.utc)
-
-    def derive_status(e, sold_count):
-        if getattr(e, 'cancelled', False):
-            return 'Cancelled'
-
-        cap = e.capacity
-        if cap is not None and int(cap) <= 0:
-            return 'Sold Out'
-        if cap is not None and (sold_count or 0) >= cap:
-            return 'Sold Out'
+        rows, total, pages = listing.paginate(listing.apply_order(qry, keys), page, per_page)
 
-        if _has_started(e.start_at):
-            return 'Inactive'
+    # prices for the cards come from the aggregate cache, not a join per request
+    prices = listing.min_prices([e.id for (e, _, _) in rows])
 
-        return 'Open'
-
-
-    enriched = []
-    for (e, mp, sold_qty) in rows:
-        s = derive_status(e, int(sold_qty or 0))
-        enriched.append({
+    page_items = []
+    for (e, sold_qty, s) in rows:
+        page_items.append({
             "event": e,
-            "min_price": float(mp or 0.0),
+            "min_price": prices.get(e.id, 0.0),
             "sold_count": int(sold_qty or 0),
             "status": s
         })
 
-    if status_filter:
-        enriched = [r for r in enriched if r["status"] == status_filter]
-
-    # paginate
-    total = len(enriched)
-    pages = max((total + per_page - 1) // per_page, 1)
-    start = (page - 1) * per_page
-    end   = start + per_page
-    page_items = enriched[start:end]
-
     window = 2
     start_page = max(1, page - window)
     end_page   = min(pages, page + window)
 
-    base_params = request.args.to_dict()
-    base_params.pop('page', None)
-    base_params.pop('per_page', None)
-    base_params = {k: v for k, v in base_params.items() if v not in (None, '', [])}
+    base_qs = listing.page_query_string(request.args)
 
     return render_template(
         'index.html',
@@ -176,93 +114,31 @@ def index():
         has_next=(page < pages),
         prev_page=(page - 1),
         next_page=(page + 1),
-        base_params=base_params,
+        base_qs=base_qs,
         start_page=start_page,
         end_page=end_page,
+        cursor_mode=cursor_mode,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        list_url=url_for(endpoint),
     )
 
+@main_bp.route('/home')
+@replica_reads
+@conditional(listing.listing_version)
+def index():
+    session['event'] = None
+    return _render_listing('main.index', 'dateSoonest')
+
 # Legacy redirect: keep old links working
 @main_bp.route('/bookinghistory')
 def bookingHistory():
     return redirect(url_for('bookings.booking_history'))
 
 @main_bp.route('/search')
+@replica_reads
+@conditional(listing.listing_version)
 def search_events():
-    q_text     = (request.args.get('q') or '').strip()
-    category   = (request.args.get('category') or '').strip()
-    fmt        = (request.args.get('format') or '').strip()
-    price_min  = request.args.get('price_min', type=float)
-    price_max  = request.args.get('price_max', type=float)
-    sort       = (request.args.get('sort') or 'relevance').strip()
-
-    # define min price subquery/expr in THIS function
-    price_sq = (
-        db.session.query(
-            TicketType.event_id.label("event_id"),
-            func.min(cast(TicketType.price, Float)).label("min_price"),
-        )
-        .group_by(TicketType.event_id)
-        .subquery()
-    )
-    price_expr = func.coalesce(price_sq.c.min_price, 0.0)
-
-    sold_sq = (
-        db.session.query(
-            Booking.event_id.label("event_id"),
-            func.coalesce(func.sum(Booking.qty), 0).label("sold_qty"),
-        )
-        .filter(Booking.status == "CONFIRMED")
-        .group_by(Booking.event_id)
-        .subquery()
-    )
-    
-    qry = (
-        db.session.query(
-            Event,
-            price_expr.label("min_price"),
-            func.coalesce(sold_sq.c.sold_qty, 0).label("sold_qty"),
-        )
-        .outerjoin(price_sq, price_sq.c.event_id == Event.id)
-        .outerjoin(Booking, Booking.event_id == Event.id)
-        .outerjoin(Event_Tag, Event_Tag.event_id == Event.id)
-        .outerjoin(Tag, Tag.id == Event_Tag.tag_id)
-        .group_by(Event.id, price_sq.c.min_price, sold_sq.c.sold_qty)
-    )
-
-    if q_text:
-        ilike = f"%{q_text}%"
-        qry = qry.filter(or_(Event.title.ilike(ilike), Event.description.ilike(ilike)))
-    if category:
-        qry = qry.filter(Tag.name == category)
-    if fmt:
-        qry = qry.filter(Event.event_type == fmt)
-    if price_min is not None:
-        qry = qry.having(func.coalesce(func.min(TicketType.price), 0) >= price_min)
-    if price_max is not None:
-        qry = qry.having(func.coalesce(func.min(TicketType.price), 1_000_000) <= price_max)
-
-    if sort == 'dateSoonest':
-        qry = qry.order_by(Event.start_at.asc().nulls_last())
-    elif sort == 'priceLowHigh':
-        qry = qry.order_by(func.coalesce(func.min(TicketType.price), 0).asc())
-    elif sort == 'priceHighLow':
-        qry = qry.order_by(func.coalesce(func.min(TicketType.price), 0).desc())
-    elif sort == 'popularity':
-        qry = qry.order_by(func.coalesce(sold_sq.c.sold_qty, 0).desc(), Event.start_at.asc())
-    else:
-        qry = qry.order_by(Event.start_at.asc().nulls_last())
-
-    rows = qry.all()
-    results = [{'event': e, 'min_price': mp, 'popularity': pop} for (e, mp, pop) in rows]
-
-    return render_template(
-        'index.html',
-        active_page='home',
-        results=results,
-        q=q_text,
-        category_selected=category,
-        price_min=price_min,
-        price_max=price_max,
-        sort_selected=sort,
-        fmt_selected=fmt,
-    )
\ No newline at end of file
+    # same engine as /home: the tag filter is an EXISTS semi-join and every
+    # aggregate (min price, sold qty) is pre-grouped, so bookings never fan out rows
+    return _render_listing('main.search_events', 'relevance')
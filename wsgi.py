@@ -0,0 +1,83 @@
+"""
+Production entry point.
+
+    python wsgi.py                                   # gunicorn, WSGI_* settings
+    python wsgi.py --bind 0.0.0.0:8000 --workers 4 --threads 8
+    gunicorn --preload -w 4 --threads 8 wsgi:app     # or drive gunicorn yourself
+
+Configure the app with BONDRA_SETTINGS=/path/to/settings.py or BONDRA_*
+environment variables (see create_app); at least BONDRA_SECRET_KEY. Without
+gunicorn (Windows) it falls back to waitress, which runs threads in one process.
+
+Apply schema migrations as a deploy step, before the workers start:
+
+    BONDRA_AUTO_MIGRATE=false flask --app wsgi db upgrade
+
+With more than one worker, point PROMETHEUS_MULTIPROC_DIR at a directory of
+its own so /metrics reports all of them (see website/metrics.py).
+"""
+import argparse, glob, os
+
+from website import create_app
+
+app = create_app()
+
+
+def _gunicorn(options):
+    from gunicorn.app.base import BaseApplication
+
+    # the app is created once here and forked into the workers (preload_app);
+    # create_app resets connections and job threads in each child
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+            if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+                self.cfg.set("child_exit", _metrics_child_exit)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def _metrics_child_exit(server, worker):
+    # an exited worker's live gauges (pool connections) must stop counting
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def _clear_metrics():
+    # samples of the previous run's workers
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the site with a production WSGI server.")
+    parser.add_argument("--bind", default=app.config.get("WSGI_BIND", "127.0.0.1:8000"))
+    parser.add_argument("--workers", type=int, default=app.config.get("WSGI_WORKERS", os.cpu_count() or 1))
+    parser.add_argument("--threads", type=int, default=app.config.get("WSGI_THREADS", 4))
+    parser.add_argument("--timeout", type=int, default=app.config.get("WSGI_TIMEOUT", 30))
+    args = parser.parse_args(argv)
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        _clear_metrics()
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        from waitress import serve
+        serve(app, listen=args.bind, threads=args.workers * args.threads)
+        return
+    _gunicorn({
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "preload_app": True,
+        "accesslog": "-",
+    })
+
+
+if __name__ == "__main__":
+    main()